@@ -13,12 +13,15 @@ from reportlab.pdfgen import canvas as rl_canvas
 from reportlab.lib.colors import HexColor
 import io
 from plm_module import plm, init_plm_db
+from plm_corte import corte_pedido
 from plm_explorer_routes import plm_explorer
+from trabajos import trabajos, tarea, encolar, init_trabajos_db
 
 app = Flask(__name__)
 DB = os.path.join(os.path.dirname(__file__), 'crm.db')
 app.register_blueprint(plm)
 app.register_blueprint(plm_explorer)
+app.register_blueprint(trabajos)
 
 # ── DB ────────────────────────────────────────────────────────────────────────
 def get_db():
@@ -183,6 +186,7 @@ def init_db():
     conn.commit()
     conn.close()
     init_plm_db()
+    init_trabajos_db()
 
 # ── HELPERS ───────────────────────────────────────────────────────────────────
 def next_num(tabla, campo, prefijo):
@@ -364,8 +368,13 @@ def presupuesto_detalle(id):
         FROM presupuestos p JOIN clientes c ON c.id = p.cliente_id
         WHERE p.id=?''',(id,)).fetchone()
     proyecto = conn.execute('SELECT * FROM proyectos WHERE presupuesto_id=?',(id,)).fetchone()
+    estimaciones = conn.execute('''SELECT e.*, d.codigo, d.nombre FROM plm_estimaciones e
+        JOIN plm_documentos d ON d.id = e.documento_id
+        WHERE e.presupuesto_id=? ORDER BY e.id''',(id,)).fetchall()
+    estimaciones = [dict(e, detalle=json.loads(e['detalle'] or '{}')) for e in estimaciones]
     conn.close()
-    return render_template('presupuesto_detalle.html', presupuesto=presupuesto, proyecto=proyecto)
+    return render_template('presupuesto_detalle.html', presupuesto=presupuesto, proyecto=proyecto,
+        estimaciones=estimaciones)
 
 @app.route('/presupuesto/<int:id>/editar', methods=['POST'])
 def presupuesto_editar(id):
@@ -537,15 +546,38 @@ def factura_eliminar(id):
     conn.commit(); conn.close()
     return redirect(url_for('facturacion'))
 
-@app.route('/factura/<int:id>/pdf')
-def factura_pdf(id):
+def factura_para_pdf(id):
     conn = get_db()
     f = conn.execute('''SELECT f.*, c.nombre as cliente_nombre, c.empresa as cliente_empresa,
         c.email as cliente_email, p.referencia as proyecto_ref
         FROM facturas f JOIN clientes c ON c.id=f.cliente_id
         LEFT JOIN proyectos p ON p.id=f.proyecto_id WHERE f.id=?''',(id,)).fetchone()
     conn.close()
+    return f
 
+@app.route('/factura/<int:id>/pdf')
+def factura_pdf(id):
+    f = factura_para_pdf(id)
+    response = make_response(generar_factura_pdf(f))
+    response.headers['Content-Type'] = 'application/pdf'
+    response.headers['Content-Disposition'] = f'attachment; filename={f["numero"]}.pdf'
+    return response
+
+@app.route('/factura/<int:id>/pdf/trabajo', methods=['POST'])
+def factura_pdf_trabajo(id):
+    return jsonify({'ok': True, 'job_id': encolar('factura_pdf', {'id': id})})
+
+@tarea('factura_pdf')
+def trabajo_factura_pdf(ctx, id):
+    f = factura_para_pdf(id)
+    if f is None:
+        raise ValueError(f'Factura {id} no encontrada')
+    ruta = ctx.ruta_archivo(f"{f['numero']}.pdf")
+    with open(ruta, 'wb') as out:
+        out.write(generar_factura_pdf(f))
+    return {'archivo': ruta}
+
+def generar_factura_pdf(f):
     buf = io.BytesIO()
     c = rl_canvas.Canvas(buf, pagesize=A4)
     W, H = A4
@@ -627,11 +659,7 @@ def factura_pdf(id):
     c.drawString(MARGIN,4.5*mm,"juanantonio@diseñomecanico.es  ·  juanantonio-mecanico.es")
     c.setFillColor(ORANGE); c.drawRightString(W-MARGIN,4.5*mm,"DISEÑO · FABRICACIÓN · ENTREGA")
     c.save()
-    buf.seek(0)
-    response = make_response(buf.read())
-    response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = f'attachment; filename={f["numero"]}.pdf'
-    return response
+    return buf.getvalue()
 
 # ── PROVEEDORES ───────────────────────────────────────────────────────────────
 @app.route('/proveedores')
@@ -770,8 +798,12 @@ def pedido_detalle_view(id):
         LEFT JOIN clientes c ON c.id = p.cliente_id
         LEFT JOIN albaranes a ON a.pedido_id = pp.id
         WHERE pp.id=?''',(id,)).fetchone()
+    cortes, totales_corte = corte_pedido(conn, id)
+    dxfs = conn.execute('''SELECT id, codigo, nombre FROM plm_documentos
+        WHERE lower(ruta_origen) LIKE '%.dxf' ORDER BY codigo''').fetchall()
     conn.close()
-    return render_template('pedido_detalle.html', pedido=pedido)
+    return render_template('pedido_detalle.html', pedido=pedido, cortes=cortes,
+        totales_corte=totales_corte, dxfs=dxfs)
 
 # ── ALBARANES ─────────────────────────────────────────────────────────────────
 @app.route('/albaranes')
@@ -0,0 +1,352 @@
+"""
+PLM Auditoría — JA · ERP
+Registro de actividad de los documentos (lo que antes era plm_log).
+
+Cada entrada ocupa lo mínimo: la acción es un código entero (plm_auditoria_acciones
+da su nombre; las nuevas se dan de alta solas) y la fecha, segundos Unix (UTC).
+Se consulta por documento (índice documento_id, id) y por fecha (índice fecha).
+
+Las entradas de meses pasados (más de RETENCION_MESES) se archivan por meses en
+plm_auditoria_archivo: ordenadas por documento y en bloques de BLOQUE_ARCHIVO
+comprimidos (zstd si está instalado, si no zlib), cada uno con su rango de
+documentos. plm_auditoria_archivo_docs dice en qué meses aparece cada documento;
+así el historial de un documento solo descomprime un bloque por mes en que tuvo
+actividad.
+
+Para escribir hay dos caminos:
+
+    registrar_db / registrar_lote   dentro de la transacción del llamador
+    Registro.registrar              a un búfer que se escribe por lotes (cada
+                                    LOTE entradas o INTERVALO segundos) con una
+                                    sola conexión; también archiva una vez al día
+"""
+
+import atexit
+import calendar
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import date
+
+from plm_core import zstandard
+
+log = logging.getLogger('plm_auditoria')
+
+ACCIONES = ('CREADO', 'ESTADO', 'REVISION', 'REGISTRADO', 'WATCHER_NUEVO', 'WATCHER_CAMBIO',
+            'SYNC_NUEVO', 'SYNC_MOVIDO', 'SYNC_BORRADO', 'BOM', 'PRESUPUESTO', 'PEDIDO')
+RETENCION_MESES = 12   # meses completos que se quedan en plm_auditoria
+LOTE = 500
+INTERVALO = 2.0        # segundos máximos que una entrada espera en el búfer
+NIVEL_ZSTD = 9          # más no compensa: bloques pequeños y muy repetitivos
+BLOQUE_ARCHIVO = 1000  # entradas por bloque comprimido
+MAX_RESULTADOS = 1000
+
+_SELECT = '''SELECT a.id, a.documento_id, c.nombre AS accion,
+                    datetime(a.fecha, 'unixepoch') AS fecha, a.detalle
+             FROM plm_auditoria a JOIN plm_auditoria_acciones c ON c.codigo = a.accion'''
+
+
+# ── ESQUEMA ───────────────────────────────────────────────────────────────────
+
+def asegurar_auditoria(conn):
+    """Tablas de auditoría; migra (y elimina) el plm_log antiguo si queda."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_auditoria_acciones (
+        codigo INTEGER PRIMARY KEY,
+        nombre TEXT UNIQUE NOT NULL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_auditoria (
+        id INTEGER PRIMARY KEY,
+        documento_id INTEGER,
+        accion INTEGER NOT NULL,     -- plm_auditoria_acciones.codigo
+        fecha INTEGER NOT NULL,      -- segundos Unix (UTC)
+        detalle TEXT)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plm_auditoria_doc ON plm_auditoria(documento_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plm_auditoria_fecha ON plm_auditoria(fecha)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_auditoria_archivo (
+        id INTEGER PRIMARY KEY,
+        mes TEXT NOT NULL,           -- 'YYYY-MM' (UTC)
+        doc_min INTEGER NOT NULL,    -- rango de documento_id del bloque (-1 = sin documento)
+        doc_max INTEGER NOT NULL,
+        entradas INTEGER NOT NULL,
+        formato TEXT NOT NULL,       -- zst | zlib
+        datos BLOB NOT NULL,         -- JSON [[id, documento_id, accion, fecha, detalle], ...]
+        creado TEXT DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plm_auditoria_archivo_mes ON plm_auditoria_archivo(mes, doc_min)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_auditoria_archivo_docs (
+        documento_id INTEGER NOT NULL,
+        mes TEXT NOT NULL,
+        entradas INTEGER NOT NULL,
+        PRIMARY KEY (documento_id, mes)) WITHOUT ROWID''')
+    conn.executemany("INSERT OR IGNORE INTO plm_auditoria_acciones (codigo, nombre) VALUES (?,?)",
+                     list(enumerate(ACCIONES, 1)))
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='plm_log'").fetchone():
+        conn.execute('''INSERT OR IGNORE INTO plm_auditoria_acciones (nombre)
+                        SELECT DISTINCT COALESCE(accion, '') FROM plm_log''')
+        conn.execute('''INSERT INTO plm_auditoria (documento_id, accion, fecha, detalle)
+            SELECT l.documento_id, c.codigo,
+                   COALESCE(CAST(strftime('%s', l.fecha) AS INTEGER), 0), l.detalle
+            FROM plm_log l JOIN plm_auditoria_acciones c ON c.nombre = COALESCE(l.accion, '')
+            ORDER BY l.id''')
+        conn.execute("DROP TABLE plm_log")
+    conn.commit()
+
+
+# ── ESCRITURA ─────────────────────────────────────────────────────────────────
+
+_codigos = {}
+_codigos_lock = threading.Lock()
+
+
+def codigo_accion(conn, nombre):
+    """Código de una acción; si es nueva se da de alta (en la transacción del llamador,
+    así que no se recuerda hasta que se lee ya confirmada)."""
+    with _codigos_lock:
+        codigo = _codigos.get(nombre)
+    if codigo is not None:
+        return codigo
+    row = conn.execute("SELECT codigo FROM plm_auditoria_acciones WHERE nombre=?", (nombre,)).fetchone()
+    if row is None:
+        # OR IGNORE: otro escritor puede haberla dado de alta entre la lectura y el alta
+        conn.execute("INSERT OR IGNORE INTO plm_auditoria_acciones (nombre) VALUES (?)", (nombre,))
+        return conn.execute("SELECT codigo FROM plm_auditoria_acciones WHERE nombre=?",
+                            (nombre,)).fetchone()[0]
+    with _codigos_lock:
+        _codigos[nombre] = row[0]
+    return row[0]
+
+
+def registrar_lote(conn, entradas, fecha=None):
+    """Escribe [(documento_id, acción, detalle), ...] con un executemany, dentro de
+    la transacción del llamador."""
+    fecha = int(fecha or time.time())
+    conn.executemany(
+        "INSERT INTO plm_auditoria (documento_id, accion, fecha, detalle) VALUES (?,?,?,?)",
+        [(doc, codigo_accion(conn, accion), fecha, detalle) for doc, accion, detalle in entradas])
+
+
+def registrar_db(conn, documento_id, accion, detalle=''):
+    registrar_lote(conn, [(documento_id, accion, detalle)])
+
+
+class Registro:
+    """Búfer de entradas que un hilo escribe por lotes con una sola conexión."""
+
+    def __init__(self, ruta_db):
+        self._ruta = ruta_db
+        self._conn = None
+        self._buffer = []
+        self._lock = threading.Lock()        # búfer
+        self._escritura = threading.Lock()   # conexión
+        self._hay = threading.Event()
+        self._hilo = None
+        self._archivado = None               # día de la última rotación
+
+    def registrar(self, documento_id, accion, detalle=''):
+        with self._lock:
+            self._buffer.append((documento_id, accion, detalle, int(time.time())))
+            lleno = len(self._buffer) >= LOTE
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._bucle, name='plm-auditoria', daemon=True)
+                self._hilo.start()
+                atexit.register(self.vaciar)
+        if lleno:
+            self._hay.set()
+
+    def vaciar(self):
+        """Escribe lo pendiente ya (antes de leer el historial, al salir...)."""
+        with self._escritura:
+            with self._lock:
+                lote, self._buffer = self._buffer, []
+            if not lote:
+                return
+            try:
+                with self._conexion():
+                    self._conn.executemany(
+                        "INSERT INTO plm_auditoria (documento_id, accion, fecha, detalle) VALUES (?,?,?,?)",
+                        [(doc, codigo_accion(self._conn, accion), fecha, detalle)
+                         for doc, accion, detalle, fecha in lote])
+            except sqlite3.Error as e:  # BD bloqueada, disco lleno...: se reintenta en el siguiente lote
+                log.warning(f"Auditoría aplazada: {e}")
+                with self._lock:
+                    self._buffer[:0] = lote
+
+    def _conexion(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._ruta, check_same_thread=False)
+        return self._conn
+
+    def _bucle(self):
+        while True:
+            self._hay.wait(INTERVALO)
+            self._hay.clear()
+            try:
+                self.vaciar()
+                if self._archivado != date.today():
+                    self._archivado = date.today()
+                    self._archivar()
+            except Exception:  # el hilo no puede morir: el búfer crecería sin escribirse
+                log.exception("Error en el registro de auditoría")
+
+    def _archivar(self):
+        conn = sqlite3.connect(self._ruta)  # aparte: vaciar() no espera a que termine
+        try:
+            archivar(conn)
+        except (sqlite3.Error, RuntimeError) as e:
+            log.warning(f"No se pudo archivar la auditoría: {e}")
+        finally:
+            conn.close()
+
+
+# ── ARCHIVO ───────────────────────────────────────────────────────────────────
+
+def _comprimir(datos):
+    if zstandard is not None:
+        return 'zst', zstandard.ZstdCompressor(level=NIVEL_ZSTD).compress(datos)
+    return 'zlib', zlib.compress(datos, 9)
+
+
+def _descomprimir(formato, datos):
+    if formato == 'zlib':
+        return zlib.decompress(datos)
+    if zstandard is None:
+        raise RuntimeError("El archivo de auditoría está comprimido con zstd: pip install zstandard")
+    return zstandard.ZstdDecompressor().decompress(datos)
+
+
+def _doc(e):
+    return -1 if e[1] is None else e[1]
+
+
+def _entradas_archivo(conn, mes, documento_id=None):
+    """Entradas archivadas de un mes; con documento_id, solo las de los bloques cuyo
+    rango lo incluye."""
+    if documento_id is None:
+        bloques = conn.execute("SELECT formato, datos FROM plm_auditoria_archivo WHERE mes=?", (mes,))
+    else:
+        bloques = conn.execute('''SELECT formato, datos FROM plm_auditoria_archivo
+            WHERE mes=? AND doc_min <= ? AND doc_max >= ?''', (mes, documento_id, documento_id))
+    return [e for formato, datos in bloques.fetchall() for e in json.loads(_descomprimir(formato, datos))]
+
+
+def _inicio_mes(anio, mes):
+    anio, mes = anio + (mes - 1) // 12, (mes - 1) % 12 + 1
+    return calendar.timegm((anio, mes, 1, 0, 0, 0))
+
+
+def archivar(conn, meses=RETENCION_MESES):
+    """Pasa al archivo comprimido las entradas anteriores a los últimos `meses`
+    meses completos, un mes por transacción. Si el mes ya estaba archivado (entradas
+    con fecha atrasada), se fusiona."""
+    hoy = date.today()
+    limite = _inicio_mes(hoy.year, hoy.month - meses)
+    resultado = {'meses': 0, 'entradas': 0}
+    primera = conn.execute("SELECT MIN(fecha) FROM plm_auditoria").fetchone()[0]
+    if primera is None or primera >= limite:
+        return resultado
+    inicio = time.gmtime(primera)
+    anio, m = inicio.tm_year, inicio.tm_mon
+    while _inicio_mes(anio, m) < limite:
+        desde, hasta = _inicio_mes(anio, m), _inicio_mes(anio, m + 1)
+        mes = f'{anio:04d}-{m:02d}'
+        anio, m = anio + m // 12, m % 12 + 1
+        with conn:
+            nuevas = [list(r) for r in conn.execute(
+                '''SELECT id, documento_id, accion, fecha, detalle FROM plm_auditoria
+                   WHERE fecha >= ? AND fecha < ?''', (desde, hasta))]
+            if not nuevas:
+                continue
+            entradas = sorted(_entradas_archivo(conn, mes) + nuevas, key=lambda e: (_doc(e), e[0]))
+            conn.execute("DELETE FROM plm_auditoria_archivo WHERE mes=?", (mes,))
+            bloques = []
+            for i in range(0, len(entradas), BLOQUE_ARCHIVO):
+                bloque = entradas[i:i + BLOQUE_ARCHIVO]
+                formato, datos = _comprimir(json.dumps(bloque, ensure_ascii=False,
+                                                       separators=(',', ':')).encode())
+                bloques.append((mes, _doc(bloque[0]), _doc(bloque[-1]), len(bloque), formato, datos))
+            conn.executemany('''INSERT INTO plm_auditoria_archivo
+                (mes, doc_min, doc_max, entradas, formato, datos) VALUES (?,?,?,?,?,?)''', bloques)
+            por_doc = {}
+            for e in entradas:
+                if e[1] is not None:
+                    por_doc[e[1]] = por_doc.get(e[1], 0) + 1
+            conn.execute("DELETE FROM plm_auditoria_archivo_docs WHERE mes=?", (mes,))
+            conn.executemany("INSERT INTO plm_auditoria_archivo_docs (documento_id, mes, entradas) VALUES (?,?,?)",
+                             [(d, mes, n) for d, n in por_doc.items()])
+            conn.execute("DELETE FROM plm_auditoria WHERE fecha >= ? AND fecha < ?", (desde, hasta))
+        resultado['meses'] += 1
+        resultado['entradas'] += len(nuevas)
+    return resultado
+
+
+# ── CONSULTA ──────────────────────────────────────────────────────────────────
+
+def _fila_archivo(e, nombres):
+    return {'id': e[0], 'documento_id': e[1], 'accion': nombres.get(e[2], str(e[2])),
+            'fecha': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(e[3])), 'detalle': e[4]}
+
+
+def _nombres(conn):
+    return dict(conn.execute("SELECT codigo, nombre FROM plm_auditoria_acciones").fetchall())
+
+
+def _epoch(dia):
+    """'YYYY-MM-DD' → segundos Unix del inicio de ese día (UTC)."""
+    return calendar.timegm(date.fromisoformat(dia).timetuple())
+
+
+def consultar(conn, documento_id=None, desde=None, hasta=None, accion=None, limite=20):
+    """Entradas más recientes primero, del registro vivo y, si no llegan, de los meses
+    archivados. desde / hasta son días 'YYYY-MM-DD' (hasta incluido)."""
+    limite = max(1, min(int(limite), MAX_RESULTADOS))
+    ini = _epoch(desde) if desde else None
+    fin = _epoch(hasta) + 86400 if hasta else None
+    where, params = [], []
+    if documento_id is not None:
+        where.append('a.documento_id = ?')
+        params.append(documento_id)
+    if ini is not None:
+        where.append('a.fecha >= ?')
+        params.append(ini)
+    if fin is not None:
+        where.append('a.fecha < ?')
+        params.append(fin)
+    codigo = None
+    if accion:
+        row = conn.execute("SELECT codigo FROM plm_auditoria_acciones WHERE nombre=?", (accion,)).fetchone()
+        if row is None:
+            return []
+        codigo = row[0]
+        where.append('a.accion = ?')
+        params.append(codigo)
+    orden = 'a.id DESC' if documento_id is not None and ini is None and fin is None else 'a.fecha DESC, a.id DESC'
+    filas = [dict(r) for r in conn.execute(
+        f"{_SELECT} {'WHERE ' + ' AND '.join(where) if where else ''} ORDER BY {orden} LIMIT ?",
+        params + [limite])]
+    if len(filas) >= limite:
+        return filas
+
+    # meses archivados, del más reciente al más antiguo
+    if documento_id is not None:
+        meses = [r[0] for r in conn.execute(
+            "SELECT mes FROM plm_auditoria_archivo_docs WHERE documento_id=? ORDER BY mes DESC",
+            (documento_id,))]
+    else:
+        meses = [r[0] for r in conn.execute("SELECT DISTINCT mes FROM plm_auditoria_archivo ORDER BY mes DESC")]
+    nombres = _nombres(conn)
+    for mes in meses:
+        anio, m = map(int, mes.split('-'))
+        if (ini is not None and _inicio_mes(anio, m + 1) <= ini) or (fin is not None and _inicio_mes(anio, m) >= fin):
+            continue
+        for e in sorted(_entradas_archivo(conn, mes, documento_id), key=lambda e: (e[3], e[0]), reverse=True):
+            if ((documento_id is None or e[1] == documento_id) and (codigo is None or e[2] == codigo)
+                    and (ini is None or e[3] >= ini) and (fin is None or e[3] < fin)):
+                filas.append(_fila_archivo(e, nombres))
+                if len(filas) >= limite:
+                    return filas
+    return filas
+
+
+def historial(conn, documento_id, limite=20):
+    return consultar(conn, documento_id=documento_id, limite=limite)
@@ -0,0 +1,197 @@
+"""
+PLM Búsqueda — JA · ERP
+Consulta de documentos con facetas (estado, tipo, software, proyecto, fecha de
+modificación), orden y paginación por clave.
+
+Las facetas salen de una sola consulta agrupada por estado, tipo, software,
+proyecto y periodo de modificación (con solo el filtro de texto aplicado); cada
+faceta se cuenta en Python con los filtros de las demás, así que sus números
+dicen cuántos documentos quedarían al marcar esa opción. Los periodos son
+acumulativos (hoy ⊂ 7 días ⊂ 30 días ⊂ año) y se agrupan por el más corto. El
+resultado se guarda por texto buscado y día hasta que cambia plm_documentos
+(contador de plm_avisos, ver plm_core).
+
+Las páginas se piden por clave: el cursor es el (valor de orden, id) de la
+última fila y la siguiente página empieza justo detrás, con el índice de la
+columna de orden; no hay OFFSET que recorrer.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
+
+from plm_core import asegurar_avisos, version_aviso
+
+TABLAS_AVISO_DOCS = {'plm_documentos': 'codigo, nombre, tipo, software, estado, proyecto_id, modificado'}
+ORDENES = {   # clave → (columna, descendente por defecto)
+    'modificado': ('d.modificado', True),
+    'creado': ('d.creado', True),
+    'codigo': ('d.codigo', False),
+    'nombre': ('d.nombre', False),
+}
+FACETAS = ('estado', 'tipo', 'software', 'proyecto', 'modificado')
+PERIODOS = (('hoy', 'Hoy', 0), ('7d', 'Últimos 7 días', 7), ('30d', 'Últimos 30 días', 30),
+            ('365d', 'Último año', 365))
+POR_PAGINA = 50
+MAX_POR_PAGINA = 500
+MAX_CACHE = 32   # textos buscados cuyas facetas se guardan
+
+
+def asegurar_busqueda(conn):
+    asegurar_avisos(conn, TABLAS_AVISO_DOCS)
+    for nombre, columnas in (('modificado', 'modificado, id'), ('creado', 'creado, id'),
+                             ('nombre', 'nombre, id'), ('proyecto', 'proyecto_id')):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_plm_documentos_{nombre} ON plm_documentos({columnas})")
+    conn.commit()
+
+
+# ── FILTROS ───────────────────────────────────────────────────────────────────
+
+def _desde(periodo, hoy=None):
+    """Fecha (YYYY-MM-DD) a partir de la que cuenta un periodo de PERIODOS."""
+    dias = next((d for clave, _, d in PERIODOS if clave == periodo), None)
+    return None if dias is None else ((hoy or date.today()) - timedelta(days=dias)).isoformat()
+
+
+def _filtro_texto(q):
+    q = (q or '').strip()
+    if not q:
+        return '', []
+    patron = '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    return (" AND (d.codigo LIKE ? ESCAPE '\\' OR d.nombre LIKE ? ESCAPE '\\' "
+            "OR d.descripcion LIKE ? ESCAPE '\\')"), [patron] * 3
+
+
+def _filtros_sql(filtros):
+    """Cláusula WHERE (tras el texto) para {faceta: [valores]}. '' es «sin valor»."""
+    sql, params = [], []
+    for faceta, columna in (('estado', 'd.estado'), ('tipo', 'd.tipo'), ('software', 'd.software'),
+                            ('proyecto', 'd.proyecto_id')):
+        valores = filtros.get(faceta)
+        if valores:
+            sql.append(f"COALESCE({columna}, '') IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps([v if v == '' or faceta != 'proyecto' else int(v) for v in valores]))
+    desde = _desde((filtros.get('modificado') or [None])[0])
+    if desde:
+        sql.append("d.modificado >= ?")
+        params.append(desde)
+    return ''.join(' AND ' + s for s in sql), params
+
+
+# ── FACETAS ───────────────────────────────────────────────────────────────────
+
+class Facetas:
+    """Combinaciones (estado, tipo, software, proyecto, periodo) → nº de documentos,
+    por texto buscado y día, válidas mientras no cambie plm_documentos. periodo es el
+    índice en PERIODOS del más corto que incluye la fecha (len(PERIODOS) si ninguno)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._cache = OrderedDict()
+
+    def grupos(self, conn, q):
+        version = version_aviso(conn, 'plm_documentos')
+        hoy = date.today()
+        clave = (q, hoy)
+        with self._lock:
+            if version is None or version != self._version:
+                self._cache.clear()
+                self._version = version
+            elif clave in self._cache:
+                self._cache.move_to_end(clave)
+                return self._cache[clave]
+        texto, params = _filtro_texto(q)
+        periodo = ' '.join(f"WHEN d.modificado >= '{_desde(p, hoy)}' THEN {i}"
+                           for i, (p, _, _) in enumerate(PERIODOS))
+        filas = conn.execute(f'''SELECT COALESCE(d.estado, ''), COALESCE(d.tipo, ''),
+                   COALESCE(d.software, ''), COALESCE(d.proyecto_id, ''),
+                   CASE {periodo} ELSE {len(PERIODOS)} END, COUNT(*)
+            FROM plm_documentos d WHERE 1=1{texto}
+            GROUP BY 1, 2, 3, 4, 5''', params).fetchall()
+        grupos = [tuple(f) for f in filas]
+        with self._lock:
+            if version == self._version:
+                self._cache[clave] = grupos
+                while len(self._cache) > MAX_CACHE:
+                    self._cache.popitem(last=False)
+        return grupos
+
+
+facetas_cache = Facetas()
+
+
+def contar_facetas(conn, q, filtros):
+    """{faceta: [{valor, etiqueta, n, marcado}]} y el total con todos los filtros."""
+    grupos = facetas_cache.grupos(conn, q)
+    marcados = {f: {str(v) for v in filtros.get(f) or ()} for f in FACETAS[:4]}
+    periodo = (filtros.get('modificado') or [None])[0]
+    claves_periodo = [clave for clave, _, _ in PERIODOS]
+    hasta = claves_periodo.index(periodo) if periodo in claves_periodo else None
+
+    cuentas = {f: {} for f in FACETAS}
+    total = 0
+    for g in grupos:
+        valores, p, n = [str(v) for v in g[:4]], g[4], g[5]
+        # facetas que esta combinación incumple (fuera de las de la propia faceta)
+        fallan = [f for f, v in zip(FACETAS[:4], valores) if marcados[f] and v not in marcados[f]]
+        if hasta is not None and p > hasta:
+            fallan.append('modificado')
+        if not fallan:
+            total += n
+        for f, v in zip(FACETAS[:4], valores):
+            if not fallan or fallan == [f]:
+                cuentas[f][v] = cuentas[f].get(v, 0) + n
+        if not fallan or fallan == ['modificado']:
+            for clave in claves_periodo[p:]:
+                cuentas['modificado'][clave] = cuentas['modificado'].get(clave, 0) + n
+
+    ids = [int(v) for v in cuentas['proyecto'] if v]
+    nombres = {str(r[0]): r[1] for r in conn.execute(
+        "SELECT id, nombre FROM proyectos WHERE id IN (SELECT value FROM json_each(?))",
+        (json.dumps(ids),))}
+    res = {}
+    for f in FACETAS[:4]:
+        etiqueta = (lambda v: nombres.get(v, f'#{v}')) if f == 'proyecto' else (lambda v: v.replace('_', ' '))
+        res[f] = sorted(({'valor': v, 'etiqueta': etiqueta(v) if v else '(sin valor)', 'n': n,
+                          'marcado': v in marcados[f]} for v, n in cuentas[f].items()),
+                        key=lambda o: (-o['n'], o['etiqueta']))
+    res['modificado'] = [{'valor': clave, 'etiqueta': etiqueta, 'n': cuentas['modificado'].get(clave, 0),
+                          'marcado': clave == periodo} for clave, etiqueta, _ in PERIODOS]
+    return res, total
+
+
+# ── CONSULTA ──────────────────────────────────────────────────────────────────
+
+def buscar(conn, q='', filtros=None, orden='modificado', descendente=None, cursor=None,
+           limite=POR_PAGINA, con_facetas=True):
+    """Una página de documentos. cursor es el 'siguiente' de la página anterior."""
+    filtros = filtros or {}
+    columna, desc_defecto = ORDENES.get(orden, ORDENES['modificado'])
+    desc = desc_defecto if descendente is None else descendente
+    limite = max(1, min(int(limite or POR_PAGINA), MAX_POR_PAGINA))
+    texto, p_texto = _filtro_texto(q)
+    where, p_where = _filtros_sql(filtros)
+    sql, params = texto + where, p_texto + p_where
+    if cursor:
+        valor, ultimo = json.loads(cursor)
+        sql += f" AND ({columna}, d.id) {'<' if desc else '>'} (?, ?)"
+        params += [valor, int(ultimo)]
+    sentido = 'DESC' if desc else 'ASC'
+    filas = [dict(r) for r in conn.execute(f'''SELECT d.id, d.codigo, d.nombre, d.tipo, d.software,
+               d.estado, d.proyecto_id, d.modificado, d.creado, p.nombre AS proyecto_nombre,
+               {columna} AS _clave
+        FROM plm_documentos d LEFT JOIN proyectos p ON p.id = d.proyecto_id
+        WHERE 1=1{sql}
+        ORDER BY {columna} {sentido}, d.id {sentido} LIMIT ?''', params + [limite + 1])]
+    siguiente = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente = json.dumps([filas[-1]['_clave'], filas[-1]['id']])
+    for f in filas:
+        del f['_clave']
+    res = {'documentos': filas, 'siguiente': siguiente, 'orden': orden, 'descendente': desc}
+    if con_facetas:
+        res['facetas'], res['total'] = contar_facetas(conn, q, filtros)
+    return res
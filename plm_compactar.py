@@ -0,0 +1,295 @@
+"""
+PLM Compactar — JA · ERP
+Compactación en segundo plano de las versiones antiguas del vault.
+
+La versión actual de cada documento (plm_documentos.hash_b2) nunca se toca: sigue
+en claro y se lee directamente. Las anteriores se guardan como delta zstd contra
+la versión siguiente del mismo documento o, si no compensa, comprimidas enteras.
+Los autoguardados (versiones que entraron por watcher o sync sin revisión) se
+recortan según el estado del documento.
+
+Uso:
+    python plm_compactar.py
+"""
+
+import os
+import sqlite3
+import threading
+import zlib
+
+from plm_core import (asegurar_esquema, blob_relativo, ruta_vault, ruta_blob_guardado,
+                      leer_blob, zstandard, MAX_CADENA_DELTA, HASH_BUFFER)
+
+DB = os.path.join(os.path.dirname(__file__), 'crm.db')
+
+# Política por estado del documento:
+#   comprimir      las versiones no actuales se guardan comprimidas / como delta
+#   autoguardados  cuántas versiones sin revisión se conservan (None = todas)
+# Las versiones de una revisión 'liberado' se conservan siempre en claro.
+RETENCION = {
+    'liberado':  {'comprimir': False, 'autoguardados': None},
+    'aprobado':  {'comprimir': True,  'autoguardados': None},
+    'revision':  {'comprimir': True,  'autoguardados': 20},
+    'en_diseno': {'comprimir': True,  'autoguardados': 10},
+    'obsoleto':  {'comprimir': True,  'autoguardados': 0},
+}
+
+NIVEL_ZSTD = 19
+NIVEL_DELTA = 10
+MAX_DELTA = 128 * 1024 * 1024  # por encima, compresión normal en streaming
+LOTE_BD = 200
+
+
+def get_db():
+    conn = sqlite3.connect(DB)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+# ── PROGRESO ──────────────────────────────────────────────────────────────────
+# Como en plm_sync: el observador (si lo hay) recibe una copia en cada avance.
+
+_lock = threading.Lock()
+_progreso = {'estado': 'inactivo'}
+_observador = None
+
+
+def _avanzar(**cambios):
+    with _lock:
+        for k, v in cambios.items():
+            if k.startswith('+'):
+                _progreso[k[1:]] = _progreso.get(k[1:], 0) + v
+            else:
+                _progreso[k] = v
+        copia = dict(_progreso)
+    if _observador is not None:
+        _observador(copia)
+
+
+def estado_compactacion():
+    with _lock:
+        return dict(_progreso)
+
+
+# ── PLAN ──────────────────────────────────────────────────────────────────────
+
+def planificar(conn):
+    """Decide qué referencias sobran y qué blobs comprimir.
+    Devuelve (refs_a_borrar, [(hash, base_hash | None)])."""
+    refs = conn.execute('''SELECT r.id, r.hash_b2, r.documento_id, r.revision_id,
+            d.estado, d.hash_b2 AS actual, v.estado AS estado_rev
+        FROM plm_blob_refs r
+        JOIN plm_documentos d ON d.id = r.documento_id
+        LEFT JOIN plm_revisiones v ON v.id = r.revision_id
+        ORDER BY r.documento_id, r.id''').fetchall()
+    blobs = {r['hash_b2']: (r['formato'], r['base_hash'])
+             for r in conn.execute("SELECT hash_b2, formato, base_hash FROM plm_blobs")}
+
+    por_doc = {}
+    for r in refs:
+        por_doc.setdefault(r['documento_id'], []).append(r)
+
+    protegidos = {r['actual'] for r in refs if r['actual']}
+    protegidos.update(r['hash_b2'] for r in refs
+                      if r['estado_rev'] == 'liberado'
+                      or not RETENCION.get(r['estado'], RETENCION['en_diseno'])['comprimir'])
+
+    refs_a_borrar = []
+    cadenas = []  # por documento: hashes conservados, del más reciente al más antiguo
+    for filas in por_doc.values():
+        politica = RETENCION.get(filas[0]['estado'], RETENCION['en_diseno'])
+        actual = filas[0]['actual']
+        ultima_ref, con_revision = {}, set()
+        for r in filas:
+            ultima_ref[r['hash_b2']] = r['id']
+            if r['revision_id'] is not None:
+                con_revision.add(r['hash_b2'])
+        orden = sorted(ultima_ref, key=ultima_ref.get, reverse=True)
+
+        limite = politica['autoguardados']
+        sobrantes = set()
+        if limite is not None:
+            autoguardados = [h for h in orden if h != actual and h not in con_revision]
+            sobrantes = set(autoguardados[limite:])
+            refs_a_borrar.extend(r['id'] for r in filas if r['hash_b2'] in sobrantes)
+        cadenas.append([h for h in orden if h not in sobrantes])
+
+    # Profundidad de cada delta y altura de los deltas que cuelgan de cada blob:
+    # un delta nuevo no puede dejar ninguna cadena por encima de MAX_CADENA_DELTA.
+    dependientes = {}
+    for h, (formato, base) in blobs.items():
+        if formato == 'delta':
+            dependientes.setdefault(base, []).append(h)
+
+    def profundidad(h):
+        n = 0
+        while blobs.get(h, ('raw', None))[0] == 'delta' and n <= MAX_CADENA_DELTA:
+            h = blobs[h][1]
+            n += 1
+        return n
+
+    def altura(h, n=0):
+        if n > MAX_CADENA_DELTA:
+            return n
+        return max((1 + altura(d, n + 1) for d in dependientes.get(h, ())), default=0)
+
+    tareas, vistos = [], set()
+    for cadena in cadenas:
+        for siguiente, h in zip(cadena, cadena[1:]):
+            if h in protegidos or h in vistos or blobs.get(h, ('', None))[0] != 'raw':
+                continue
+            vistos.add(h)
+            base = siguiente if zstandard is not None else None
+            if base is not None and profundidad(base) + 1 + altura(h) >= MAX_CADENA_DELTA:
+                base = None
+            if base is not None:
+                blobs[h] = ('delta', base)
+                dependientes.setdefault(base, []).append(h)
+            tareas.append((h, base))
+    return refs_a_borrar, tareas
+
+
+# ── EJECUCIÓN ─────────────────────────────────────────────────────────────────
+
+def _escribir_atomico(destino, escribir):
+    tmp = destino + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            escribir(f)
+        os.replace(tmp, destino)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def comprimir_blob(conn, hash_b2, base):
+    """Escribe la versión compactada junto al blob en claro (que sigue existiendo
+    hasta que la BD confirme el cambio). Devuelve (formato, base, tamano_disco)."""
+    crudo = ruta_vault(blob_relativo(hash_b2))
+    tamano = os.path.getsize(crudo)
+
+    if base is not None and tamano <= MAX_DELTA:
+        datos_base = leer_blob(conn, base)
+        if len(datos_base) <= MAX_DELTA:
+            with open(crudo, 'rb') as f:
+                datos = f.read()
+            window_log = min(31, max(20, max(len(datos), len(datos_base)).bit_length() + 1))
+            params = zstandard.ZstdCompressionParameters.from_level(NIVEL_DELTA, window_log=window_log)
+            dic = zstandard.ZstdCompressionDict(datos_base, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+            delta = zstandard.ZstdCompressor(dict_data=dic, compression_params=params).compress(datos)
+            destino = ruta_blob_guardado(hash_b2, 'delta')
+            _escribir_atomico(destino, lambda f: f.write(delta))
+            return 'delta', base, len(delta)
+
+    formato = 'zst' if zstandard is not None else 'zlib'
+    destino = ruta_blob_guardado(hash_b2, formato)
+
+    def escribir(f):
+        with open(crudo, 'rb') as src:
+            if zstandard is not None:
+                zstandard.ZstdCompressor(level=NIVEL_ZSTD).copy_stream(src, f, size=tamano)
+                return
+            z = zlib.compressobj(9)
+            for bloque in iter(lambda: src.read(HASH_BUFFER), b''):
+                f.write(z.compress(bloque))
+            f.write(z.flush())
+
+    _escribir_atomico(destino, escribir)
+    return formato, None, os.path.getsize(destino)
+
+
+_HUERFANO = '''NOT EXISTS (SELECT 1 FROM plm_blob_refs r WHERE r.hash_b2 = b.hash_b2)
+      AND NOT EXISTS (SELECT 1 FROM plm_documentos d WHERE d.hash_b2 = b.hash_b2)
+      AND NOT EXISTS (SELECT 1 FROM plm_revisiones v WHERE v.hash_b2 = b.hash_b2)
+      AND NOT EXISTS (SELECT 1 FROM plm_blobs x WHERE x.base_hash = b.hash_b2)'''
+
+
+def recoger_huerfanos(conn):
+    """Borra los blobs que ya nadie usa (ni referencias, ni documentos,
+    ni revisiones, ni como base de un delta).
+
+    Cada lote se vuelve a comprobar y se borra del disco con el bloqueo de
+    escritura tomado: una ingesta que acaba de reutilizar el blob ya lo habrá
+    referenciado, y una posterior lo restaura (plm_core.referenciar_blob)."""
+    huerfanos = conn.execute(f"SELECT hash_b2, formato FROM plm_blobs b WHERE {_HUERFANO}").fetchall()
+    eliminados = 0
+    for i in range(0, len(huerfanos), LOTE_BD):
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for r in huerfanos[i:i + LOTE_BD]:
+                if not conn.execute(f"DELETE FROM plm_blobs AS b WHERE hash_b2=? AND {_HUERFANO}",
+                                    (r['hash_b2'],)).rowcount:
+                    continue
+                eliminados += 1
+                for ruta in {ruta_vault(blob_relativo(r['hash_b2'])),
+                             ruta_blob_guardado(r['hash_b2'], r['formato'])}:
+                    try:
+                        os.remove(ruta)
+                    except OSError:
+                        pass
+    _avanzar(**{'+eliminados': eliminados})
+
+
+def compactar(observador=None):
+    """Aplica la política de retención y compacta las versiones antiguas."""
+    global _observador
+    with _lock:
+        _progreso.clear()
+        _progreso['estado'] = 'analizando'
+    _observador = observador
+    conn = get_db()
+    try:
+        refs_a_borrar, tareas = planificar(conn)
+        _avanzar(**{'estado': 'compactando', 'total': len(tareas),
+                    'refs_recortadas': len(refs_a_borrar)})
+
+        for i in range(0, len(refs_a_borrar), LOTE_BD):
+            with conn:
+                conn.executemany("DELETE FROM plm_blob_refs WHERE id=?",
+                                 [(ref_id,) for ref_id in refs_a_borrar[i:i + LOTE_BD]])
+        recoger_huerfanos(conn)
+
+        for h, base in tareas:
+            crudo = ruta_vault(blob_relativo(h))
+            try:
+                tamano = os.path.getsize(crudo)
+                formato, base, en_disco = comprimir_blob(conn, h, base)
+            except (OSError, RuntimeError):
+                _avanzar(**{'+errores': 1})
+                continue
+            if en_disco >= tamano:
+                os.remove(ruta_blob_guardado(h, formato))
+                _avanzar(**{'+procesados': 1})
+                continue
+            # Si entretanto volvió a ser la versión actual de algún documento, se queda
+            # en claro. El claro se borra antes del commit, con el bloqueo de escritura
+            # tomado, para que ninguna ingesta lo dé por bueno y lo pierda después.
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                cur = conn.execute('''UPDATE plm_blobs SET formato=?, base_hash=?, tamano_disco=?
+                    WHERE hash_b2=? AND formato='raw'
+                      AND NOT EXISTS (SELECT 1 FROM plm_documentos WHERE hash_b2=?)''',
+                    (formato, base, en_disco, h, h))
+                if cur.rowcount:
+                    os.remove(crudo)
+            if cur.rowcount:
+                _avanzar(**{'+procesados': 1, '+' + ('deltas' if formato == 'delta' else 'comprimidos'): 1,
+                            '+bytes_antes': tamano, '+bytes_despues': en_disco})
+            else:
+                os.remove(ruta_blob_guardado(h, formato))
+                _avanzar(**{'+procesados': 1})
+        _avanzar(estado='terminado')
+        return estado_compactacion()
+    finally:
+        _observador = None
+        conn.close()
+
+
+if __name__ == '__main__':
+    conn = get_db()
+    asegurar_esquema(conn)
+    conn.close()
+    print(compactar())
@@ -0,0 +1,543 @@
+"""
+PLM Core — JA · ERP
+Utilidades compartidas (sin Flask) entre plm_module, plm_explorer_routes y plm_watcher.
+"""
+
+import os
+import json
+import hashlib
+import io
+import zlib
+import tempfile
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:  # sin zstd el vault comprime con zlib y sin deltas
+    zstandard = None
+
+
+# ── ESQUEMA ───────────────────────────────────────────────────────────────────
+
+def asegurar_esquema(conn):
+    """Migraciones idempotentes de las tablas PLM compartidas (ERP y watcher)."""
+    asegurar_ruta_norm(conn)
+    asegurar_hash_cache(conn)
+    asegurar_snapshot(conn)
+    asegurar_vault(conn)
+    asegurar_avisos(conn)
+    asegurar_metadatos(conn)
+
+
+# ── RUTAS NORMALIZADAS ────────────────────────────────────────────────────────
+# plm_documentos.ruta_norm guarda la ruta resuelta (symlinks), con separadores y
+# mayúsculas normalizados según el SO. Tiene índice UNIQUE: todas las búsquedas
+# por ruta (explorador, watcher, sync manual, registro) pasan por aquí.
+
+def normalizar_ruta(ruta):
+    """Ruta canónica para comparar: absoluta, sin symlinks, normcase."""
+    if not ruta:
+        return None
+    return os.path.normcase(os.path.realpath(ruta))
+
+
+def normalizar_en_directorio(dir_norm, entry):
+    """Normaliza una entrada de os.scandir reutilizando la ruta ya resuelta
+    del directorio (evita un realpath por archivo en unidades de red)."""
+    try:
+        if entry.is_symlink():
+            return normalizar_ruta(entry.path)
+    except OSError:
+        pass
+    return os.path.normcase(os.path.join(dir_norm, entry.name))
+
+
+def asegurar_ruta_norm(conn):
+    """Migración: añade plm_documentos.ruta_norm + índice único y rellena filas antiguas."""
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(plm_documentos)").fetchall()]
+    if 'ruta_norm' not in cols:
+        conn.execute("ALTER TABLE plm_documentos ADD COLUMN ruta_norm TEXT")
+
+    pendientes = conn.execute(
+        "SELECT id, ruta_origen FROM plm_documentos "
+        "WHERE ruta_norm IS NULL AND ruta_origen IS NOT NULL AND ruta_origen != '' ORDER BY id"
+    ).fetchall()
+    if pendientes:
+        usadas = {r[0] for r in conn.execute(
+            "SELECT ruta_norm FROM plm_documentos WHERE ruta_norm IS NOT NULL")}
+        for doc_id, ruta in pendientes:
+            norm = normalizar_ruta(ruta)
+            # Duplicados históricos: se queda el más antiguo, el resto sin ruta_norm
+            if norm in usadas:
+                continue
+            usadas.add(norm)
+            conn.execute("UPDATE plm_documentos SET ruta_norm=? WHERE id=?", (norm, doc_id))
+
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_plm_documentos_ruta_norm "
+                 "ON plm_documentos(ruta_norm)")
+    conn.commit()
+
+
+def buscar_doc_por_ruta(conn, ruta):
+    """Documento registrado para una ruta (cualquier forma de escribirla) o None."""
+    norm = normalizar_ruta(ruta)
+    if not norm:
+        return None
+    return conn.execute("SELECT * FROM plm_documentos WHERE ruta_norm=?", (norm,)).fetchone()
+
+
+def buscar_docs_por_rutas(conn, rutas_norm):
+    """Resuelve de golpe qué rutas (ya normalizadas) están registradas.
+
+    Una sola consulta: la lista viaja como un único parámetro JSON y SQLite la
+    cruza contra el índice de ruta_norm. Devuelve {ruta_norm: row}.
+    """
+    rutas_norm = sorted(set(r for r in rutas_norm if r))
+    if not rutas_norm:
+        return {}
+    rows = conn.execute(
+        "SELECT * FROM plm_documentos WHERE ruta_norm IN (SELECT value FROM json_each(?))",
+        (json.dumps(rutas_norm),)
+    ).fetchall()
+    return {row['ruta_norm']: row for row in rows}
+
+
+# ── HUELLAS DE CONTENIDO ──────────────────────────────────────────────────────
+# El hash "oficial" es BLAKE2b (plm_documentos.hash_b2): más rápido que MD5 en
+# 64 bits. MD5 solo se calcula para comparar con documentos antiguos que aún no
+# tienen hash_b2. plm_hash_cache recuerda el hash de cada ruta junto a su
+# (tamaño, mtime, inode): si el stat no cambió, el archivo no se vuelve a leer.
+
+HASH_BUFFER = 1024 * 1024  # lecturas de 1 MB sobre un buffer reutilizado
+
+
+def _leer_hash(ruta, h):
+    buf = bytearray(HASH_BUFFER)
+    vista = memoryview(buf)
+    with open(ruta, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(vista[:n])
+    return h.hexdigest()
+
+
+def calc_hash(ruta):
+    """BLAKE2b del archivo (sin caché). None si no se puede leer."""
+    try:
+        return _leer_hash(ruta, hashlib.blake2b(digest_size=32))
+    except Exception:
+        return None
+
+
+def calc_hash_md5(ruta):
+    """MD5 del archivo — solo para comparar con hash_md5 heredados."""
+    try:
+        return _leer_hash(ruta, hashlib.md5())
+    except Exception:
+        return None
+
+
+def asegurar_hash_cache(conn):
+    """Migración: tabla de huellas + columnas hash_b2 en documentos y revisiones."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_hash_cache (
+        ruta_norm TEXT PRIMARY KEY,
+        tamano INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        hash_b2 TEXT,
+        hash_md5 TEXT)''')
+    for tabla in ('plm_documentos', 'plm_revisiones'):
+        cols = [r[1] for r in conn.execute(f"PRAGMA table_info({tabla})").fetchall()]
+        if 'hash_b2' not in cols:
+            conn.execute(f"ALTER TABLE {tabla} ADD COLUMN hash_b2 TEXT")
+    conn.commit()
+
+
+def _firma_stat(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def _huella(conn, ruta, campo, calcular, st=None):
+    """Hash (campo 'hash_b2' o 'hash_md5') pasando por plm_hash_cache."""
+    try:
+        st = st or os.stat(ruta)
+    except OSError:
+        return None
+    norm = normalizar_ruta(ruta)
+    firma = _firma_stat(st)
+    row = conn.execute(
+        "SELECT tamano, mtime_ns, inode, hash_b2, hash_md5 FROM plm_hash_cache WHERE ruta_norm=?",
+        (norm,)
+    ).fetchone()
+    vigente = row is not None and tuple(row[:3]) == firma
+    if vigente:
+        guardado = row[3] if campo == 'hash_b2' else row[4]
+        if guardado:
+            return guardado
+
+    valor = calcular(ruta)
+    if valor is None:
+        return None
+    if vigente:
+        conn.execute(f"UPDATE plm_hash_cache SET {campo}=? WHERE ruta_norm=?", (valor, norm))
+    else:
+        conn.execute(
+            f"""INSERT OR REPLACE INTO plm_hash_cache (ruta_norm, tamano, mtime_ns, inode, {campo})
+                VALUES (?,?,?,?,?)""", (norm,) + firma + (valor,))
+    return valor
+
+
+def hash_archivo(conn, ruta, st=None):
+    """BLAKE2b del archivo; solo lo lee si cambió su (tamaño, mtime, inode).
+    Escribe en plm_hash_cache dentro de la transacción del llamador."""
+    return _huella(conn, ruta, 'hash_b2', calc_hash, st)
+
+
+def hash_md5_archivo(conn, ruta, st=None):
+    """MD5 (compatibilidad) con la misma caché."""
+    return _huella(conn, ruta, 'hash_md5', calc_hash_md5, st)
+
+
+def hashes_en_cache(conn, archivos):
+    """{ruta_norm: hash_b2} de [(ruta_norm, stat)] cuyo stat no cambió. Una consulta."""
+    firmas = {norm: _firma_stat(st) for norm, st in archivos}
+    if not firmas:
+        return {}
+    rows = conn.execute(
+        "SELECT ruta_norm, tamano, mtime_ns, inode, hash_b2 FROM plm_hash_cache "
+        "WHERE hash_b2 IS NOT NULL AND ruta_norm IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(firmas)),)
+    ).fetchall()
+    return {r[0]: r[4] for r in rows if tuple(r[1:4]) == firmas[r[0]]}
+
+
+def guardar_hashes(conn, filas):
+    """Guarda en plm_hash_cache una lista [(ruta_norm, stat, hash_b2)]."""
+    conn.executemany(
+        "INSERT OR REPLACE INTO plm_hash_cache (ruta_norm, tamano, mtime_ns, inode, hash_b2) "
+        "VALUES (?,?,?,?,?)",
+        [(norm,) + _firma_stat(st) + (h,) for norm, st, h in filas if h]
+    )
+
+
+def contenido_cambiado(conn, doc, ruta, nuevo_hash):
+    """¿El archivo difiere de lo guardado en el documento?
+
+    Documentos anteriores a BLAKE2 se comparan por MD5 una sola vez; si coinciden
+    se les rellena hash_b2 para no volver a necesitar MD5.
+    """
+    if doc['hash_b2']:
+        return doc['hash_b2'] != nuevo_hash
+    if doc['hash_md5']:
+        if doc['hash_md5'] != hash_md5_archivo(conn, ruta):
+            return True
+        conn.execute("UPDATE plm_documentos SET hash_b2=? WHERE id=?", (nuevo_hash, doc['id']))
+        return False
+    return True
+
+
+# ── SNAPSHOT DE WATCH FOLDERS ─────────────────────────────────────────────────
+# Último estado conocido de cada archivo CAD bajo cada watch folder. Comparar el
+# stat actual con este snapshot dice qué es nuevo, qué cambió, qué se movió y
+# qué desapareció sin tener que leer los archivos que siguen igual.
+
+def asegurar_snapshot(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_wf_snapshot (
+        wf_id INTEGER NOT NULL,
+        ruta_norm TEXT NOT NULL,
+        ruta TEXT NOT NULL,
+        tamano INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        hash_b2 TEXT,
+        PRIMARY KEY (wf_id, ruta_norm))''')
+    conn.commit()
+
+
+def firma_archivo(st):
+    """(tamaño, mtime_ns, inode): si no cambia, el contenido se da por igual."""
+    return _firma_stat(st)
+
+
+def cargar_snapshot(conn, wf_id):
+    """{ruta_norm: row} del snapshot de una watch folder."""
+    return {r['ruta_norm']: r for r in conn.execute(
+        "SELECT * FROM plm_wf_snapshot WHERE wf_id=?", (wf_id,))}
+
+
+def guardar_snapshot(conn, wf_id, archivos):
+    """Actualiza el snapshot de una watch folder con [(ruta_norm, ruta, stat, hash_b2)]."""
+    conn.executemany(
+        '''INSERT OR REPLACE INTO plm_wf_snapshot
+           (wf_id, ruta_norm, ruta, tamano, mtime_ns, inode, hash_b2) VALUES (?,?,?,?,?,?,?)''',
+        [(wf_id, norm, ruta) + _firma_stat(st) + (h,) for norm, ruta, st, h in archivos])
+
+
+# ── AVISOS DE CONFIGURACIÓN ───────────────────────────────────────────────────
+# plm_avisos lleva un contador por tabla que mantienen triggers. El watcher mira
+# PRAGMA data_version (¿alguien ha escrito en la BD?) y solo entonces este
+# contador, en vez de releer plm_watchfolders cada pocos segundos.
+
+TABLAS_AVISO = {'plm_watchfolders': 'ruta, activa, software'}
+
+
+def asegurar_avisos(conn, tablas=TABLAS_AVISO):
+    """Contador y triggers para {tabla: columnas que cuentan como cambio}."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_avisos (
+        tabla TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0)''')
+    for tabla, columnas in tablas.items():
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+                            (tabla,)).fetchone():
+            continue
+        conn.execute("INSERT OR IGNORE INTO plm_avisos (tabla) VALUES (?)", (tabla,))
+        for nombre, evento in (('ins', 'INSERT'), ('upd', f'UPDATE OF {columnas}'), ('del', 'DELETE')):
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{tabla}_aviso_{nombre}
+                AFTER {evento} ON {tabla}
+                BEGIN UPDATE plm_avisos SET version = version + 1 WHERE tabla = '{tabla}'; END''')
+    conn.commit()
+
+
+def version_aviso(conn, tabla):
+    row = conn.execute("SELECT version FROM plm_avisos WHERE tabla=?", (tabla,)).fetchone()
+    return row[0] if row else None
+
+
+# ── VAULT POR CONTENIDO ───────────────────────────────────────────────────────
+# Cada contenido distinto se guarda una sola vez en plm_vault/blobs/ab/cd/<hash_b2>.
+# archivo_vault (documentos y revisiones) guarda la ruta relativa del blob; las
+# copias planas antiguas (PZA-2025-0001_<ts>.sldprt) siguen resolviéndose igual.
+# plm_blob_refs dice qué documentos y revisiones usan cada blob.
+# plm_compactar puede guardar blobs antiguos comprimidos ('zst', 'zlib') o como
+# delta zstd contra otro blob ('delta', base_hash); leer_blob/abrir_blob los
+# devuelven siempre en claro. Si el archivo en claro existe, manda sobre el resto.
+
+VAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plm_vault')
+FICLONE = 0x40049409  # ioctl de reflink (btrfs, XFS, ...)
+
+
+def asegurar_vault(conn):
+    """Migración: tablas de blobs y referencias documento/revisión → blob."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_blobs (
+        hash_b2 TEXT PRIMARY KEY,
+        tamano INTEGER NOT NULL,
+        formato TEXT DEFAULT 'raw',  -- raw | zst | zlib | delta
+        base_hash TEXT,              -- blob contra el que se calculó el delta
+        tamano_disco INTEGER,
+        creado TEXT DEFAULT CURRENT_TIMESTAMP)''')
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(plm_blobs)").fetchall()]
+    for col, tipo in (('formato', "TEXT DEFAULT 'raw'"), ('base_hash', 'TEXT'),
+                      ('tamano_disco', 'INTEGER')):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE plm_blobs ADD COLUMN {col} {tipo}")
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_blob_refs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        hash_b2 TEXT NOT NULL,
+        documento_id INTEGER NOT NULL,
+        revision_id INTEGER,
+        creado TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (hash_b2) REFERENCES plm_blobs(hash_b2),
+        FOREIGN KEY (documento_id) REFERENCES plm_documentos(id),
+        FOREIGN KEY (revision_id) REFERENCES plm_revisiones(id))''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plm_blob_refs_doc ON plm_blob_refs(documento_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plm_blob_refs_hash ON plm_blob_refs(hash_b2)")
+    conn.commit()
+
+
+def blob_relativo(hash_b2):
+    """Ruta del blob relativa a VAULT_DIR (lo que se guarda en archivo_vault)."""
+    return os.path.join('blobs', hash_b2[:2], hash_b2[2:4], hash_b2)
+
+
+def ruta_vault(archivo_vault):
+    """Ruta absoluta de un archivo_vault (blob o copia plana antigua)."""
+    return os.path.join(VAULT_DIR, archivo_vault)
+
+
+def _clonar(origen, destino):
+    """Copia de contenido lo más barata que permita el sistema de archivos:
+    reflink, después copy_file_range (sin pasar por espacio de usuario) y por
+    último copia con buffer."""
+    with open(origen, 'rb') as src, open(destino, 'wb') as dst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError:
+                pass
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30):
+                    pass
+                return
+            except OSError:
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+        shutil.copyfileobj(src, dst, HASH_BUFFER)
+
+
+def guardar_blob(ruta, hash_b2):
+    """Ingresa un archivo en el vault y devuelve su archivo_vault.
+
+    Si el blob ya existe no se copia nada. No se usan hardlinks: el origen es el
+    archivo de trabajo del usuario y el programa CAD puede reescribirlo en sitio.
+    La copia se vuelve a hashear antes de darla por buena: el archivo puede haber
+    cambiado entre el cálculo de hash_b2 y la copia, no solo durante ella.
+    Lanza OSError si el contenido copiado no corresponde a hash_b2.
+    """
+    rel = blob_relativo(hash_b2)
+    destino = ruta_vault(rel)
+    if os.path.exists(destino):
+        return rel
+    carpeta = os.path.dirname(destino)
+    os.makedirs(carpeta, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=carpeta, prefix='.tmp-')
+    os.close(fd)
+    try:
+        _clonar(ruta, tmp)
+        if _leer_hash(tmp, hashlib.blake2b(digest_size=32)) != hash_b2:
+            raise OSError(f"El archivo cambió desde que se calculó su hash: {ruta}")
+        os.replace(tmp, destino)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return rel
+
+
+def referenciar_blob(conn, hash_b2, documento_id, revision_id=None, ruta=None):
+    """Apunta un documento (y opcionalmente una revisión) a un blob del vault.
+
+    Va dentro de la transacción de escritura de la ingesta. plm_compactar solo
+    borra archivos en claro con el bloqueo de escritura tomado y tras volver a
+    mirar la BD, así que lo que aquí se ve en disco sigue ahí hasta el commit; si
+    el blob se compactó o se recogió entre guardar_blob y este punto, se restaura
+    en claro (desde el vault o, si ya no está, copiando de nuevo `ruta`)."""
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    destino = ruta_vault(blob_relativo(hash_b2))
+    if not os.path.exists(destino):
+        _restaurar_blob(conn, hash_b2, ruta)
+    tamano = os.path.getsize(destino)
+    # Un contenido compactado que vuelve a entrar (p. ej. se recupera una versión
+    # antigua) vuelve a ser 'raw': el archivo en claro existe.
+    conn.execute("""INSERT INTO plm_blobs (hash_b2, tamano, tamano_disco) VALUES (?,?,?)
+        ON CONFLICT(hash_b2) DO UPDATE SET formato='raw', base_hash=NULL,
+            tamano_disco=excluded.tamano_disco
+        WHERE formato != 'raw'""", (hash_b2, tamano, tamano))
+    conn.execute("INSERT INTO plm_blob_refs (hash_b2, documento_id, revision_id) VALUES (?,?,?)",
+                 (hash_b2, documento_id, revision_id))
+
+
+def _restaurar_blob(conn, hash_b2, ruta=None):
+    """Vuelve a escribir en claro un blob que ya no lo está."""
+    destino = ruta_vault(blob_relativo(hash_b2))
+    row = conn.execute("SELECT formato FROM plm_blobs WHERE hash_b2=?", (hash_b2,)).fetchone()
+    if row is None or row[0] == 'raw':
+        if ruta is None:
+            raise FileNotFoundError(destino)
+        guardar_blob(ruta, hash_b2)
+        return
+    datos = leer_blob(conn, hash_b2)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(destino), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(datos)
+        os.replace(tmp, destino)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    # Con el claro de vuelta, la copia compactada sobra (leer_blob prefiere el claro)
+    try:
+        os.remove(ruta_blob_guardado(hash_b2, row[0]))
+    except OSError:
+        pass
+
+
+# ── LECTURA DEL VAULT ─────────────────────────────────────────────────────────
+
+SUFIJOS_BLOB = {'zst': '.zst', 'zlib': '.z', 'delta': '.delta'}
+MAX_CADENA_DELTA = 8  # saltos máximos al reconstruir un delta
+
+
+def ruta_blob_guardado(hash_b2, formato):
+    """Archivo físico de un blob según su formato."""
+    return ruta_vault(blob_relativo(hash_b2)) + SUFIJOS_BLOB.get(formato, '')
+
+
+def leer_blob(conn, hash_b2, _saltos=0):
+    """Contenido en claro de un blob, sea cual sea su formato en disco."""
+    crudo = ruta_vault(blob_relativo(hash_b2))
+    if os.path.exists(crudo):
+        with open(crudo, 'rb') as f:
+            return f.read()
+    row = conn.execute("SELECT formato, base_hash FROM plm_blobs WHERE hash_b2=?",
+                       (hash_b2,)).fetchone()
+    if row is None or row[0] == 'raw':
+        raise FileNotFoundError(crudo)
+    formato, base_hash = row[0], row[1]
+    with open(ruta_blob_guardado(hash_b2, formato), 'rb') as f:
+        datos = f.read()
+    if formato == 'zlib':
+        return zlib.decompress(datos)
+    if zstandard is None:
+        raise RuntimeError("El blob está comprimido con zstd: pip install zstandard")
+    if formato == 'zst':
+        return zstandard.ZstdDecompressor().decompress(datos)
+    if _saltos >= MAX_CADENA_DELTA:
+        raise RuntimeError(f"Cadena de deltas demasiado larga en {hash_b2}")
+    base = leer_blob(conn, base_hash, _saltos + 1)
+    dic = zstandard.ZstdCompressionDict(base, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    return zstandard.ZstdDecompressor(dict_data=dic, max_window_size=1 << 31).decompress(datos)
+
+
+def abrir_vault(conn, archivo_vault):
+    """Archivo binario legible de un archivo_vault: el blob en claro se abre
+    directamente; uno compactado se descomprime en memoria."""
+    ruta = ruta_vault(archivo_vault)
+    if os.path.exists(ruta):
+        return open(ruta, 'rb')
+    return io.BytesIO(leer_blob(conn, os.path.basename(archivo_vault)))
+
+
+# ── METADATOS CAD ─────────────────────────────────────────────────────────────
+# Lo que plm_metadatos extrae de cada contenido (cabecera STEP, variables DXF,
+# triángulos, caja y propiedades de masa de STL/OBJ), indexado por hash_b2: cada contenido se analiza
+# una sola vez. Los campos por los que se busca van en columnas; el resto en datos.
+
+def asegurar_metadatos(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_metadatos (
+        hash_b2 TEXT PRIMARY KEY,
+        formato TEXT,
+        autor TEXT,
+        organizacion TEXT,
+        sistema TEXT,          -- sistema de origen (STEP) / versión de AutoCAD (DXF)
+        esquema TEXT,          -- AP203, AP214, AP242...
+        nombre_archivo TEXT,   -- FILE_NAME (STEP) / cabecera (STL)
+        triangulos INTEGER,
+        dim_x REAL, dim_y REAL, dim_z REAL,
+        volumen REAL,          -- mallas: en unidades del archivo al cubo
+        area REAL,
+        datos TEXT,            -- JSON con todo lo extraído
+        error TEXT,
+        creado TEXT DEFAULT CURRENT_TIMESTAMP)''')
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(plm_metadatos)").fetchall()]
+    for col in ('volumen', 'area'):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE plm_metadatos ADD COLUMN {col} REAL")
+    for col in ('autor', 'sistema', 'esquema'):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_plm_metadatos_{col} ON plm_metadatos({col})")
+    conn.commit()
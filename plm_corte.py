@@ -0,0 +1,538 @@
+"""
+PLM Corte — JA · ERP
+Análisis de DXF para corte láser: longitud de corte, contornos, perforaciones y
+aprovechamiento de chapa.
+
+El DXF se lee en streaming (pares código/valor, una entidad en memoria cada vez).
+LINE, ARC, CIRCLE, LWPOLYLINE/POLYLINE (con bulges), ELLIPSE y SPLINE se
+convierten en trazos; los bloques (INSERT) se expanden con su transformación.
+Las longitudes de líneas, arcos y tramos con bulge se calculan en bloque con
+NumPy; elipses y splines se aproximan por muestreo.
+
+    perforaciones = contornos cerrados + cadenas abiertas (cada una exige entrar)
+    aprovechamiento = área neta de las piezas / rectángulo envolvente del corte
+
+Los resultados se guardan por hash_b2 en plm_corte: cada contenido se analiza una
+vez. Los pedidos a proveedor pueden enlazar documentos DXF (plm_pedido_documentos)
+para ver los totales de corte del pedido.
+"""
+
+import json
+import math
+import re
+from datetime import datetime
+
+from plm_core import ruta_vault
+from plm_mallas import NUMPY_OK, np
+
+TOLERANCIA = 0.01          # unidades de dibujo para unir extremos de trazos
+PASO_ARCO = math.radians(5)  # muestreo de arcos para áreas (no afecta a la longitud)
+MUESTRAS_CURVA = 64          # mínimo de puntos por elipse / spline
+MAX_ANIDAMIENTO = 8          # bloques dentro de bloques
+
+# Capas que no se cortan (cotas, textos, grabado...). Se comparan sin mayúsculas.
+CAPAS_NO_CORTE = re.compile(r'^(defpoints|cotas?|dim\w*|text[oa]s?|grabado|marcado|ejes?|ayuda)$', re.I)
+MM_POR_UNIDAD = {1: 25.4, 2: 304.8, 4: 1.0, 5: 10.0, 6: 1000.0}  # $INSUNITS
+
+
+# ── LECTURA ───────────────────────────────────────────────────────────────────
+
+def _pares(f):
+    """(código, valor) de un DXF ASCII, sin cargarlo entero."""
+    while True:
+        codigo, valor = f.readline(), f.readline()
+        if not valor:
+            return
+        try:
+            yield int(codigo), valor.strip()
+        except ValueError:
+            continue
+
+
+def _entidades(ruta):
+    """Genera (sección, tipo, [(código, valor)]) por cada entidad del DXF, más
+    las variables de cabecera como ('HEADER', '$VAR', pares)."""
+    with open(ruta, 'rb') as f:
+        if f.read(18) == b'AutoCAD Binary DXF':
+            raise ValueError("DXF binario no soportado")
+    with open(ruta, 'r', encoding='latin-1', errors='replace') as f:
+        seccion, tipo, pares = None, None, []
+        esperando_nombre = False
+        for codigo, valor in _pares(f):
+            if esperando_nombre:
+                esperando_nombre = False
+                if codigo == 2:
+                    seccion = valor
+                    continue
+            if seccion == 'HEADER':
+                if codigo == 9:
+                    if tipo:
+                        yield seccion, tipo, pares
+                    tipo, pares = valor, []
+                    continue
+                if codigo != 0:
+                    pares.append((codigo, valor))
+                    continue
+            if codigo == 0:
+                if tipo:
+                    yield seccion, tipo, pares
+                tipo, pares = valor, []
+                if valor == 'SECTION':
+                    esperando_nombre, tipo = True, None
+                elif valor in ('ENDSEC', 'EOF'):
+                    seccion, tipo = None, None
+                continue
+            if tipo:
+                pares.append((codigo, valor))
+        if tipo:
+            yield seccion, tipo, pares
+
+
+# ── TRAZOS ────────────────────────────────────────────────────────────────────
+
+class _Dibujo:
+    """Geometría de un espacio (modelo o bloque) antes de expandir INSERTs."""
+
+    def __init__(self, base=(0.0, 0.0)):
+        self.base = base
+        self.lineas = []    # (x0, y0, x1, y1)
+        self.arcos = []     # (cx, cy, r, a0, a1) en grados, antihorario
+        self.circulos = []  # (cx, cy, r)
+        self.polis = []     # (vértices [(x, y)], bulges [b], cerrada)
+        self.curvas = []    # (puntos (k, 2), cerrada) ya muestreadas
+        self.inserts = []   # (bloque, x, y, sx, sy, rot, cols, filas, dcol, dfila)
+        self.tipos = {}
+
+
+def _f(pares, codigo, defecto=0.0):
+    for c, v in pares:
+        if c == codigo:
+            try:
+                return float(v)
+            except ValueError:
+                return defecto
+    return defecto
+
+
+def _i(pares, codigo, defecto=0):
+    return int(_f(pares, codigo, defecto))
+
+
+def _todos(pares, codigo):
+    return [float(v) for c, v in pares if c == codigo]
+
+
+def _curva_elipse(pares):
+    cx, cy = _f(pares, 10), _f(pares, 20)
+    mx, my = _f(pares, 11), _f(pares, 21)
+    ratio = _f(pares, 40, 1.0)
+    t0, t1 = _f(pares, 41, 0.0), _f(pares, 42, 2 * math.pi)
+    if t1 <= t0:
+        t1 += 2 * math.pi
+    cerrada = abs(t1 - t0 - 2 * math.pi) < 1e-6
+    t = np.linspace(t0, t1, max(MUESTRAS_CURVA, int((t1 - t0) / PASO_ARCO) + 1))
+    # eje menor: eje mayor girado 90° y escalado por ratio
+    pts = np.column_stack([cx + mx * np.cos(t) - my * ratio * np.sin(t),
+                           cy + my * np.cos(t) + mx * ratio * np.sin(t)])
+    return pts, cerrada
+
+
+def _curva_spline(pares):
+    """B-spline (racional si trae pesos) evaluada por Cox–de Boor en bloque."""
+    grado = _i(pares, 71, 3)
+    nudos = np.array(_todos(pares, 40))
+    ctrl = np.column_stack([_todos(pares, 10), _todos(pares, 20)]) if _todos(pares, 10) else np.zeros((0, 2))
+    cerrada = bool(_i(pares, 70) & 1)
+    if len(ctrl) <= grado or len(nudos) != len(ctrl) + grado + 1:
+        ajuste = np.column_stack([_todos(pares, 11), _todos(pares, 21)]) if _todos(pares, 11) else ctrl
+        return ajuste, cerrada  # sin nudos válidos: polilínea por los puntos de ajuste
+    pesos = np.array(_todos(pares, 41)) if len(_todos(pares, 41)) == len(ctrl) else np.ones(len(ctrl))
+    u = np.linspace(nudos[grado], nudos[len(ctrl)], max(MUESTRAS_CURVA, 8 * len(ctrl)))
+    u[-1] -= 1e-12 * max(1.0, abs(u[-1]))
+    n_base = len(nudos) - 1
+    base = ((nudos[:-1][None, :] <= u[:, None]) & (u[:, None] < nudos[1:][None, :])).astype(float)
+    for p in range(1, grado + 1):
+        n_base -= 1
+        izq_den = nudos[p:p + n_base] - nudos[:n_base]
+        der_den = nudos[p + 1:p + 1 + n_base] - nudos[1:1 + n_base]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            izq = np.where(izq_den > 0, (u[:, None] - nudos[:n_base]) / izq_den, 0.0)
+            der = np.where(der_den > 0, (nudos[p + 1:p + 1 + n_base] - u[:, None]) / der_den, 0.0)
+        base = izq * base[:, :n_base] + der * base[:, 1:n_base + 1]
+    bw = base * pesos
+    pts = (bw @ ctrl) / bw.sum(axis=1, keepdims=True)
+    return pts, cerrada
+
+
+def _vertices_polilinea(pares):
+    """Vértices y bulges de una LWPOLYLINE (o de los VERTEX de una POLYLINE)."""
+    vertices, bulges = [], []
+    for c, v in pares:
+        if c == 10:
+            vertices.append([float(v), 0.0])
+            bulges.append(0.0)
+        elif c == 20 and vertices:
+            vertices[-1][1] = float(v)
+        elif c == 42 and vertices:
+            bulges[-1] = float(v)
+    return vertices, bulges
+
+
+def leer_dibujo(ruta):
+    """Modelo y bloques de un DXF: ({nombre: _Dibujo}, modelo, variables)."""
+    bloques, modelo, variables = {}, _Dibujo(), {}
+    actual, poli = modelo, None
+    for seccion, tipo, pares in _entidades(ruta):
+        if seccion == 'HEADER':
+            variables[tipo] = pares
+            continue
+        if seccion not in ('ENTITIES', 'BLOCKS'):
+            continue
+        if tipo == 'BLOCK':
+            nombre = next((v for c, v in pares if c == 2), '')
+            actual = bloques.setdefault(nombre, _Dibujo((_f(pares, 10), _f(pares, 20))))
+            continue
+        if tipo == 'ENDBLK':
+            actual = modelo
+            continue
+        if poli is not None:
+            if tipo == 'VERTEX':
+                if not _i(pares, 70) & 16:  # los puntos de control de splines no cuentan
+                    v, b = _vertices_polilinea(pares)
+                    poli[0].extend(v)
+                    poli[1].extend(b)
+                continue
+            poli = None  # SEQEND (u otra entidad): la polilínea ya está en actual.polis
+            if tipo == 'SEQEND':
+                continue
+        if _i(pares, 67) == 1:  # espacio papel
+            continue
+        capa = next((v for c, v in pares if c == 8), '0')
+        if tipo != 'INSERT' and CAPAS_NO_CORTE.match(capa):
+            continue
+        contado = True
+        # Extrusión (0, 0, -1): el sistema de la entidad está espejado en X
+        espejo = -1.0 if _f(pares, 230, 1.0) < 0 else 1.0
+        if tipo == 'LINE':
+            actual.lineas.append((_f(pares, 10), _f(pares, 20), _f(pares, 11), _f(pares, 21)))
+        elif tipo == 'ARC':
+            a0, a1 = _f(pares, 50), _f(pares, 51)
+            if espejo < 0:
+                a0, a1 = 180.0 - a1, 180.0 - a0
+            actual.arcos.append((espejo * _f(pares, 10), _f(pares, 20), _f(pares, 40), a0, a1))
+        elif tipo == 'CIRCLE':
+            actual.circulos.append((espejo * _f(pares, 10), _f(pares, 20), _f(pares, 40)))
+        elif tipo == 'LWPOLYLINE':
+            v, b = _vertices_polilinea(pares)
+            if espejo < 0:
+                v, b = [[-x, y] for x, y in v], [-x for x in b]
+            actual.polis.append((v, b, bool(_i(pares, 70) & 1)))
+        elif tipo == 'POLYLINE':
+            if _i(pares, 70) & (16 | 64):  # mallas poligonales: no son corte
+                contado = False
+            else:
+                poli = ([], [], bool(_i(pares, 70) & 1))
+                actual.polis.append(poli)
+        elif tipo == 'ELLIPSE':
+            actual.curvas.append(_curva_elipse(pares))
+        elif tipo == 'SPLINE':
+            actual.curvas.append(_curva_spline(pares))
+        elif tipo == 'INSERT':
+            actual.inserts.append((
+                next((v for c, v in pares if c == 2), ''), _f(pares, 10), _f(pares, 20),
+                _f(pares, 41, 1.0), _f(pares, 42, 1.0), _f(pares, 50),
+                max(1, _i(pares, 70, 1)), max(1, _i(pares, 71, 1)), _f(pares, 44), _f(pares, 45)))
+        else:
+            contado = False
+        if contado:
+            actual.tipos[tipo] = actual.tipos.get(tipo, 0) + 1
+    return bloques, modelo, variables
+
+
+def _muestrear_arco(cx, cy, r, a0, barrido):
+    n = max(2, int(abs(barrido) / PASO_ARCO) + 1)
+    t = a0 + np.linspace(0.0, barrido, n)
+    return np.column_stack([cx + r * np.cos(t), cy + r * np.sin(t)])
+
+
+def trazos_dibujo(d):
+    """[(puntos (k, 2), longitud, cerrado)] de un _Dibujo sin sus INSERTs."""
+    trazos = []
+    if d.lineas:
+        l = np.array(d.lineas, dtype=float)
+        largos = np.hypot(l[:, 2] - l[:, 0], l[:, 3] - l[:, 1])
+        trazos.extend((fila.reshape(2, 2), largo, False) for fila, largo in zip(l, largos))
+    if d.arcos:
+        a = np.array(d.arcos, dtype=float)
+        barridos = np.radians((a[:, 4] - a[:, 3]) % 360.0)
+        barridos[barridos == 0] = 2 * math.pi
+        largos = a[:, 2] * barridos
+        for (cx, cy, r, a0, _), barrido, largo in zip(a, barridos, largos):
+            trazos.append((_muestrear_arco(cx, cy, r, math.radians(a0), barrido), largo, False))
+    if d.circulos:
+        c = np.array(d.circulos, dtype=float)
+        for (cx, cy, r), largo in zip(c, 2 * math.pi * c[:, 2]):
+            trazos.append((_muestrear_arco(cx, cy, r, 0.0, 2 * math.pi), largo, True))
+    for vertices, bulges, cerrada in d.polis:
+        if len(vertices) < 2:
+            continue
+        trazos.append(_trazo_polilinea(np.array(vertices, dtype=float), np.array(bulges), cerrada))
+    for pts, cerrada in d.curvas:
+        if len(pts) >= 2:
+            trazos.append((pts, float(np.hypot(*np.diff(pts, axis=0).T).sum()), cerrada))
+    return trazos
+
+
+def _trazo_polilinea(p, b, cerrada):
+    """Longitud exacta (arcos por bulge) y puntos muestreados de una polilínea."""
+    if cerrada:
+        q = np.vstack([p[1:], p[:1]])
+    else:
+        q, p, b = p[1:], p[:-1], b[:-1]
+    cuerda = np.hypot(q[:, 0] - p[:, 0], q[:, 1] - p[:, 1])
+    theta = 4 * np.arctan(b)  # ángulo del arco, con signo (bulge > 0: antihorario)
+    media = np.abs(theta) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = np.where(b != 0, media / np.sin(media), 1.0)
+    longitud = float((cuerda * factor).sum())
+
+    if not b.any():
+        pts = np.vstack([p, q[-1:]])
+        return pts, longitud, cerrada
+    partes = []
+    for (x0, y0), (x1, y1), bi, th in zip(p, q, b, theta):
+        if bi == 0:
+            partes.append(np.array([[x0, y0]]))
+            continue
+        k = (1 - bi * bi) / (4 * bi)
+        cx, cy = (x0 + x1) / 2 - (y1 - y0) * k, (y0 + y1) / 2 + (x1 - x0) * k
+        r = math.hypot(x0 - cx, y0 - cy)
+        partes.append(_muestrear_arco(cx, cy, r, math.atan2(y0 - cy, x0 - cx), th)[:-1])
+    partes.append(q[-1:])
+    return np.vstack(partes), longitud, cerrada
+
+
+def expandir(bloques, dibujo, profundidad=0, _hechos=None):
+    """Trazos de un dibujo con sus INSERTs resueltos (recursivo; cada bloque
+    se resuelve una vez y se transforma en cada inserción)."""
+    hechos = {} if _hechos is None else _hechos
+    trazos = trazos_dibujo(dibujo)
+    tipos = dict(dibujo.tipos)
+    if profundidad >= MAX_ANIDAMIENTO:
+        return trazos, tipos
+    for nombre, x, y, sx, sy, rot, cols, filas, dcol, dfila in dibujo.inserts:
+        bloque = bloques.get(nombre)
+        if bloque is None or nombre.lower().startswith('*paper_space'):
+            continue
+        if nombre not in hechos:
+            hechos[nombre] = expandir(bloques, bloque, profundidad + 1, hechos)
+        internos, tipos_b = hechos[nombre]
+        base = np.array(bloque.base)
+        cos_r, sin_r = math.cos(math.radians(rot)), math.sin(math.radians(rot))
+        giro = np.array([[cos_r, sin_r], [-sin_r, cos_r]])  # filas: p @ giro
+        uniforme = abs(abs(sx) - abs(sy)) < 1e-9
+        for i in range(cols):
+            for j in range(filas):
+                desplaz = np.array([i * dcol, j * dfila]) @ giro + (x, y)
+                for pts, largo, cerrado in internos:
+                    nuevos = ((pts - base) * (sx, sy)) @ giro + desplaz
+                    if uniforme:
+                        largo = largo * abs(sx)
+                    else:
+                        largo = float(np.hypot(*np.diff(nuevos, axis=0).T).sum())
+                    trazos.append((nuevos, largo, cerrado))
+                for t, n in tipos_b.items():
+                    tipos[t] = tipos.get(t, 0) + n
+    return trazos, tipos
+
+
+# ── CONTORNOS ─────────────────────────────────────────────────────────────────
+
+def _area(pts):
+    x, y = pts[:, 0], pts[:, 1]
+    return 0.5 * abs(float(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))))
+
+
+def _contiene(poligono, puntos):
+    """Ray casting vectorizado: qué puntos (m, 2) caen dentro del polígono."""
+    x, y = poligono[:, 0], poligono[:, 1]
+    x2, y2 = np.roll(x, -1), np.roll(y, -1)
+    px, py = puntos[:, 0:1], puntos[:, 1:2]
+    cruza = (y > py) != (y2 > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xi = x + (py - y) * (x2 - x) / (y2 - y)
+    return ((cruza & (px < xi)).sum(axis=1) % 2) == 1
+
+
+def contornos(trazos, tolerancia=TOLERANCIA):
+    """Une los trazos abiertos por sus extremos. Devuelve (cerrados, abiertos):
+    polígonos de los contornos cerrados y número de cadenas abiertas."""
+    cerrados = [pts for pts, _, c in trazos if c]
+    abiertos = [pts for pts, _, c in trazos if not c]
+    if not abiertos:
+        return cerrados, 0
+
+    extremos = np.array([[pts[0], pts[-1]] for pts in abiertos])      # (n, 2, 2)
+    claves = np.round(extremos / tolerancia).astype(np.int64).reshape(-1, 2)
+    _, nodo = np.unique(claves, axis=0, return_inverse=True)
+    nodo = nodo.reshape(-1, 2)                                         # nodo inicial/final de cada trazo
+    padre = list(range(int(nodo.max()) + 1))
+
+    def raiz(a):
+        while padre[a] != a:
+            padre[a] = padre[padre[a]]
+            a = padre[a]
+        return a
+
+    for a, b in nodo:
+        padre[raiz(a)] = raiz(b)
+    grado = np.bincount(nodo.ravel(), minlength=len(padre))
+    componentes = {}
+    for i, (a, _) in enumerate(nodo):
+        componentes.setdefault(raiz(a), []).append(i)
+
+    n_abiertos = 0
+    for trazos_c in componentes.values():
+        nodos_c = set(nodo[trazos_c].ravel().tolist())
+        if any(grado[n] != 2 for n in nodos_c):
+            n_abiertos += 1
+            continue
+        # Ciclo simple: se recorre para obtener el polígono ordenado
+        por_nodo = {}
+        for i in trazos_c:
+            for n in nodo[i]:
+                por_nodo.setdefault(int(n), []).append(i)
+        i, actual = trazos_c[0], int(nodo[trazos_c[0]][1])
+        partes, usados = [abiertos[i]], {i}
+        while len(usados) < len(trazos_c):
+            i = next(t for t in por_nodo[actual] if t not in usados)
+            usados.add(i)
+            if int(nodo[i][0]) == actual:
+                partes.append(abiertos[i])
+                actual = int(nodo[i][1])
+            else:
+                partes.append(abiertos[i][::-1])
+                actual = int(nodo[i][0])
+        cerrados.append(np.vstack(partes))
+    return cerrados, n_abiertos
+
+
+def analizar(ruta):
+    """Longitud de corte, contornos, perforaciones y aprovechamiento (en mm)."""
+    if not NUMPY_OK:
+        raise RuntimeError("NumPy no está instalado: pip install numpy")
+    bloques, modelo, variables = leer_dibujo(ruta)
+    trazos, tipos = expandir(bloques, modelo)
+    try:
+        unidades = int(_f(variables.get('$INSUNITS', []), 70, 4))
+    except ValueError:
+        unidades = 4
+    escala = MM_POR_UNIDAD.get(unidades, 1.0)  # sin unidades: se asume mm
+    resultado = {'entidades': tipos, 'unidades': unidades, 'escala_mm': escala,
+                 'longitud_mm': 0.0, 'contornos': 0, 'abiertos': 0, 'perforaciones': 0,
+                 'piezas': 0, 'ancho_mm': 0.0, 'alto_mm': 0.0, 'area_piezas_mm2': 0.0,
+                 'area_chapa_mm2': 0.0, 'aprovechamiento': None}
+    if not trazos:
+        return resultado
+
+    cerrados, n_abiertos = contornos(trazos, TOLERANCIA)
+    todos = np.vstack([pts for pts, _, _ in trazos])
+    minimo, maximo = todos.min(axis=0), todos.max(axis=0)
+    ancho, alto = (maximo - minimo) * escala
+
+    # Nivel de anidamiento de cada contorno: par = pieza (suma), impar = agujero (resta)
+    areas = np.array([_area(c) for c in cerrados])
+    orden = np.argsort(-areas)
+    cajas = np.array([[c[:, 0].min(), c[:, 1].min(), c[:, 0].max(), c[:, 1].max()] for c in cerrados]).reshape(-1, 4)
+    puntos = np.array([c[0] for c in cerrados]).reshape(-1, 2)
+    nivel = np.zeros(len(cerrados), dtype=int)
+    for k, i in enumerate(orden):
+        menores = orden[k + 1:]
+        if not len(menores):
+            break
+        dentro_caja = ((cajas[menores, 0] >= cajas[i, 0]) & (cajas[menores, 2] <= cajas[i, 2]) &
+                       (cajas[menores, 1] >= cajas[i, 1]) & (cajas[menores, 3] <= cajas[i, 3]))
+        candidatos = menores[dentro_caja]
+        if len(candidatos):
+            nivel[candidatos[_contiene(cerrados[i], puntos[candidatos])]] += 1
+    neta = float((areas * np.where(nivel % 2 == 0, 1, -1)).sum()) * escala ** 2
+
+    resultado.update({
+        'longitud_mm': round(float(sum(l for _, l, _ in trazos)) * escala, 2),
+        'contornos': len(cerrados),
+        'abiertos': n_abiertos,
+        'perforaciones': len(cerrados) + n_abiertos,
+        'piezas': int((nivel == 0).sum()),
+        'ancho_mm': round(float(ancho), 2),
+        'alto_mm': round(float(alto), 2),
+        'area_piezas_mm2': round(neta, 2),
+        'area_chapa_mm2': round(float(ancho * alto), 2),
+        'aprovechamiento': round(neta / float(ancho * alto), 4) if ancho * alto > 0 else None,
+    })
+    return resultado
+
+
+# ── CACHÉ Y PEDIDOS ───────────────────────────────────────────────────────────
+
+def asegurar_corte(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_corte (
+        hash_b2 TEXT PRIMARY KEY,
+        longitud_mm REAL,
+        contornos INTEGER,
+        perforaciones INTEGER,
+        aprovechamiento REAL,
+        datos TEXT,                  -- JSON con el análisis completo
+        error TEXT,
+        creado TEXT DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_pedido_documentos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        pedido_id INTEGER NOT NULL,
+        documento_id INTEGER NOT NULL,
+        cantidad INTEGER DEFAULT 1,
+        UNIQUE (pedido_id, documento_id),
+        FOREIGN KEY (pedido_id) REFERENCES pedidos_proveedor(id),
+        FOREIGN KEY (documento_id) REFERENCES plm_documentos(id))''')
+    conn.commit()
+
+
+def es_dxf(doc):
+    return (doc['ruta_origen'] or doc['archivo_vault'] or '').lower().endswith('.dxf')
+
+
+def corte_documento(conn, doc):
+    """Análisis de corte del contenido actual de un documento DXF (o None).
+    Se calcula la primera vez y queda guardado por hash_b2."""
+    if not doc or not es_dxf(doc) or not doc['hash_b2'] or not doc['archivo_vault']:
+        return None
+    row = conn.execute("SELECT datos, error FROM plm_corte WHERE hash_b2=?", (doc['hash_b2'],)).fetchone()
+    if row is not None:
+        return {'error': row['error']} if row['error'] else json.loads(row['datos'])
+    try:
+        datos, error = analizar(ruta_vault(doc['archivo_vault'])), None
+    except (OSError, ValueError, RuntimeError) as e:
+        datos, error = None, str(e)[:300]
+    with conn:
+        conn.execute('''INSERT OR REPLACE INTO plm_corte
+            (hash_b2, longitud_mm, contornos, perforaciones, aprovechamiento, datos, error, creado)
+            VALUES (?,?,?,?,?,?,?,?)''',
+            (doc['hash_b2'], datos and datos['longitud_mm'], datos and datos['contornos'],
+             datos and datos['perforaciones'], datos and datos['aprovechamiento'],
+             json.dumps(datos) if datos else None, error, datetime.now().isoformat()))
+    return datos if datos else {'error': error}
+
+
+def corte_pedido(conn, pedido_id):
+    """Documentos DXF de un pedido con su análisis y los totales por cantidad."""
+    filas = conn.execute('''SELECT pd.id AS enlace_id, pd.cantidad, d.*
+        FROM plm_pedido_documentos pd JOIN plm_documentos d ON d.id = pd.documento_id
+        WHERE pd.pedido_id=? ORDER BY pd.id''', (pedido_id,)).fetchall()
+    lineas, totales = [], {'longitud_mm': 0.0, 'perforaciones': 0, 'piezas': 0}
+    for f in filas:
+        corte = corte_documento(conn, f) or {'error': 'No es un DXF'}
+        lineas.append({'enlace_id': f['enlace_id'], 'documento_id': f['id'], 'codigo': f['codigo'],
+                       'nombre': f['nombre'], 'cantidad': f['cantidad'], 'corte': corte})
+        if not corte.get('error'):
+            totales['longitud_mm'] += corte['longitud_mm'] * f['cantidad']
+            totales['perforaciones'] += corte['perforaciones'] * f['cantidad']
+            totales['piezas'] += corte['piezas'] * f['cantidad']
+    return lineas, totales
@@ -0,0 +1,188 @@
+"""
+PLM Costes — JA · ERP
+Estimación de coste de piezas STL/OBJ para presupuestos de CNC e impresión 3D.
+
+Parte de las propiedades de masa de la malla (plm_mallas.propiedades_masa, ya
+guardadas en plm_metadatos al ingresar el archivo), de la densidad y precio del
+material (plm_materiales) y de las tarifas de cada proveedor (plm_tarifas):
+
+    impresion_3d  material = volumen de la pieza; proceso = volumen impreso
+    cnc           material = bruto (caja + sobremedida); proceso = volumen retirado
+
+    coste = max(mínimo, fijo + cantidad · (material · €/kg + proceso · €/cm³ + área · €/cm²))
+
+Una estimación se puede adjuntar a un presupuesto (plm_estimaciones) y suma su
+precio al importe.
+"""
+
+import json
+from datetime import datetime
+
+from plm_core import ruta_vault
+from plm_mallas import EXT_MALLA
+from plm_metadatos import leer_malla, guardar_metadatos
+
+PROCESOS = {'impresion_3d': 'Impresión 3D', 'cnc': 'Mecanizado CNC'}
+SOBREMEDIDA_MM = 2.0  # por cara, para el bruto de CNC
+UNIDADES_MM = {'mm': 1.0, 'cm': 10.0, 'm': 1000.0, 'in': 25.4}
+PRESUPUESTO_EDITABLE = ('borrador', 'enviado')  # estados en los que se puede adjuntar
+
+MATERIALES_INICIALES = [
+    # nombre, densidad (g/cm³), €/kg, procesos
+    ('PLA', 1.24, 25.0, 'impresion_3d'),
+    ('PETG', 1.27, 28.0, 'impresion_3d'),
+    ('PA12 (SLS)', 1.01, 60.0, 'impresion_3d'),
+    ('Resina estándar (SLA)', 1.18, 90.0, 'impresion_3d'),
+    ('Aluminio 6082', 2.70, 6.5, 'cnc'),
+    ('Acero S275', 7.85, 1.8, 'cnc'),
+    ('Inox 304', 8.00, 5.5, 'cnc'),
+    ('POM', 1.41, 9.0, 'cnc'),
+]
+
+# especialidad del proveedor → (proceso, fijo €, €/cm³, €/cm², mínimo €)
+TARIFAS_INICIALES = {
+    'Impresión 3D': ('impresion_3d', 5.0, 0.12, 0.0, 15.0),
+    'Mecanizado CNC': ('cnc', 45.0, 0.35, 0.02, 60.0),
+}
+
+
+# ── ESQUEMA ───────────────────────────────────────────────────────────────────
+
+def asegurar_costes(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_materiales (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nombre TEXT UNIQUE NOT NULL,
+        densidad REAL NOT NULL,      -- g/cm³
+        precio_kg REAL DEFAULT 0,
+        procesos TEXT,               -- 'impresion_3d,cnc'; NULL = cualquiera
+        activo INTEGER DEFAULT 1)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_tarifas (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        proveedor_id INTEGER NOT NULL,
+        proceso TEXT NOT NULL,       -- impresion_3d | cnc
+        material_id INTEGER,         -- NULL = cualquier material
+        coste_fijo REAL DEFAULT 0,   -- por pedido (preparación, programación)
+        precio_cm3 REAL DEFAULT 0,   -- por cm³ impreso / retirado
+        precio_cm2 REAL DEFAULT 0,   -- por cm² de superficie (acabado)
+        minimo REAL DEFAULT 0,
+        activa INTEGER DEFAULT 1,
+        FOREIGN KEY (proveedor_id) REFERENCES proveedores(id),
+        FOREIGN KEY (material_id) REFERENCES plm_materiales(id))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_estimaciones (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        presupuesto_id INTEGER NOT NULL,
+        documento_id INTEGER NOT NULL,
+        hash_b2 TEXT,
+        tarifa_id INTEGER, material_id INTEGER,
+        cantidad INTEGER DEFAULT 1,
+        coste REAL, margen REAL, precio REAL,
+        detalle TEXT,                -- JSON con el desglose completo
+        creado TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (presupuesto_id) REFERENCES presupuestos(id),
+        FOREIGN KEY (documento_id) REFERENCES plm_documentos(id))''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plm_estimaciones_pres ON plm_estimaciones(presupuesto_id)")
+
+    if conn.execute("SELECT COUNT(*) FROM plm_materiales").fetchone()[0] == 0:
+        conn.executemany("INSERT INTO plm_materiales (nombre, densidad, precio_kg, procesos) VALUES (?,?,?,?)",
+                         MATERIALES_INICIALES)
+    if conn.execute("SELECT COUNT(*) FROM plm_tarifas").fetchone()[0] == 0:
+        for pv in conn.execute("SELECT id, especialidad FROM proveedores WHERE estado='activo'").fetchall():
+            if pv[1] in TARIFAS_INICIALES:
+                conn.execute('''INSERT INTO plm_tarifas
+                    (proveedor_id, proceso, coste_fijo, precio_cm3, precio_cm2, minimo)
+                    VALUES (?,?,?,?,?,?)''', (pv[0], *TARIFAS_INICIALES[pv[1]]))
+    conn.commit()
+
+
+# ── PROPIEDADES ───────────────────────────────────────────────────────────────
+
+def propiedades_documento(conn, doc):
+    """Propiedades de masa del contenido actual de un documento de malla, o None.
+    Salen de plm_metadatos; si la fila es anterior al cálculo de masas, se
+    calculan sobre el blob y se completa la fila."""
+    ext = '.' + (doc['ruta_origen'] or doc['archivo_vault'] or '').rsplit('.', 1)[-1].lower()
+    if ext not in EXT_MALLA or not doc['hash_b2'] or not doc['archivo_vault']:
+        return None
+    row = conn.execute("SELECT datos, volumen FROM plm_metadatos WHERE hash_b2=?",
+                       (doc['hash_b2'],)).fetchone()
+    if row is not None and row['volumen'] is not None:
+        return json.loads(row['datos'])
+    datos = leer_malla(ruta_vault(doc['archivo_vault']), ext)
+    if 'volumen' not in datos:
+        return None
+    with conn:
+        if row is None:
+            guardar_metadatos(conn, [(doc['hash_b2'], datos)])
+        else:
+            conn.execute("UPDATE plm_metadatos SET volumen=?, area=?, datos=? WHERE hash_b2=?",
+                         (datos['volumen'], datos['area'], json.dumps(datos), doc['hash_b2']))
+    return datos
+
+
+# ── ESTIMACIÓN ────────────────────────────────────────────────────────────────
+
+def estimar(props, material, tarifa, cantidad=1, unidades='mm'):
+    """Desglose de coste de una pieza con un material y una tarifa."""
+    f = UNIDADES_MM.get(unidades, 1.0)
+    volumen_cm3 = props['volumen'] * f ** 3 / 1000.0
+    area_cm2 = props['area'] * f ** 2 / 100.0
+    dims = [(b - a) * f for a, b in zip(props['bbox_min'], props['bbox_max'])]
+    bruto_cm3 = 1.0
+    for d in dims:
+        bruto_cm3 *= (d + 2 * SOBREMEDIDA_MM) / 10.0
+
+    if tarifa['proceso'] == 'cnc':
+        material_cm3, proceso_cm3 = bruto_cm3, max(bruto_cm3 - volumen_cm3, 0.0)
+    else:
+        material_cm3, proceso_cm3 = volumen_cm3, volumen_cm3
+    material_kg = material_cm3 * material['densidad'] / 1000.0
+    coste_material = material_kg * material['precio_kg']
+    coste_proceso = proceso_cm3 * tarifa['precio_cm3'] + area_cm2 * tarifa['precio_cm2']
+    coste = max(tarifa['minimo'], tarifa['coste_fijo'] + cantidad * (coste_material + coste_proceso))
+    return {
+        'tarifa_id': tarifa['id'], 'proveedor': tarifa['proveedor'], 'proceso': tarifa['proceso'],
+        'material_id': material['id'], 'material': material['nombre'], 'cantidad': cantidad,
+        'dimensiones_mm': [round(d, 2) for d in dims],
+        'volumen_cm3': round(volumen_cm3, 3), 'area_cm2': round(area_cm2, 2),
+        'peso_kg': round(volumen_cm3 * material['densidad'] / 1000.0, 4),
+        'material_kg': round(material_kg, 4),
+        'coste_material': round(coste_material, 2), 'coste_proceso': round(coste_proceso, 2),
+        'coste_fijo': tarifa['coste_fijo'], 'coste': round(coste, 2),
+    }
+
+
+def tarifas_activas(conn, material):
+    """Tarifas que admiten el material (por id o por proceso compatible)."""
+    return conn.execute('''SELECT t.*, COALESCE(p.empresa, p.nombre) AS proveedor FROM plm_tarifas t
+        JOIN proveedores p ON p.id = t.proveedor_id
+        WHERE t.activa = 1 AND p.estado = 'activo'
+          AND (t.material_id IS NULL OR t.material_id = ?)
+          AND (? IS NULL OR instr(',' || ? || ',', ',' || t.proceso || ',') > 0)''',
+        (material['id'], material['procesos'], material['procesos'])).fetchall()
+
+
+def estimaciones(conn, props, material_id, cantidad=1, unidades='mm'):
+    """Estimación con cada tarifa aplicable al material, de más barata a más cara."""
+    material = conn.execute("SELECT * FROM plm_materiales WHERE id=?", (material_id,)).fetchone()
+    if material is None:
+        raise ValueError("Material no encontrado")
+    return sorted((estimar(props, material, t, cantidad, unidades)
+                   for t in tarifas_activas(conn, material)), key=lambda e: e['coste'])
+
+
+def adjuntar_a_presupuesto(conn, presupuesto_id, doc, estimacion, margen=0.0):
+    """Guarda la estimación en el presupuesto y suma su precio al importe.
+    Escribe dentro de la transacción del llamador; ValueError si el presupuesto
+    ya no está en PRESUPUESTO_EDITABLE."""
+    precio = round(estimacion['coste'] * (1 + margen / 100.0), 2)
+    if not conn.execute(f"""UPDATE presupuestos SET importe = COALESCE(importe, 0) + ?
+            WHERE id=? AND estado IN ({','.join('?' * len(PRESUPUESTO_EDITABLE))})""",
+            (precio, presupuesto_id, *PRESUPUESTO_EDITABLE)).rowcount:
+        raise ValueError("El presupuesto ya no admite cambios")
+    conn.execute('''INSERT INTO plm_estimaciones
+        (presupuesto_id, documento_id, hash_b2, tarifa_id, material_id, cantidad,
+         coste, margen, precio, detalle, creado) VALUES (?,?,?,?,?,?,?,?,?,?,?)''',
+        (presupuesto_id, doc['id'], doc['hash_b2'], estimacion['tarifa_id'],
+         estimacion['material_id'], estimacion['cantidad'], estimacion['coste'], margen, precio,
+         json.dumps(estimacion, ensure_ascii=False), datetime.now().isoformat()))
+    return precio
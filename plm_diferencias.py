@@ -0,0 +1,169 @@
+"""
+PLM Diferencias — JA · ERP
+Comparación de BOM: entre dos BOM, o entre una BOM y una foto suya de cuando se
+aprobó o liberó (plm_bom_fotos, se guarda al pasar a esos estados).
+
+Las líneas se emparejan por pasos, cada uno sobre lo que dejó libre el anterior:
+
+    documento    mismo documento_id
+    codigo       mismo código (sin mayúsculas ni espacios)
+    descripcion  misma descripción normalizada, y si no, la más parecida entre las
+                 que comparten alguna palabra (difflib, mínimo SIMILITUD_MINIMA)
+
+Si una clave se repite, las líneas se emparejan en orden de posición. Los pasos
+exactos son diccionarios (lineales); el parecido solo compara candidatas que
+comparten una palabra poco frecuente, así que en la práctica también lo es.
+"""
+
+import json
+import re
+from collections import Counter, deque
+from difflib import SequenceMatcher
+
+CAMPOS_LINEA = ('id', 'pos', 'codigo', 'descripcion', 'cantidad', 'unidad', 'material',
+                'proveedor', 'notas', 'documento_id', 'bom_hijo_id')
+CAMPOS_COMPARADOS = ('cantidad', 'unidad', 'material', 'proveedor', 'codigo', 'descripcion',
+                     'documento_id')
+ESTADOS_FOTO = ('aprobado', 'liberado')
+SIMILITUD_MINIMA = 0.6
+MAX_CANDIDATAS = 10      # por línea, en el emparejamiento por parecido
+MAX_FRECUENCIA = 50      # palabras más repetidas no sirven para buscar candidatas
+
+_RE_PALABRA = re.compile(r'\w+')
+
+
+# ── FOTOS ─────────────────────────────────────────────────────────────────────
+
+def asegurar_diferencias(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_bom_fotos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bom_id INTEGER NOT NULL,
+        estado TEXT,                 -- estado al que pasó la BOM
+        num_lineas INTEGER,
+        lineas TEXT,                 -- JSON con las líneas tal como estaban
+        creado TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (bom_id) REFERENCES plm_bom(id))''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plm_bom_fotos_bom ON plm_bom_fotos(bom_id)")
+    conn.commit()
+
+
+def lineas_bom(conn, bom_id):
+    return [dict(r) for r in conn.execute(
+        f"SELECT {', '.join(CAMPOS_LINEA)} FROM plm_bom_lineas WHERE bom_id=? ORDER BY pos, id",
+        (bom_id,))]
+
+
+def guardar_foto(conn, bom_id, estado):
+    """Guarda las líneas actuales de la BOM. Escribe dentro de la transacción del llamador."""
+    lineas = lineas_bom(conn, bom_id)
+    return conn.execute(
+        "INSERT INTO plm_bom_fotos (bom_id, estado, num_lineas, lineas) VALUES (?,?,?,?)",
+        (bom_id, estado, len(lineas), json.dumps(lineas, ensure_ascii=False))).lastrowid
+
+
+def lineas_de(conn, ref):
+    """Líneas de 'bom:<id>' o 'foto:<id>', con una descripción de qué son; None si no existe."""
+    tipo, _, ident = (ref or '').partition(':')
+    if not ident.isdigit():
+        return None
+    if tipo == 'bom':
+        b = conn.execute("SELECT id, nombre, estado FROM plm_bom WHERE id=?", (int(ident),)).fetchone()
+        return b and ({'ref': ref, 'nombre': b['nombre'], 'estado': b['estado'], 'fecha': None},
+                      lineas_bom(conn, b['id']))
+    if tipo == 'foto':
+        f = conn.execute('''SELECT f.*, b.nombre FROM plm_bom_fotos f JOIN plm_bom b ON b.id = f.bom_id
+                            WHERE f.id=?''', (int(ident),)).fetchone()
+        return f and ({'ref': ref, 'nombre': f['nombre'], 'estado': f['estado'], 'fecha': f['creado']},
+                      json.loads(f['lineas']))
+    return None
+
+
+# ── EMPAREJAMIENTO ────────────────────────────────────────────────────────────
+
+def _normalizar(texto):
+    return ' '.join(_RE_PALABRA.findall((texto or '').lower()))
+
+
+def _emparejar_exacto(antes, despues, libres_a, libres_d, clave, motivo, pares):
+    """Empareja por una clave exacta las líneas aún libres, en orden de posición."""
+    por_clave = {}
+    for j in libres_d:
+        k = clave(despues[j])
+        if k:
+            por_clave.setdefault(k, deque()).append(j)
+    for i in list(libres_a):
+        cola = por_clave.get(clave(antes[i]) or None)
+        if cola:
+            j = cola.popleft()
+            pares.append((i, j, motivo))
+            del libres_a[i], libres_d[j]
+
+
+def _emparejar_parecido(antes, despues, libres_a, libres_d, pares):
+    """Descripciones parecidas entre las líneas libres: candidatas por palabras
+    compartidas (las poco frecuentes) y el mejor parecido primero."""
+    indice = {}
+    for j in libres_d:
+        for p in set(_normalizar(despues[j]['descripcion']).split()):
+            indice.setdefault(p, []).append(j)
+    textos_d = {j: _normalizar(despues[j]['descripcion']) for j in libres_d}
+    candidatos, sm = [], SequenceMatcher(autojunk=False)
+    for i in libres_a:
+        texto = _normalizar(antes[i]['descripcion'])
+        comunes = Counter()
+        for p in set(texto.split()):
+            lista = indice.get(p, ())
+            if len(lista) <= MAX_FRECUENCIA:
+                comunes.update(lista)
+        sm.set_seq2(texto)  # SequenceMatcher guarda lo que calcula de seq2
+        for j, _ in comunes.most_common(MAX_CANDIDATAS):
+            sm.set_seq1(textos_d[j])
+            if sm.real_quick_ratio() < SIMILITUD_MINIMA or sm.quick_ratio() < SIMILITUD_MINIMA:
+                continue  # cotas superiores baratas de ratio()
+            r = sm.ratio()
+            if r >= SIMILITUD_MINIMA:
+                candidatos.append((r, i, j))
+    for r, i, j in sorted(candidatos, reverse=True):
+        if i in libres_a and j in libres_d:
+            pares.append((i, j, 'descripcion'))
+            del libres_a[i], libres_d[j]
+
+
+def comparar(antes, despues):
+    """Diferencias entre dos listas de líneas (antes → después): nuevas, eliminadas,
+    modificadas (con los campos que cambian) y cuántas siguen iguales."""
+    libres_a, libres_d = dict.fromkeys(range(len(antes))), dict.fromkeys(range(len(despues)))
+    pares = []
+    _emparejar_exacto(antes, despues, libres_a, libres_d,
+                      lambda l: l['documento_id'], 'documento', pares)
+    _emparejar_exacto(antes, despues, libres_a, libres_d,
+                      lambda l: (l['codigo'] or '').strip().lower(), 'codigo', pares)
+    _emparejar_exacto(antes, despues, libres_a, libres_d,
+                      lambda l: _normalizar(l['descripcion']), 'descripcion', pares)
+    if libres_a and libres_d:
+        _emparejar_parecido(antes, despues, libres_a, libres_d, pares)
+
+    modificadas, iguales = [], 0
+    for i, j, motivo in sorted(pares, key=lambda p: p[1]):
+        a, d = antes[i], despues[j]
+        cambios = {c: [a.get(c), d.get(c)] for c in CAMPOS_COMPARADOS
+                   if (a.get(c) or None) != (d.get(c) or None)}
+        if cambios:
+            modificadas.append({'antes': a, 'despues': d, 'emparejada_por': motivo,
+                                'cambios': cambios})
+        else:
+            iguales += 1
+    return {
+        'nuevas': [despues[j] for j in libres_d],
+        'eliminadas': [antes[i] for i in libres_a],
+        'modificadas': modificadas,
+        'iguales': iguales,
+    }
+
+
+def diferencias(conn, ref_antes, ref_despues):
+    """comparar() entre dos referencias ('bom:<id>' / 'foto:<id>'); None si falta alguna."""
+    a, d = lineas_de(conn, ref_antes), lineas_de(conn, ref_despues)
+    if a is None or d is None:
+        return None
+    return {'antes': a[0], 'despues': d[0], **comparar(a[1], d[1])}
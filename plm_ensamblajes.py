@@ -0,0 +1,232 @@
+"""
+PLM Ensamblajes — JA · ERP
+Estructura de ensamblajes STEP → BOM multinivel.
+
+El archivo se recorre por bloques (memoria constante, sea cual sea su tamaño) y
+solo se decodifican las entidades de producto; la geometría se salta sin parsear:
+
+    PRODUCT                          código (id), nombre y descripción de cada pieza
+    PRODUCT_DEFINITION_FORMATION     → PRODUCT
+    PRODUCT_DEFINITION               → PRODUCT_DEFINITION_FORMATION
+    NEXT_ASSEMBLY_USAGE_OCCURRENCE   definición padre → definición hija, una por instancia
+
+La cantidad de cada hijo es el número de ocurrencias bajo el mismo padre. Cada
+ensamblaje del árbol genera una BOM (plm_bom.origen = 'step:<documento>:<código>')
+y las líneas de subensamblajes apuntan a su BOM hija (plm_bom_lineas.bom_hijo_id).
+Las líneas se vinculan a plm_documentos por código, nombre de archivo o nombre.
+"""
+
+import os
+import re
+from collections import Counter
+
+from plm_core import ruta_vault
+from plm_metadatos import parametros_step
+
+BLOQUE = 4 * 1024 * 1024
+COLA = 256                  # bytes que pasan al bloque siguiente (cabecera de entidad partida)
+MAX_ENTIDAD = 1024 * 1024   # una entidad de producto más larga se da por corrupta
+EXT_STEP = ('.step', '.stp')
+MAX_SIN_VINCULAR = 50       # productos sin documento que se listan en el resultado
+
+_RE_ENTIDAD = re.compile(
+    rb'#(\d+)\s*=\s*(PRODUCT|PRODUCT_DEFINITION_FORMATION(?:_WITH_SPECIFIED_SOURCE)?|'
+    rb'PRODUCT_DEFINITION(?:_WITH_ASSOCIATED_DOCUMENTS)?|NEXT_ASSEMBLY_USAGE_OCCURRENCE)\s*\(')
+_RE_CUERPO = re.compile(rb"(?:[^';]|'[^']*')*;")  # hasta el ';' que no está dentro de una cadena
+
+
+# ── LECTURA ───────────────────────────────────────────────────────────────────
+
+def _ref(v):
+    """'#123' → 123."""
+    return int(v[1:]) if isinstance(v, str) and v[:1] == '#' and v[1:].isdigit() else None
+
+
+def leer_estructura(ruta, observador=None):
+    """Productos y relaciones de ensamblaje de un STEP, leído por bloques.
+
+    Devuelve {'productos': {id: {codigo, nombre, descripcion}},
+              'hijos': {id_padre: Counter(id_hijo → cantidad)}, 'raices': [id...]}
+    con los ids de entidad PRODUCT, en el orden del archivo."""
+    productos, formaciones, definiciones, usos = {}, {}, {}, Counter()
+    total, leidos, resto = os.path.getsize(ruta), 0, b''
+    with open(ruta, 'rb') as f:
+        while True:
+            bloque = f.read(BLOQUE)
+            if not bloque:
+                break
+            leidos += len(bloque)
+            buf, pos, resto = resto + bloque, 0, None
+            for m in _RE_ENTIDAD.finditer(buf):
+                if m.start() < pos:
+                    continue  # dentro de una cadena de la entidad anterior
+                fin = _RE_CUERPO.match(buf, m.end())
+                if fin is None:  # la entidad sigue en el bloque siguiente
+                    resto = buf[m.start():]
+                    if len(resto) > MAX_ENTIDAD:
+                        raise ValueError(f"Entidad STEP #{int(m.group(1))} sin terminar")
+                    break
+                pos = fin.end()
+                p, _ = parametros_step(buf[m.end() - 1:pos - 1].decode('latin-1'))
+                p += [None] * 5
+                ident, tipo = int(m.group(1)), m.group(2)
+                if tipo == b'PRODUCT':
+                    productos[ident] = {'codigo': p[0], 'nombre': p[1], 'descripcion': p[2]}
+                elif tipo.startswith(b'PRODUCT_DEFINITION_FORMATION'):
+                    formaciones[ident] = _ref(p[2])
+                elif tipo.startswith(b'PRODUCT_DEFINITION'):
+                    definiciones[ident] = _ref(p[2])
+                else:
+                    usos[_ref(p[3]), _ref(p[4])] += 1
+            if resto is None:
+                resto = buf[max(pos, len(buf) - COLA):]
+            if observador:
+                observador({'estado': 'leyendo', 'leidos': leidos, 'total': total,
+                            'productos': len(productos), 'ocurrencias': sum(usos.values())})
+
+    def producto(definicion):
+        p = formaciones.get(definiciones.get(definicion))
+        return p if p in productos else None
+
+    hijos = {}
+    for (padre, hijo), n in usos.items():
+        pp, ph = producto(padre), producto(hijo)
+        if pp is not None and ph is not None:
+            hijos.setdefault(pp, Counter())[ph] += n
+    usados = {h for c in hijos.values() for h in c}
+    return {'productos': productos, 'hijos': hijos,
+            'raices': [p for p in hijos if p not in usados]}
+
+
+# ── ESQUEMA ───────────────────────────────────────────────────────────────────
+
+def asegurar_ensamblajes(conn):
+    """Migración: BOMs ligadas a su documento y líneas que apuntan a una BOM hija."""
+    for tabla, col, tipo in (('plm_bom', 'documento_id', 'INTEGER'),     # ensamblaje que describe
+                             ('plm_bom', 'origen', 'TEXT'),              # 'step:<doc>:<código>' si se importó
+                             ('plm_bom_lineas', 'bom_hijo_id', 'INTEGER')):  # BOM del subensamblaje
+        cols = [r[1] for r in conn.execute(f"PRAGMA table_info({tabla})").fetchall()]
+        if col not in cols:
+            conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {col} {tipo}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plm_bom_documento ON plm_bom(documento_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plm_bom_origen ON plm_bom(origen)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plm_bom_lineas_bom ON plm_bom_lineas(bom_id, pos)")
+    conn.commit()
+
+
+# ── IMPORTACIÓN ───────────────────────────────────────────────────────────────
+
+def es_step(doc):
+    return (doc['ruta_origen'] or doc['archivo_vault'] or '').lower().endswith(EXT_STEP)
+
+
+def _nombre_archivo(ruta):
+    return (ruta or '').replace('\\', '/').rsplit('/', 1)[-1]
+
+
+def indice_documentos(conn):
+    """Clave en minúsculas → documento. Prioridad: código, nombre de archivo sin
+    extensión y nombre; a igualdad, piezas y ensamblajes antes que planos."""
+    docs = conn.execute('''SELECT id, codigo, nombre, ruta_origen FROM plm_documentos
+                           ORDER BY tipo = 'plano', id''').fetchall()
+    indice = {}
+    for clave in (lambda d: d['codigo'],
+                  lambda d: os.path.splitext(_nombre_archivo(d['ruta_origen']))[0],
+                  lambda d: d['nombre']):
+        for d in docs:
+            valor = clave(d)
+            if valor:
+                indice.setdefault(valor.strip().lower(), d)
+    return indice
+
+
+def _vincular(indice, producto):
+    """Documento que corresponde a un producto STEP (o None)."""
+    for texto in (producto['codigo'], producto['nombre']):
+        if texto:
+            t = texto.strip().lower()
+            d = indice.get(t) or indice.get(os.path.splitext(t)[0])
+            if d:
+                return d
+    return None
+
+
+def importar_bom(conn, doc, observador=None):
+    """Genera las BOM de un documento STEP de ensamblaje, una por ensamblaje del árbol.
+    Al reimportar se reescriben las que siguen en borrador; las que ya pasaron de
+    borrador se conservan y se crea una nueva."""
+    if not doc or not es_step(doc) or not doc['archivo_vault']:
+        raise ValueError("El documento no es un STEP del vault")
+    est = leer_estructura(ruta_vault(doc['archivo_vault']), observador)
+    productos, hijos, raices = est['productos'], est['hijos'], est['raices']
+    if not hijos:
+        raise ValueError("El STEP no contiene ensamblajes (NEXT_ASSEMBLY_USAGE_OCCURRENCE)")
+    if not raices:
+        raise ValueError("La estructura de ensamblaje del STEP es cíclica")
+    if observador:
+        observador({'estado': 'importando', 'productos': len(productos), 'ensamblajes': len(hijos)})
+
+    indice = indice_documentos(conn)
+    vinculos = {p: _vincular(indice, productos[p]) for p in productos}
+
+    # ensamblajes en profundidad desde las raíces: la BOM padre antes que sus hijas
+    orden, vistos, pila = [], set(), list(reversed(raices))
+    while pila:
+        p = pila.pop()
+        if p in vistos or p not in hijos:
+            continue
+        vistos.add(p)
+        orden.append(p)
+        pila.extend(reversed([h for h in hijos[p] if h not in vistos]))
+
+    descripcion = f"Importada de {_nombre_archivo(doc['ruta_origen']) or doc['codigo']}"
+    boms, por_origen, filas = {}, {}, []
+    with conn:
+        for p in orden:
+            prod = productos[p]
+            origen = f"step:{doc['id']}:{prod['codigo'] or prod['nombre'] or p}"
+            if origen in por_origen:  # mismo número de pieza repetido en el árbol
+                boms[p] = por_origen[origen]
+                continue
+            documento = doc if len(raices) == 1 and p == raices[0] else vinculos[p]
+            valores = (prod['nombre'] or prod['codigo'] or f'#{p}', descripcion,
+                       documento['id'] if documento else None)
+            row = conn.execute('''SELECT id FROM plm_bom WHERE origen=? AND estado='borrador'
+                                  ORDER BY id DESC LIMIT 1''', (origen,)).fetchone()
+            if row:
+                bom_id = row['id']
+                conn.execute('''UPDATE plm_bom SET nombre=?, descripcion=?, documento_id=?,
+                                proyecto_id=COALESCE(proyecto_id, ?) WHERE id=?''',
+                             (*valores, doc['proyecto_id'], bom_id))
+                conn.execute("DELETE FROM plm_bom_lineas WHERE bom_id=?", (bom_id,))
+            else:
+                bom_id = conn.execute('''INSERT INTO plm_bom
+                    (nombre, descripcion, documento_id, proyecto_id, origen) VALUES (?,?,?,?,?)''',
+                    (*valores, doc['proyecto_id'], origen)).lastrowid
+            boms[p] = por_origen[origen] = bom_id
+
+        escritas = set()
+        for p in orden:
+            if boms[p] in escritas:
+                continue
+            escritas.add(boms[p])
+            for n, (h, cantidad) in enumerate(hijos[p].items(), 1):
+                prod, d = productos[h], vinculos[h]
+                filas.append((boms[p], d['id'] if d else None, n * 10, prod['codigo'],
+                              prod['nombre'] or prod['codigo'] or f'#{h}', cantidad, 'ud',
+                              boms.get(h)))
+        conn.executemany('''INSERT INTO plm_bom_lineas
+            (bom_id, documento_id, pos, codigo, descripcion, cantidad, unidad, bom_hijo_id)
+            VALUES (?,?,?,?,?,?,?,?)''', filas)
+
+    sin_vincular = sorted({productos[h]['codigo'] or productos[h]['nombre'] or f'#{h}'
+                           for c in hijos.values() for h in c if vinculos[h] is None})
+    return {
+        'bom_id': boms[raices[0]],
+        'boms': len(por_origen),
+        'lineas': len(filas),
+        'vinculadas': sum(1 for f in filas if f[1] is not None),
+        'productos': len(productos),
+        'sin_vincular': sin_vincular[:MAX_SIN_VINCULAR],
+        'total_sin_vincular': len(sin_vincular),
+    }
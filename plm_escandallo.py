@@ -0,0 +1,232 @@
+"""
+PLM Escandallo — JA · ERP
+Coste y peso de una BOM completa (todos sus niveles), con subtotales por
+subensamblaje y por proveedor.
+
+Parte de la explosión de plm_explosion y busca, por componente, un precio y un
+peso unitarios. El precio sale, por orden:
+
+    tabla     plm_precios, por documento o por código (lo que se fija a mano)
+    pedido    último pedido a proveedor no cancelado que enlaza el documento
+              (plm_pedido_documentos): importe / unidades enlazadas al pedido
+    material  peso · €/kg del material de la línea (plm_materiales)
+
+y el peso, de plm_precios, de la masa de la malla (volumen de plm_metadatos, en mm³,
+por la densidad del material) o de la propia cantidad si la unidad es kg. Los
+subensamblajes solo suman su precio de tabla (montaje) a lo de sus hijos.
+
+Todo se calcula en una pasada con NumPy sobre las filas de la explosión: como van
+en profundidad, cada subárbol es un tramo contiguo y su subtotal sale de la suma
+acumulada.
+"""
+
+import json
+
+from plm_explosion import explosion
+from plm_mallas import NUMPY_OK, np
+
+SIN_PROVEEDOR = 'Sin proveedor'
+
+
+# ── ESQUEMA ───────────────────────────────────────────────────────────────────
+
+def asegurar_escandallo(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_precios (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        clave TEXT UNIQUE NOT NULL,  -- 'doc:<documento_id>' | 'cod:<código en minúsculas>'
+        precio REAL,                 -- € por unidad de la línea
+        peso_kg REAL,                -- kg por unidad de la línea
+        actualizado TEXT DEFAULT CURRENT_TIMESTAMP)''')
+    conn.commit()
+
+
+def clave_componente(documento_id=None, codigo=None):
+    if documento_id:
+        return f'doc:{int(documento_id)}'
+    codigo = (codigo or '').strip().lower()
+    return f'cod:{codigo}' if codigo else None
+
+
+def guardar_precio(conn, clave, precio=None, peso_kg=None):
+    """Fija (o borra, con ambos None) el precio y peso unitarios de un componente.
+    Escribe dentro de la transacción del llamador."""
+    if precio is None and peso_kg is None:
+        conn.execute("DELETE FROM plm_precios WHERE clave=?", (clave,))
+        return
+    conn.execute('''INSERT INTO plm_precios (clave, precio, peso_kg) VALUES (?,?,?)
+        ON CONFLICT(clave) DO UPDATE SET precio=excluded.precio, peso_kg=excluded.peso_kg,
+                                         actualizado=CURRENT_TIMESTAMP''',
+                 (clave, precio, peso_kg))
+
+
+# ── DATOS DE COMPONENTES ──────────────────────────────────────────────────────
+
+def _precios_tabla(conn, claves):
+    return {r['clave']: r for r in conn.execute(
+        "SELECT clave, precio, peso_kg FROM plm_precios WHERE clave IN (SELECT value FROM json_each(?))",
+        (json.dumps(claves),))}
+
+
+def _precios_pedidos(conn, doc_ids):
+    """documento_id → (precio unitario, proveedor, número de pedido) del último pedido."""
+    res = {}
+    for r in conn.execute('''SELECT pd.documento_id, p.numero, p.importe,
+               COALESCE(pv.empresa, pv.nombre) AS proveedor,
+               (SELECT SUM(cantidad) FROM plm_pedido_documentos WHERE pedido_id = p.id) AS unidades
+        FROM plm_pedido_documentos pd
+        JOIN pedidos_proveedor p ON p.id = pd.pedido_id
+        LEFT JOIN proveedores pv ON pv.id = p.proveedor_id
+        WHERE pd.documento_id IN (SELECT value FROM json_each(?))
+          AND p.estado != 'cancelado' AND p.importe > 0
+        ORDER BY p.fecha_pedido, p.id''', (json.dumps(doc_ids),)):
+        if r['unidades']:
+            res[r['documento_id']] = (r['importe'] / r['unidades'], r['proveedor'], r['numero'])
+    return res
+
+
+def _volumenes(conn, doc_ids):
+    """documento_id → volumen (mm³) de su contenido actual, si es una malla."""
+    return {r[0]: r[1] for r in conn.execute('''SELECT d.id, m.volumen FROM plm_documentos d
+        JOIN plm_metadatos m ON m.hash_b2 = d.hash_b2
+        WHERE d.id IN (SELECT value FROM json_each(?)) AND m.volumen > 0''', (json.dumps(doc_ids),))}
+
+
+def _materiales(conn):
+    return [dict(r) for r in conn.execute(
+        "SELECT id, nombre, densidad, precio_kg FROM plm_materiales WHERE activo=1")]
+
+
+def buscar_material(materiales, texto):
+    """Material de plm_materiales que corresponde al texto libre de una línea:
+    igual, o uno empieza por el otro ('Aluminio' → 'Aluminio 6082')."""
+    t = (texto or '').strip().lower()
+    if not t:
+        return None
+    for m in materiales:
+        if m['nombre'].lower() == t:
+            return m
+    return next((m for m in materiales
+                 if m['nombre'].lower().startswith(t) or t.startswith(m['nombre'].lower())), None)
+
+
+# ── CÁLCULO ───────────────────────────────────────────────────────────────────
+
+def escandallo(conn, bom_id):
+    """Coste y peso de la BOM completa: totales, por proveedor, por componente y por
+    fila de la explosión (subtotal de su subárbol)."""
+    if not NUMPY_OK:
+        raise RuntimeError("NumPy no está instalado: pip install numpy")
+    exp = explosion(conn, bom_id)
+    filas = exp['filas']
+    n = len(filas)
+
+    # componentes distintos (mismo documento o mismo código) y sus datos unitarios
+    claves, comp_idx = {}, np.empty(n, dtype=np.int64)
+    for i, f in enumerate(filas):
+        clave = clave_componente(f['documento_id'], f['codigo']) or f"des:{f['descripcion'].lower()}"
+        comp_idx[i] = claves.setdefault(clave, len(claves))
+    comps = [None] * len(claves)
+    for i, f in enumerate(filas):
+        if comps[comp_idx[i]] is None:
+            comps[comp_idx[i]] = f
+    lista_claves = list(claves)
+    doc_ids = sorted({f['documento_id'] for f in comps if f['documento_id']})
+    tabla = _precios_tabla(conn, lista_claves + [clave_componente(None, f['codigo'])
+                                                 for f in comps if f['codigo']])
+    pedidos = _precios_pedidos(conn, doc_ids)
+    volumenes = _volumenes(conn, doc_ids)
+    materiales = _materiales(conn)
+
+    k = len(comps)
+    precio_c, precio_montaje = np.full(k, np.nan), np.full(k, np.nan)
+    peso_c = np.full(k, np.nan)
+    fuente_precio, fuente_peso, proveedor_c = [None] * k, [None] * k, [None] * k
+    for c, (clave, f) in enumerate(zip(lista_claves, comps)):
+        t = tabla.get(clave) or tabla.get(clave_componente(None, f['codigo']))
+        material = buscar_material(materiales, f['material'])
+        if t is not None and t['peso_kg'] is not None:
+            peso_c[c], fuente_peso[c] = t['peso_kg'], 'tabla'
+        elif material and f['documento_id'] in volumenes:
+            peso_c[c] = volumenes[f['documento_id']] / 1000.0 * material['densidad'] / 1000.0
+            fuente_peso[c] = 'malla'
+        elif (f['unidad'] or '').lower() == 'kg':
+            peso_c[c], fuente_peso[c] = 1.0, 'unidad'
+        if t is not None and t['precio'] is not None:
+            precio_c[c] = precio_montaje[c] = t['precio']
+            fuente_precio[c] = 'tabla'
+        elif f['documento_id'] in pedidos:
+            precio_c[c], proveedor_c[c], numero = pedidos[f['documento_id']]
+            fuente_precio[c] = f'pedido {numero}'
+        elif material and material['precio_kg'] and not np.isnan(peso_c[c]):
+            precio_c[c] = peso_c[c] * material['precio_kg']
+            fuente_precio[c] = 'material'
+
+    # filas: hoja si la siguiente no cuelga de ella; subárbol = [i, fin[i])
+    nivel = np.fromiter((f['nivel'] for f in filas), dtype=np.int64, count=n)
+    cantidad = np.fromiter((f['cantidad_total'] or 0 for f in filas), dtype=np.float64, count=n)
+    hoja = np.ones(n, dtype=bool)
+    hoja[:-1] = nivel[1:] <= nivel[:-1]
+    fin, pila = np.full(n, n, dtype=np.int64), []
+    for i, nv in enumerate(nivel.tolist()):
+        while pila and nivel[pila[-1]] >= nv:
+            fin[pila.pop()] = i
+        pila.append(i)
+
+    precio = np.where(hoja, precio_c[comp_idx], precio_montaje[comp_idx])
+    coste = np.nan_to_num(cantidad * precio)
+    peso = np.where(hoja, np.nan_to_num(cantidad * peso_c[comp_idx]), 0.0)
+    acum_coste = np.concatenate(([0.0], np.cumsum(coste)))
+    acum_peso = np.concatenate(([0.0], np.cumsum(peso)))
+    inicio = np.arange(n)
+    coste_sub = acum_coste[fin] - acum_coste[inicio]
+    peso_sub = acum_peso[fin] - acum_peso[inicio]
+
+    # proveedor de cada fila: el de la línea, o el del pedido del que sale el precio
+    nombres_prov, prov_idx = {}, np.empty(n, dtype=np.int64)
+    for i, f in enumerate(filas):
+        nombre = (f['proveedor'] or '').strip() or proveedor_c[comp_idx[i]] or SIN_PROVEEDOR
+        prov_idx[i] = nombres_prov.setdefault(nombre, len(nombres_prov))
+    p = len(nombres_prov)
+    coste_prov = np.bincount(prov_idx, weights=coste, minlength=p)
+    peso_prov = np.bincount(prov_idx, weights=peso, minlength=p)
+    lineas_prov = np.bincount(prov_idx[hoja], minlength=p)
+
+    cant_comp = np.bincount(comp_idx[hoja], weights=cantidad[hoja], minlength=k)
+    coste_comp = np.bincount(comp_idx, weights=coste, minlength=k)
+    peso_comp = np.bincount(comp_idx, weights=peso, minlength=k)
+    es_hoja_comp = np.bincount(comp_idx[hoja], minlength=k) > 0
+
+    def num(v, dec=4):
+        return None if np.isnan(v) else round(float(v), dec)
+
+    componentes = [{
+        'clave': lista_claves[c], 'documento_id': f['documento_id'], 'doc_codigo': f['doc_codigo'],
+        'codigo': f['codigo'], 'descripcion': f['descripcion'], 'unidad': f['unidad'],
+        'material': f['material'], 'proveedor': (f['proveedor'] or '').strip() or proveedor_c[c],
+        'cantidad_total': round(float(cant_comp[c]), 4),
+        'precio_unitario': num(precio_c[c]), 'fuente_precio': fuente_precio[c],
+        'peso_unitario_kg': num(peso_c[c], 6), 'fuente_peso': fuente_peso[c],
+        'coste': round(float(coste_comp[c]), 2), 'peso_kg': round(float(peso_comp[c]), 4),
+    } for c, f in enumerate(comps) if es_hoja_comp[c]]
+    componentes.sort(key=lambda c: -c['coste'])
+
+    return {
+        'bom_id': bom_id,
+        'total': {
+            'coste': round(float(coste.sum()), 2),
+            'peso_kg': round(float(peso.sum()), 4),
+            'componentes': len(componentes),
+            'sin_precio': sum(1 for c in componentes if c['fuente_precio'] is None),
+            'sin_peso': sum(1 for c in componentes if c['fuente_peso'] is None),
+        },
+        'proveedores': sorted(({'proveedor': nombre, 'coste': round(float(coste_prov[i]), 2),
+                                'peso_kg': round(float(peso_prov[i]), 4),
+                                'lineas': int(lineas_prov[i])}
+                               for nombre, i in nombres_prov.items() if lineas_prov[i] or coste_prov[i]),
+                              key=lambda r: -r['coste']),
+        'componentes': componentes,
+        'filas': [{'linea_id': f['id'], 'coste': round(float(coste_sub[i]), 2),
+                   'peso_kg': round(float(peso_sub[i]), 4)} for i, f in enumerate(filas)],
+        'ciclos': exp['ciclos'],
+        'truncada': exp['truncada'],
+    }
@@ -8,10 +8,23 @@ import sys
 import json
 import subprocess
 import sqlite3
-import hashlib
-import shutil
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-from flask import Blueprint, render_template, request, jsonify, send_file
+from urllib.parse import quote
+from flask import (Blueprint, render_template, request, jsonify, send_file,
+                   Response, stream_with_context, redirect, url_for, abort)
+from plm_core import (normalizar_ruta, normalizar_en_directorio,
+                      buscar_doc_por_ruta, buscar_docs_por_rutas, hash_archivo,
+                      guardar_blob, referenciar_blob, ruta_vault, blob_relativo)
+from plm_mallas import NUMPY_OK, EXT_MALLA
+from plm_metadatos import EXTRACTORES, extraer, hashes_sin_metadatos, guardar_metadatos
+from plm_auditoria import registrar_db
+from plm_miniaturas import ruta_miniatura, fallo_miniatura, solicitar as solicitar_miniatura
+from plm_indice import buscar_archivos, resumen as resumen_indice, pendientes as indice_pendientes
+from trabajos import encolar
 
 plm_explorer = Blueprint('plm_explorer', __name__)
 
@@ -61,27 +74,193 @@ def get_db():
     return conn
 
 
-def calc_hash(filepath):
-    try:
-        h = hashlib.md5()
-        with open(filepath, 'rb') as f:
-            for chunk in iter(lambda: f.read(8192), b''):
-                h.update(chunk)
-        return h.hexdigest()
-    except Exception:
-        return None
-
-
 def get_doc_info(filepath):
     """Busca si el archivo ya está registrado en PLM."""
     conn = get_db()
-    row = conn.execute(
-        "SELECT * FROM plm_documentos WHERE ruta_origen=?", (filepath,)
-    ).fetchone()
+    row = buscar_doc_por_ruta(conn, filepath)
     conn.close()
     return dict(row) if row else None
 
 
+# ── CACHÉ DE LISTADOS ─────────────────────────────────────────────────────────
+# Volver a una carpeta ya visitada (atrás/adelante) no debe re-escanear la unidad
+# de red. Cada listado se guarda con la firma (mtime, inode) del directorio: si la
+# firma coincide se reutiliza, si no se re-escanea solo esa carpeta.
+# Ojo: editar un archivo "in situ" no cambia el mtime de su carpeta; el botón
+# Recargar (?refresh=1) fuerza el re-escaneo.
+
+class CacheDirectorios:
+    """LRU en memoria validado por firma de directorio, con tope de tamaño."""
+
+    def __init__(self, max_dirs, max_entradas):
+        self.max_dirs = max_dirs
+        self.max_entradas = max_entradas
+        self._datos = OrderedDict()  # ruta -> (firma, valor, n_entradas)
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def get(self, ruta, firma):
+        with self._lock:
+            item = self._datos.get(ruta)
+            if item is None or item[0] != firma:
+                return None
+            self._datos.move_to_end(ruta)
+            return item[1]
+
+    def put(self, ruta, firma, valor, n=1):
+        with self._lock:
+            old = self._datos.pop(ruta, None)
+            if old:
+                self._total -= old[2]
+            self._datos[ruta] = (firma, valor, n)
+            self._total += n
+            while len(self._datos) > 1 and (len(self._datos) > self.max_dirs
+                                            or self._total > self.max_entradas):
+                _, (_, _, n_old) = self._datos.popitem(last=False)
+                self._total -= n_old
+
+
+_cache_listados = CacheDirectorios(max_dirs=256, max_entradas=200_000)
+_cache_cad_count = CacheDirectorios(max_dirs=4096, max_entradas=4096)
+
+
+def firma_dir(st):
+    return (st.st_mtime_ns, st.st_ino)
+
+
+# ── E/S CONCURRENTE ───────────────────────────────────────────────────────────
+# En recursos SMB cada stat()/scandir() es un viaje de red. Se reparten en un
+# pool acotado y se espera como mucho IO_TIMEOUT: lo que no responda a tiempo
+# se devuelve como 'pendiente' en vez de bloquear todo el listado.
+
+IO_WORKERS = 16
+IO_TIMEOUT = 3.0  # segundos
+_io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='plm-io')
+PENDIENTE = object()
+
+
+def mapear_concurrente(fn, args, timeout=IO_TIMEOUT):
+    """[fn(a) for a in args] en el pool de E/S. Resultado PENDIENTE si no llega
+    a tiempo; las excepciones se devuelven como valor (no se propagan)."""
+    args = list(args)
+    if not args:
+        return []
+    if len(args) == 1:
+        try:
+            return [fn(args[0])]
+        except Exception as e:
+            return [e]
+    futuros = [_io_pool.submit(fn, a) for a in args]
+    wait(futuros, timeout=timeout)
+    res = []
+    for f in futuros:
+        if not f.done():
+            f.cancel()
+            res.append(PENDIENTE)
+        elif f.exception() is not None:
+            res.append(f.exception())
+        else:
+            res.append(f.result())
+    return res
+
+
+STAT_BLOQUE = 32  # entradas por tarea del pool (menos overhead en carpetas enormes)
+
+
+def _stat_seguro(entry):
+    try:
+        return entry.stat()
+    except Exception as e:
+        return e
+
+
+def escanear_directorio(path, forzar=False):
+    """Entradas visibles de la carpeta (carpetas primero), cacheadas por mtime/inode.
+
+    Los stat() se lanzan en paralelo; las entradas que no responden a tiempo se
+    incluyen con 'pendiente': True y el listado no se guarda en caché.
+    Las entradas son dicts compartidos con la caché: no modificarlos.
+    """
+    firma = firma_dir(os.stat(path))
+    if not forzar:
+        cached = _cache_listados.get(path, firma)
+        if cached is not None:
+            return cached
+
+    dir_norm = normalizar_ruta(path)
+    with os.scandir(path) as it:
+        visibles = [entry for entry in it if not entry.name.startswith('.')]  # Ocultar archivos ocultos
+
+    if sys.platform == 'win32':
+        # En Windows scandir ya trae tamaño y fechas: stat() no hace otro viaje
+        stats = [_stat_seguro(entry) for entry in visibles]
+    else:
+        bloques = [visibles[i:i + STAT_BLOQUE] for i in range(0, len(visibles), STAT_BLOQUE)]
+        stats = []
+        for bloque, res in zip(bloques, mapear_concurrente(
+                lambda b: [_stat_seguro(entry) for entry in b], bloques)):
+            stats.extend(res if isinstance(res, list) else [PENDIENTE] * len(bloque))
+
+    entradas = []
+    completo = True
+    for entry, stat in zip(visibles, stats):
+        if isinstance(stat, Exception):
+            continue
+        try:
+            es_dir = entry.is_dir()
+        except Exception:
+            continue
+        pendiente = stat is PENDIENTE
+        completo = completo and not pendiente
+        ext = '' if es_dir else os.path.splitext(entry.name)[1].lower()
+        entradas.append({
+            'name': entry.name,
+            'path': entry.path,
+            'is_dir': es_dir,
+            'ext': ext,
+            'size': None if pendiente else stat.st_size,
+            'mtime': None if pendiente else stat.st_mtime,
+            'pendiente': pendiente,
+            'ruta_norm': normalizar_en_directorio(dir_norm, entry) if ext in EXT_CAD else None,
+        })
+
+    # Carpetas primero, luego archivos
+    entradas.sort(key=lambda e: (not e['is_dir'], e['name'].lower()))
+    if completo:
+        _cache_listados.put(path, firma, entradas, len(entradas))
+    return entradas
+
+
+def contar_cad(path, forzar=False):
+    """Nº de archivos CAD directamente dentro de una carpeta (cacheado por mtime/inode)."""
+    try:
+        firma = firma_dir(os.stat(path))
+    except Exception:
+        return 0
+    if not forzar:
+        cached = _cache_cad_count.get(path, firma)
+        if cached is not None:
+            return cached
+        listado = _cache_listados.get(path, firma)
+        if listado is not None:
+            n = sum(1 for e in listado if e['ext'] in EXT_CAD)
+            _cache_cad_count.put(path, firma, n)
+            return n
+    try:
+        with os.scandir(path) as it:
+            n = sum(1 for f in it if os.path.splitext(f.name)[1].lower() in EXT_CAD)
+    except Exception:
+        n = 0
+    _cache_cad_count.put(path, firma, n)
+    return n
+
+
+def contar_cad_varias(paths, forzar=False):
+    """contar_cad() en paralelo; None para las carpetas que no respondan a tiempo."""
+    res = mapear_concurrente(lambda p: contar_cad(p, forzar), paths)
+    return [None if r is PENDIENTE or isinstance(r, Exception) else r for r in res]
+
+
 def format_size(size):
     for unit in ['B', 'KB', 'MB', 'GB']:
         if size < 1024:
@@ -140,71 +319,73 @@ def plm_explorer_view():
                            path_desktop=path_desktop)
 
 
-@plm_explorer.route('/plm/explorer/browse')
-def plm_browse():
-    """API: lista contenido de una carpeta."""
-    path = request.args.get('path', os.path.expanduser('~'))
-
-    # Seguridad básica: normalizar ruta
-    path = os.path.normpath(path)
-
-    if not os.path.exists(path):
-        return jsonify({'error': 'Ruta no existe', 'path': path, 'items': []})
-
+def filtrar_entradas(entradas, q='', exts=None, solo_cad=False):
+    """Filtros del explorador en servidor. El texto se aplica a todo; extensión
+    y 'solo CAD' solo a archivos (las carpetas siguen visibles para navegar)."""
+    q = (q or '').lower()
+    if not (q or exts or solo_cad):
+        return entradas
+    res = []
+    for e in entradas:
+        if q and q not in e['name'].lower():
+            continue
+        if not e['is_dir']:
+            if solo_cad and e['ext'] not in EXT_CAD:
+                continue
+            if exts and e['ext'] not in exts:
+                continue
+        res.append(e)
+    return res
+
+
+def construir_items(conn, entradas, forzar=False):
+    """Convierte entradas escaneadas en items JSON del explorador.
+
+    Solo se enriquece lo que se va a enviar: una consulta PLM y un conteo CAD
+    por subcarpeta para este bloque, no para toda la carpeta.
+    """
+    docs_plm = buscar_docs_por_rutas(conn, (e['ruta_norm'] for e in entradas))
     items = []
 
-    try:
-        entries = list(os.scandir(path))
-    except PermissionError:
-        return jsonify({'error': 'Sin permiso', 'path': path, 'items': []})
+    # Contar archivos CAD dentro de cada subcarpeta (nivel superficial), en paralelo
+    carpetas = [e['path'] for e in entradas if e['is_dir']]
+    cad_counts = dict(zip(carpetas, contar_cad_varias(carpetas, forzar)))
 
-    # Carpetas primero, luego archivos
-    entries.sort(key=lambda e: (not e.is_dir(), e.name.lower()))
+    for e in entradas:
+        ext = e['ext']
+        modified = (datetime.fromtimestamp(e['mtime']).strftime('%d/%m/%Y %H:%M')
+                    if e['mtime'] is not None else '—')
 
-    for entry in entries:
-        if entry.name.startswith('.'):
-            continue  # Ocultar archivos ocultos
-
-        try:
-            stat = entry.stat()
-        except Exception:
-            continue
-
-        ext = os.path.splitext(entry.name)[1].lower()
-
-        if entry.is_dir():
-            # Contar archivos CAD dentro (nivel superficial)
-            try:
-                cad_count = sum(
-                    1 for f in os.scandir(entry.path)
-                    if os.path.splitext(f.name)[1].lower() in EXT_CAD
-                )
-            except Exception:
-                cad_count = 0
+        if e['is_dir']:
+            cad_count = cad_counts.get(e['path'])
 
             items.append({
                 'type': 'folder',
-                'name': entry.name,
-                'path': entry.path,
+                'name': e['name'],
+                'path': e['path'],
                 'icon': EXT_ICONS['folder'],
-                'modified': datetime.fromtimestamp(stat.st_mtime).strftime('%d/%m/%Y %H:%M'),
+                'modified': modified,
                 'cad_count': cad_count,
-                'is_cad': cad_count > 0,
+                'is_cad': bool(cad_count),
+                'pendiente': e['pendiente'] or cad_count is None,
             })
         else:
             is_cad = ext in EXT_CAD
             cad_info = EXT_CAD.get(ext, None)
-            doc_plm = get_doc_info(entry.path) if is_cad else None
+            doc_plm = docs_plm.get(e['ruta_norm']) if is_cad else None
 
             items.append({
                 'type': 'file',
-                'name': entry.name,
-                'path': entry.path,
+                'thumb': ('/plm/explorer/thumb?path=' + quote(e['path'])
+                          if NUMPY_OK and ext in EXT_MALLA else None),
+                'name': e['name'],
+                'path': e['path'],
                 'ext': ext,
                 'icon': EXT_ICONS.get(ext, '▪'),
-                'size': format_size(stat.st_size),
-                'size_bytes': stat.st_size,
-                'modified': datetime.fromtimestamp(stat.st_mtime).strftime('%d/%m/%Y %H:%M'),
+                'size': format_size(e['size']) if e['size'] is not None else '—',
+                'size_bytes': e['size'],
+                'modified': modified,
+                'pendiente': e['pendiente'],
                 'is_cad': is_cad,
                 'tipo': cad_info[0] if cad_info else None,
                 'software': cad_info[1] if cad_info else None,
@@ -214,8 +395,10 @@ def plm_browse():
                 'plm_estado': doc_plm['estado'] if doc_plm else None,
                 'plm_id': doc_plm['id'] if doc_plm else None,
             })
+    return items
+
 
-    # Breadcrumb
+def breadcrumb(path):
     parts = []
     current = path
     while True:
@@ -225,15 +408,159 @@ def plm_browse():
             break
         parts.insert(0, {'name': os.path.basename(current), 'path': current})
         current = parent
+    return parts
+
 
-    return jsonify({
+BROWSE_CHUNK = 200  # items por bloque en modo streaming
+
+
+@plm_explorer.route('/plm/explorer/browse')
+def plm_browse():
+    """API: lista contenido de una carpeta.
+
+    Parámetros opcionales: q (texto en el nombre), ext (lista separada por
+    comas), solo_cad=1, offset/limit (paginación) y format=ndjson (streaming:
+    una línea 'meta' y después una línea por item, en bloques).
+    """
+    path = request.args.get('path', os.path.expanduser('~'))
+
+    # Seguridad básica: normalizar ruta
+    path = os.path.normpath(path)
+
+    if not os.path.exists(path):
+        return jsonify({'error': 'Ruta no existe', 'path': path, 'items': []})
+
+    # ↺ Recargar fuerza el re-escaneo aunque la carpeta no haya cambiado
+    forzar = request.args.get('refresh') == '1'
+
+    try:
+        entradas = escanear_directorio(path, forzar)
+    except PermissionError:
+        return jsonify({'error': 'Sin permiso', 'path': path, 'items': []})
+
+    exts = {('.' + x.strip().lower().lstrip('.')) for x in request.args.get('ext', '').split(',') if x.strip()}
+    entradas = filtrar_entradas(entradas, request.args.get('q', ''), exts,
+                                request.args.get('solo_cad') == '1')
+
+    total = len(entradas)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = request.args.get('limit', type=int)
+    fin = total if not limit or limit <= 0 else min(offset + limit, total)
+    pagina = entradas[offset:fin]
+
+    meta = {
         'path': path,
         'parent': os.path.dirname(path) if os.path.dirname(path) != path else None,
-        'breadcrumb': parts,
+        'breadcrumb': breadcrumb(path),
+        'total': total,
+        'cad_files': sum(1 for e in entradas if e['ext'] in EXT_CAD),
+        'offset': offset,
+        'next_offset': fin if fin < total else None,
+    }
+
+    if request.args.get('format') == 'ndjson':
+        def generar():
+            yield json.dumps({'meta': meta}) + '\n'
+            conn = get_db()
+            try:
+                for i in range(0, len(pagina), BROWSE_CHUNK):
+                    bloque = construir_items(conn, pagina[i:i + BROWSE_CHUNK], forzar)
+                    yield ''.join(json.dumps({'item': it}) + '\n' for it in bloque)
+            finally:
+                conn.close()
+            yield json.dumps({'end': True}) + '\n'
+
+        return Response(stream_with_context(generar()), mimetype='application/x-ndjson',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    conn = get_db()
+    items = construir_items(conn, pagina, forzar)
+    conn.close()
+
+    meta.update({
         'items': items,
-        'total': len(items),
         'cad_total': sum(1 for i in items if i.get('is_cad')),
     })
+    return jsonify(meta)
+
+
+# ── MINIATURAS ────────────────────────────────────────────────────────────────
+# Las miniaturas de STL/OBJ se guardan por hash de contenido, así que su URL
+# (/plm/thumb/<hash>) no cambia nunca y el navegador la cachea sin revalidar.
+# Desde el explorador se pide por ruta: se resuelve el hash (plm_hash_cache, sin
+# leer el archivo si no cambió) y se redirige. Si la miniatura aún no existe se
+# encarga al pool y se espera como mucho THUMB_TIMEOUT; si no llega, 202 y el
+# cliente reintenta.
+
+THUMB_TIMEOUT = 4.0  # segundos
+THUMB_MAX_AGE = 365 * 24 * 3600
+_RE_HASH = re.compile(r'[0-9a-f]{16,128}')
+
+
+def _esperar_miniatura(hash_b2, ruta, ext=None):
+    """Respuesta de error/pendiente, o None si la miniatura ya está en disco."""
+    if os.path.exists(ruta_miniatura(hash_b2)):
+        return None
+    fallo = fallo_miniatura(hash_b2)
+    if fallo is not None:  # malla ilegible: no se vuelve a encolar
+        return jsonify({'error': fallo}), 422
+    fut = solicitar_miniatura(hash_b2, ruta, ext)
+    wait([fut], timeout=THUMB_TIMEOUT)
+    if not fut.done():
+        resp = jsonify({'pendiente': True})
+        resp.status_code = 202
+        resp.headers['Retry-After'] = '2'
+        resp.headers['Cache-Control'] = 'no-store'
+        return resp
+    if fut.exception() is not None:
+        return jsonify({'error': str(fut.exception())}), 422
+    return None
+
+
+@plm_explorer.route('/plm/thumb/<hash_b2>')
+def plm_thumb(hash_b2):
+    """Miniatura PNG de una malla por hash de contenido (del vault si no existe)."""
+    if not _RE_HASH.fullmatch(hash_b2) or not NUMPY_OK:
+        abort(404)
+    if not os.path.exists(ruta_miniatura(hash_b2)):
+        # El blob no tiene extensión: el formato sale de los metadatos del ingreso
+        conn = get_db()
+        row = conn.execute("SELECT formato FROM plm_metadatos WHERE hash_b2=?", (hash_b2,)).fetchone()
+        conn.close()
+        blob = ruta_vault(blob_relativo(hash_b2))
+        if row is None or '.' + row['formato'] not in EXT_MALLA or not os.path.exists(blob):
+            abort(404)
+        pendiente = _esperar_miniatura(hash_b2, blob, '.' + row['formato'])
+        if pendiente is not None:
+            return pendiente
+    resp = send_file(ruta_miniatura(hash_b2), mimetype='image/png', max_age=THUMB_MAX_AGE)
+    resp.headers['Cache-Control'] = f'public, max-age={THUMB_MAX_AGE}, immutable'
+    return resp
+
+
+@plm_explorer.route('/plm/explorer/thumb')
+def plm_thumb_ruta():
+    """Miniatura de un archivo del explorador: redirige a /plm/thumb/<hash>."""
+    path = os.path.normpath(request.args.get('path', ''))
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in EXT_MALLA or not NUMPY_OK or not os.path.isfile(path):
+        abort(404)
+    conn = get_db()
+    try:
+        hash_b2 = hash_archivo(conn, path)
+        conn.commit()
+    finally:
+        conn.close()
+    if not hash_b2:
+        abort(404)
+    # Si el contenido ya está en el vault se renderiza desde ahí (no cambia)
+    blob = ruta_vault(blob_relativo(hash_b2))
+    pendiente = _esperar_miniatura(hash_b2, blob if os.path.exists(blob) else path, ext)
+    if pendiente is not None:
+        return pendiente
+    resp = redirect(url_for('plm_explorer.plm_thumb', hash_b2=hash_b2))
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
 
 
 @plm_explorer.route('/plm/explorer/open', methods=['POST'])
@@ -273,46 +600,62 @@ def plm_register_file():
 
     tipo, software, _ = EXT_CAD[ext]
     nombre = os.path.splitext(os.path.basename(filepath))[0]
-    nuevo_hash = calc_hash(filepath)
 
     conn = get_db()
+    try:
+        # Comprobar si ya existe
+        existing = buscar_doc_por_ruta(conn, filepath)
+        if existing:
+            return jsonify({'ok': False, 'error': f'Ya registrado como {existing["codigo"]}',
+                            'plm_id': existing['id'], 'codigo': existing['codigo']})
+
+        # La caché de hashes se confirma ya: la copia al vault y el análisis van
+        # sin transacción abierta (no bloquean al watcher ni a la sincronización)
+        nuevo_hash = hash_archivo(conn, filepath)
+        conn.commit()
+        if not nuevo_hash:
+            return jsonify({'ok': False, 'error': 'No se pudo leer el archivo'})
 
-    # Comprobar si ya existe
-    existing = conn.execute(
-        "SELECT id, codigo FROM plm_documentos WHERE ruta_origen=?", (filepath,)
-    ).fetchone()
-
-    if existing:
+        # Ingresar en el vault (no se copia si el contenido ya estaba)
+        try:
+            archivo_vault = guardar_blob(filepath, nuevo_hash)
+        except OSError as e:
+            return jsonify({'ok': False, 'error': str(e)})
+        metadatos = None
+        if ext in EXTRACTORES and hashes_sin_metadatos(conn, [nuevo_hash]):
+            metadatos = extraer(ruta_vault(archivo_vault), ext)
+
+        # Código y altas en una sola transacción corta, con el bloqueo ya tomado:
+        # el watcher puede haber registrado la misma ruta entretanto
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            existing = buscar_doc_por_ruta(conn, filepath)
+            if existing:
+                return jsonify({'ok': False, 'error': f'Ya registrado como {existing["codigo"]}',
+                                'plm_id': existing['id'], 'codigo': existing['codigo']})
+            prefijos = {'pieza': 'PZA', 'ensamblaje': 'ENS', 'plano': 'PLN', 'otro': 'DOC', 'bom': 'BOM'}
+            pref = prefijos.get(tipo, 'DOC')
+            row = conn.execute(
+                "SELECT codigo FROM plm_documentos WHERE tipo=? ORDER BY id DESC LIMIT 1", (tipo,)
+            ).fetchone()
+            num = int(row['codigo'].split('-')[-1]) + 1 if row else 1
+            codigo = f"{pref}-{datetime.now().year}-{num:04d}"
+
+            if metadatos is not None:
+                guardar_metadatos(conn, [(nuevo_hash, metadatos)])
+            conn.execute('''INSERT INTO plm_documentos
+                (codigo, nombre, tipo, software, ruta_origen, ruta_norm, archivo_vault, hash_b2, estado, proyecto_id)
+                VALUES (?,?,?,?,?,?,?,?,?,?)''',
+                (codigo, nombre, tipo, software, filepath, normalizar_ruta(filepath), archivo_vault, nuevo_hash,
+                 'en_diseno', proyecto_id or None))
+            doc_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            cur = conn.execute('''INSERT INTO plm_revisiones
+                (documento_id, revision, descripcion_cambio, archivo_vault, hash_b2)
+                VALUES (?,?,?,?,?)''', (doc_id, 'A', 'Registrado desde explorador PLM', archivo_vault, nuevo_hash))
+            referenciar_blob(conn, nuevo_hash, doc_id, cur.lastrowid, filepath)
+            registrar_db(conn, doc_id, 'REGISTRADO', f"Desde explorador: {filepath}")
+    finally:
         conn.close()
-        return jsonify({'ok': False, 'error': f'Ya registrado como {existing["codigo"]}',
-                        'plm_id': existing['id'], 'codigo': existing['codigo']})
-
-    # Generar código
-    prefijos = {'pieza': 'PZA', 'ensamblaje': 'ENS', 'plano': 'PLN', 'otro': 'DOC', 'bom': 'BOM'}
-    pref = prefijos.get(tipo, 'DOC')
-    row = conn.execute(
-        "SELECT codigo FROM plm_documentos WHERE tipo=? ORDER BY id DESC LIMIT 1", (tipo,)
-    ).fetchone()
-    num = int(row['codigo'].split('-')[-1]) + 1 if row else 1
-    codigo = f"{pref}-{datetime.now().year}-{num:04d}"
-
-    # Copiar al vault
-    ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-    vault_name = f"{codigo}_{ts}{ext}"
-    shutil.copy2(filepath, os.path.join(VAULT_DIR, vault_name))
-
-    conn.execute('''INSERT INTO plm_documentos
-        (codigo, nombre, tipo, software, ruta_origen, archivo_vault, hash_md5, estado, proyecto_id)
-        VALUES (?,?,?,?,?,?,?,?,?)''',
-        (codigo, nombre, tipo, software, filepath, vault_name, nuevo_hash, 'en_diseno',
-         proyecto_id or None))
-    doc_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-    conn.execute('''INSERT INTO plm_revisiones (documento_id, revision, descripcion_cambio)
-        VALUES (?,?,?)''', (doc_id, 'A', 'Registrado desde explorador PLM'))
-    conn.execute('INSERT INTO plm_log (documento_id, accion, detalle) VALUES (?,?,?)',
-                 (doc_id, 'REGISTRADO', f"Desde explorador: {filepath}"))
-    conn.commit()
-    conn.close()
 
     return jsonify({'ok': True, 'codigo': codigo, 'plm_id': doc_id, 'tipo': tipo, 'software': software})
 
@@ -332,7 +675,7 @@ def plm_add_watchfolder_explorer():
         conn.execute("INSERT INTO plm_watchfolders (ruta, software) VALUES (?,?)",
                      (ruta, software))
         conn.commit()
-        result = {'ok': True}
+        result = {'ok': True, 'job_id': encolar('plm_indice', unico=True)}
     except Exception:
         result = {'ok': False, 'error': 'Ya está en watch folders'}
     conn.close()
@@ -346,4 +689,82 @@ def plm_get_proyectos():
         "SELECT id, nombre FROM proyectos WHERE estado NOT IN ('entregado','cancelado') ORDER BY nombre"
     ).fetchall()
     conn.close()
-    return jsonify([dict(p) for p in proyectos])
\ No newline at end of file
+    return jsonify([dict(p) for p in proyectos])
+
+
+# ── ÍNDICE GLOBAL ─────────────────────────────────────────────────────────────
+# Búsqueda en todos los CAD de las watch folders sin recorrer carpetas (ver
+# plm_indice). Si alguna carpeta no se ha rastreado aún, se encola el rastreo y
+# se responde con lo que haya.
+
+def item_indice(a):
+    """Fila de plm_archivos → item del explorador (mismo formato que construir_items)."""
+    ext = a['ext']
+    cad_info = EXT_CAD.get(ext)
+    return {
+        'type': 'file',
+        'thumb': ('/plm/explorer/thumb?path=' + quote(a['ruta'])
+                  if NUMPY_OK and ext in EXT_MALLA else None),
+        'name': a['nombre'],
+        'path': a['ruta'],
+        'carpeta': os.path.dirname(a['ruta']),
+        'wf_ruta': a['wf_ruta'],
+        'ext': ext,
+        'icon': EXT_ICONS.get(ext, '▪'),
+        'size': format_size(a['tamano']) if a['tamano'] is not None else '—',
+        'size_bytes': a['tamano'],
+        'modified': (datetime.fromtimestamp(a['mtime_ns'] / 1e9).strftime('%d/%m/%Y %H:%M')
+                     if a['mtime_ns'] is not None else '—'),
+        'pendiente': False,
+        'is_cad': cad_info is not None,
+        'tipo': cad_info[0] if cad_info else None,
+        'software': cad_info[1] if cad_info else None,
+        'color': cad_info[2] if cad_info else '#555',
+        'plm_registrado': a['documento_id'] is not None,
+        'plm_codigo': a['doc_codigo'],
+        'plm_estado': a['doc_estado'],
+        'plm_id': a['documento_id'],
+    }
+
+
+def _encolar_si_falta(conn):
+    return encolar('plm_indice', unico=True) if indice_pendientes(conn) else None
+
+
+@plm_explorer.route('/plm/explorer/indice')
+def plm_indice_buscar():
+    """API: busca en el índice global. Parámetros: q, modo (contiene | prefijo),
+    registro (si | no), ext (lista separada por comas), wf (id de watch folder),
+    cursor (el 'siguiente' de la página anterior) y limit."""
+    exts = {('.' + x.strip().lower().lstrip('.')) for x in request.args.get('ext', '').split(',') if x.strip()}
+    conn = get_db()
+    try:
+        res = buscar_archivos(conn, request.args.get('q', ''), request.args.get('modo', 'contiene'),
+                              request.args.get('registro') or None, exts,
+                              request.args.get('wf', type=int), request.args.get('cursor') or None,
+                              request.args.get('limit', type=int))
+        job_id = _encolar_si_falta(conn)
+    except (ValueError, TypeError):
+        return jsonify({'ok': False, 'error': 'Cursor no válido'}), 400
+    finally:
+        conn.close()
+    return jsonify({'ok': True, 'items': [item_indice(a) for a in res['archivos']],
+                    'siguiente': res['siguiente'], 'modo': res['modo'], 'job_id': job_id})
+
+
+@plm_explorer.route('/plm/explorer/indice/resumen')
+def plm_indice_resumen():
+    """API: archivos indexados, registrados y sin registrar por watch folder y extensión."""
+    conn = get_db()
+    try:
+        res = resumen_indice(conn)
+        res['job_id'] = _encolar_si_falta(conn)
+    finally:
+        conn.close()
+    return jsonify(res)
+
+
+@plm_explorer.route('/plm/explorer/indice/rastrear', methods=['POST'])
+def plm_indice_rastrear():
+    """Vuelve a rastrear todas las watch folders en segundo plano."""
+    return jsonify({'ok': True, 'job_id': encolar('plm_indice', unico=True)})
@@ -0,0 +1,195 @@
+"""
+PLM Explosión — JA · ERP
+Explosión multinivel de BOM y cadena de uso (dónde se usa una pieza o una BOM).
+
+Una línea baja a otra BOM si apunta a ella (bom_hijo_id, ver plm_ensamblajes) o
+si su documento tiene BOM propia (plm_bom.documento_id; si hay varias manda la
+liberada, luego la aprobada y luego la más reciente).
+
+Todas las líneas se tienen en memoria en un grafo (GrafoBom) con su índice
+inverso; se recarga cuando cambian plm_bom o plm_bom_lineas, lo que se sabe por
+los contadores de plm_avisos que mantienen triggers (ver plm_core). Cada
+explosión y cada cadena de uso se guarda por BOM / documento hasta la recarga.
+
+    cantidad_total = producto de las cantidades desde la BOM raíz hasta la línea
+
+Un ciclo (una BOM que acaba conteniéndose) se marca en la línea que lo cierra y
+no se sigue bajando por ella.
+"""
+
+import threading
+
+from plm_core import asegurar_avisos
+
+TABLAS_AVISO_BOM = {
+    'plm_bom': 'documento_id, estado',
+    'plm_bom_lineas': 'bom_id, documento_id, bom_hijo_id, pos, codigo, descripcion, '
+                      'cantidad, unidad, material, proveedor',
+}
+PRIORIDAD_ESTADO = {'liberado': 0, 'aprobado': 1, 'revision': 2, 'borrador': 3}
+MAX_FILAS = 50_000  # una explosión más larga se corta (y se avisa)
+
+
+def asegurar_explosion(conn):
+    asegurar_avisos(conn, TABLAS_AVISO_BOM)
+
+
+def _clave_resumen(linea):
+    """Las líneas que son el mismo componente: mismo documento, o si no, mismo código
+    (o descripción) y unidad."""
+    if linea['documento_id']:
+        return ('doc', linea['documento_id'], linea['unidad'])
+    return ('txt', (linea['codigo'] or linea['descripcion'] or '').strip().lower(), linea['unidad'])
+
+
+class GrafoBom:
+    """Líneas de todas las BOM por bom_id (en orden de pos) y quién usa cada BOM y
+    cada documento."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._firma = None
+        self.boms = {}        # id → fila de plm_bom
+        self.lineas = {}      # bom_id → [línea, ...]
+        self.bom_de_doc = {}  # documento_id → BOM vigente del documento
+        self.usos_bom = {}    # bom_id → [línea que baja a esa BOM, ...]
+        self.usos_doc = {}    # documento_id → [línea que lo referencia, ...]
+        self._cache = {}
+
+    def actualizar(self, conn):
+        firma = tuple(conn.execute(
+            "SELECT tabla, version FROM plm_avisos WHERE tabla IN ('plm_bom', 'plm_bom_lineas') "
+            "ORDER BY tabla").fetchall())
+        with self._lock:
+            if firma and firma == self._firma:
+                return
+            boms = {r['id']: dict(r) for r in conn.execute(
+                "SELECT id, nombre, estado, documento_id FROM plm_bom")}
+            lineas = {}
+            for r in conn.execute('''SELECT l.id, l.bom_id, l.documento_id, l.bom_hijo_id, l.pos,
+                        l.codigo, l.descripcion, l.cantidad, l.unidad, l.material, l.proveedor,
+                        d.codigo AS doc_codigo
+                    FROM plm_bom_lineas l LEFT JOIN plm_documentos d ON d.id = l.documento_id
+                    ORDER BY l.bom_id, l.pos, l.id'''):
+                lineas.setdefault(r['bom_id'], []).append(dict(r))
+            bom_de_doc = {}
+            for b in sorted(boms.values(), key=lambda b: (-PRIORIDAD_ESTADO.get(b['estado'], 9), b['id'])):
+                if b['documento_id']:
+                    bom_de_doc[b['documento_id']] = b['id']  # la última escrita es la que manda
+            self.boms, self.lineas, self.bom_de_doc = boms, lineas, bom_de_doc
+            self.usos_bom, self.usos_doc = {}, {}
+            for ls in lineas.values():
+                for l in ls:
+                    hijo = self.hijo(l)
+                    if hijo is not None:
+                        self.usos_bom.setdefault(hijo, []).append(l)
+                    if l['documento_id']:
+                        self.usos_doc.setdefault(l['documento_id'], []).append(l)
+            self._cache = {}
+            self._firma = firma
+
+    def hijo(self, linea):
+        """BOM a la que baja una línea, o None si es un componente final."""
+        hijo = linea['bom_hijo_id'] or self.bom_de_doc.get(linea['documento_id'])
+        return hijo if hijo in self.boms else None
+
+    def explotar(self, bom_id):
+        """{'filas': [...], 'resumen': [...], 'ciclos': [[bom_id, ...]], 'truncada': bool}.
+        filas va en profundidad (cada subensamblaje seguido de su contenido) y resumen
+        suma las cantidades totales de los componentes finales."""
+        with self._lock:
+            if ('explosion', bom_id) in self._cache:
+                return self._cache['explosion', bom_id]
+            filas, resumen, ciclos, truncada = [], {}, [], False
+            pila = [(iter(self.lineas.get(bom_id, ())), 1, 1.0, '', (bom_id,))]
+            while pila:
+                it, nivel, factor, prefijo, camino = pila[-1]
+                l = next(it, None)
+                if l is None:
+                    pila.pop()
+                    continue
+                total = factor * (l['cantidad'] or 0)
+                hijo = self.hijo(l)
+                fila = dict(l, nivel=nivel, ruta=f"{prefijo}{l['pos']}", cantidad_total=total,
+                            bom_hijo=hijo, ciclo=hijo in camino)
+                filas.append(fila)
+                if fila['ciclo']:
+                    ciclos.append(list(camino[camino.index(hijo):]) + [hijo])
+                elif hijo is None or not self.lineas.get(hijo):
+                    r = resumen.get(_clave_resumen(l))
+                    if r is None:
+                        resumen[_clave_resumen(l)] = {
+                            'documento_id': l['documento_id'], 'doc_codigo': l['doc_codigo'],
+                            'codigo': l['codigo'], 'descripcion': l['descripcion'],
+                            'unidad': l['unidad'], 'material': l['material'],
+                            'proveedor': l['proveedor'], 'cantidad_total': total, 'apariciones': 1}
+                    else:
+                        r['cantidad_total'] += total
+                        r['apariciones'] += 1
+                elif len(filas) >= MAX_FILAS:
+                    truncada = True
+                else:
+                    pila.append((iter(self.lineas[hijo]), nivel + 1, total, fila['ruta'] + '.',
+                                 camino + (hijo,)))
+            res = {'bom_id': bom_id, 'filas': filas, 'ciclos': ciclos, 'truncada': truncada,
+                   'niveles': max((f['nivel'] for f in filas), default=0),
+                   'resumen': sorted(resumen.values(),
+                                     key=lambda r: ((r['codigo'] or r['descripcion'] or '').lower()))}
+            self._cache['explosion', bom_id] = res
+            return res
+
+    def donde_se_usa(self, documento_id=None, bom_id=None):
+        """Cadena de uso hacia arriba de un documento o de una BOM. Cada fila es una
+        línea que lo contiene; nivel 1 = BOM que lo usa directamente, y cantidad_total
+        = unidades por cada unidad de esa BOM. raiz marca las BOM que no usa nadie."""
+        clave = ('usos', documento_id, bom_id)
+        with self._lock:
+            if clave in self._cache:
+                return self._cache[clave]
+            if documento_id is not None:
+                directas = list(self.usos_doc.get(documento_id, ()))
+                propia = self.bom_de_doc.get(documento_id)
+                vistas = {l['id'] for l in directas}
+                directas += [l for l in self.usos_bom.get(propia, ()) if l['id'] not in vistas]
+                inicio = (propia,) if propia else ()
+            else:
+                directas, inicio = list(self.usos_bom.get(bom_id, ())), (bom_id,)
+            filas, raices = [], {}
+            pila = [(iter(directas), 1, 1.0, inicio)]
+            while pila:
+                it, nivel, factor, camino = pila[-1]
+                l = next(it, None)
+                if l is None:
+                    pila.pop()
+                    continue
+                padre = l['bom_id']
+                b = self.boms.get(padre, {})
+                total = factor * (l['cantidad'] or 0)
+                usos = self.usos_bom.get(padre, [])
+                fila = {'nivel': nivel, 'bom_id': padre, 'bom_nombre': b.get('nombre'),
+                        'bom_estado': b.get('estado'), 'linea_id': l['id'], 'pos': l['pos'],
+                        'cantidad': l['cantidad'], 'cantidad_total': total,
+                        'ciclo': padre in camino, 'raiz': not usos}
+                filas.append(fila)
+                if fila['raiz']:
+                    r = raices.setdefault(padre, {'bom_id': padre, 'bom_nombre': b.get('nombre'),
+                                                  'bom_estado': b.get('estado'), 'cantidad_total': 0.0})
+                    r['cantidad_total'] += total
+                elif not fila['ciclo'] and len(filas) < MAX_FILAS:
+                    pila.append((iter(usos), nivel + 1, total, camino + (padre,)))
+            res = {'filas': filas, 'raices': sorted(raices.values(), key=lambda r: r['bom_id'])}
+            self._cache[clave] = res
+            return res
+
+
+grafo = GrafoBom()
+
+
+def explosion(conn, bom_id):
+    grafo.actualizar(conn)
+    return grafo.explotar(bom_id)
+
+
+def donde_se_usa(conn, documento_id=None, bom_id=None):
+    grafo.actualizar(conn)
+    return grafo.donde_se_usa(documento_id=documento_id, bom_id=bom_id)
@@ -0,0 +1,444 @@
+"""
+PLM Índice — JA · ERP
+Índice global de los archivos CAD de todas las watch folders (plm_archivos):
+ruta, nombre, extensión, tamaño, mtime y documento PLM registrado, para
+encontrar un archivo sin recorrer carpetas en el explorador.
+
+Lo llena un rastreo completo (trabajo 'plm_indice' y, en el watcher, al activar
+una carpeta y cada RASTREO_PERIODICO) que compara con lo ya indexado y solo
+escribe diferencias. Entre rastreos lo mantienen los eventos del watcher
+(ColaIndice). documento_id lo mantienen triggers sobre plm_documentos: registrar,
+mover o borrar un documento se refleja sin volver a rastrear.
+
+Búsqueda por prefijo con el índice de nombre_min (un rango, sin LIKE) y por
+subcadena con una tabla FTS5 de trigramas (SQLite ≥ 3.34; sin ella, o con menos
+de 3 caracteres, LIKE sobre el índice de nombre). Las páginas se piden por clave
+como en plm_busqueda: (nombre_min, id), o el rowid en las búsquedas FTS, que
+salen en ese orden.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from plm_core import normalizar_ruta, normalizar_en_directorio
+
+log = logging.getLogger('plm_indice')
+
+# Las del explorador (EXT_CAD en plm_explorer_routes)
+EXT_INDICE = frozenset((
+    '.sldprt', '.sldasm', '.slddrw', '.prt', '.asm', '.drw', '.dwg', '.dxf',
+    '.ipt', '.iam', '.idw', '.step', '.stp', '.iges', '.igs', '.stl', '.obj',
+    '.pdf', '.xlsx', '.xls'))
+LOTE_BD = 2000                 # filas por transacción en el rastreo
+INTERVALO_EVENTOS = 2.0        # segundos entre lotes de eventos del watcher
+RASTREO_PERIODICO = 6 * 3600   # el watcher vuelve a rastrear (eventos perdidos en red)
+POR_PAGINA = 100
+MAX_POR_PAGINA = 1000
+MIN_TRIGRAMA = 3               # FTS5 trigram no busca subcadenas más cortas
+
+_UPSERT = '''INSERT INTO plm_archivos
+    (wf_id, ruta_norm, ruta, nombre, nombre_min, ext, tamano, mtime_ns, documento_id)
+    VALUES (?,?,?,?,?,?,?,?, (SELECT id FROM plm_documentos WHERE ruta_norm=?))
+    ON CONFLICT(ruta_norm) DO UPDATE SET wf_id=excluded.wf_id, ruta=excluded.ruta,
+        nombre=excluded.nombre, nombre_min=excluded.nombre_min, tamano=excluded.tamano,
+        mtime_ns=excluded.mtime_ns'''
+
+
+def asegurar_indice(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_archivos (
+        id INTEGER PRIMARY KEY,
+        wf_id INTEGER NOT NULL,
+        ruta_norm TEXT NOT NULL UNIQUE,
+        ruta TEXT NOT NULL,
+        nombre TEXT NOT NULL,         -- con extensión
+        nombre_min TEXT NOT NULL,     -- en minúsculas: búsqueda por prefijo y orden
+        ext TEXT NOT NULL,
+        tamano INTEGER,
+        mtime_ns INTEGER,
+        documento_id INTEGER)         -- documento PLM con esta ruta (triggers)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plm_archivos_nombre ON plm_archivos(nombre_min, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plm_archivos_sin_registrar "
+                 "ON plm_archivos(nombre_min, id) WHERE documento_id IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_plm_archivos_wf ON plm_archivos(wf_id, ext, documento_id)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_indice_carpetas (
+        wf_id INTEGER PRIMARY KEY,
+        ruta TEXT,                    -- ruta de la watch folder cuando se rastreó
+        rastreado TEXT,
+        archivos INTEGER,
+        segundos REAL,
+        errores INTEGER)              -- carpetas que no se pudieron leer''')
+
+    # documento_id al día con plm_documentos, lo escriba quien lo escriba
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS plm_archivos_doc_ai
+        AFTER INSERT ON plm_documentos WHEN new.ruta_norm IS NOT NULL BEGIN
+            UPDATE plm_archivos SET documento_id=new.id WHERE ruta_norm=new.ruta_norm;
+        END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS plm_archivos_doc_au
+        AFTER UPDATE OF ruta_norm ON plm_documentos WHEN old.ruta_norm IS NOT new.ruta_norm BEGIN
+            UPDATE plm_archivos SET documento_id=NULL WHERE ruta_norm=old.ruta_norm AND documento_id=old.id;
+            UPDATE plm_archivos SET documento_id=new.id WHERE ruta_norm=new.ruta_norm;
+        END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS plm_archivos_doc_ad
+        AFTER DELETE ON plm_documentos BEGIN
+            UPDATE plm_archivos SET documento_id=NULL WHERE ruta_norm=old.ruta_norm AND documento_id=old.id;
+        END''')
+    _asegurar_fts(conn)
+    conn.commit()
+
+
+def _asegurar_fts(conn):
+    """Tabla FTS5 de trigramas sobre plm_archivos.nombre (contenido externo,
+    mantenida por triggers). Sin FTS5 o sin trigram se busca con LIKE."""
+    if hay_fts(conn):
+        return
+    try:
+        conn.execute('''CREATE VIRTUAL TABLE plm_archivos_fts USING fts5(
+            nombre, content='plm_archivos', content_rowid='id', tokenize='trigram')''')
+    except sqlite3.OperationalError:
+        return
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS plm_archivos_fts_ai AFTER INSERT ON plm_archivos BEGIN
+            INSERT INTO plm_archivos_fts(rowid, nombre) VALUES (new.id, new.nombre);
+        END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS plm_archivos_fts_ad AFTER DELETE ON plm_archivos BEGIN
+            INSERT INTO plm_archivos_fts(plm_archivos_fts, rowid, nombre) VALUES ('delete', old.id, old.nombre);
+        END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS plm_archivos_fts_au
+        AFTER UPDATE OF nombre ON plm_archivos WHEN old.nombre IS NOT new.nombre BEGIN
+            INSERT INTO plm_archivos_fts(plm_archivos_fts, rowid, nombre) VALUES ('delete', old.id, old.nombre);
+            INSERT INTO plm_archivos_fts(rowid, nombre) VALUES (new.id, new.nombre);
+        END''')
+    # plm_archivos creada con un SQLite sin trigram: se indexa lo que ya hay
+    conn.execute("INSERT INTO plm_archivos_fts(plm_archivos_fts) VALUES ('rebuild')")
+
+
+def hay_fts(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name='plm_archivos_fts'").fetchone() is not None
+
+
+# ── ESCANEO ───────────────────────────────────────────────────────────────────
+
+def _fila(ruta, ruta_norm, nombre, st):
+    """(ruta_norm, ruta, nombre, ext, tamano, mtime_ns) de un archivo indexable."""
+    return (ruta_norm, ruta, nombre, os.path.splitext(nombre)[1].lower(), st.st_size, st.st_mtime_ns)
+
+
+def escanear(ruta, errores=None, excluir=()):
+    """Filas de los archivos indexables bajo ruta (recursivo), sin entrar en las
+    subcarpetas de excluir (ruta_norm). Las carpetas que no se pueden leer (o
+    dejan de responder a medias) se añaden a errores."""
+    pendientes = [(ruta, normalizar_ruta(ruta))]
+    while pendientes:
+        carpeta, dir_norm = pendientes.pop()
+        try:
+            with os.scandir(carpeta) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_norm = os.path.join(dir_norm, os.path.normcase(entry.name))
+                            if sub_norm not in excluir:
+                                pendientes.append((entry.path, sub_norm))
+                            continue
+                        if os.path.splitext(entry.name)[1].lower() not in EXT_INDICE or not entry.is_file():
+                            continue
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    yield _fila(entry.path, normalizar_en_directorio(dir_norm, entry), entry.name, st)
+        except OSError:
+            if errores is not None:
+                errores.append(dir_norm)
+
+
+def fila_archivo(ruta):
+    """Fila de un archivo suelto; None si ya no existe o no es indexable."""
+    nombre = os.path.basename(ruta)
+    if os.path.splitext(nombre)[1].lower() not in EXT_INDICE:
+        return None
+    try:
+        st = os.stat(ruta)
+    except OSError:
+        return None
+    return _fila(ruta, normalizar_ruta(ruta), nombre, st) if os.path.isfile(ruta) else None
+
+
+def _rango_carpeta(dir_norm):
+    """(desde, hasta) de las ruta_norm que cuelgan de dir_norm, para el índice único."""
+    base = dir_norm.rstrip(os.sep) + os.sep
+    return base, base[:-1] + chr(ord(os.sep) + 1)
+
+
+def _bajo(ruta_norm, carpetas):
+    return any(ruta_norm.startswith(c.rstrip(os.sep) + os.sep) for c in carpetas)
+
+
+def _vigiladas(conn):
+    """[(ruta_norm, wf_id)] de las watch folders, de la más profunda a la menos.
+    Con carpetas anidadas, cada archivo es de la más profunda que lo contiene."""
+    carpetas = [(normalizar_ruta(r[1]), r[0])
+                for r in conn.execute("SELECT id, ruta FROM plm_watchfolders")]
+    return sorted((c for c in carpetas if c[0]), key=lambda c: len(c[0]), reverse=True)
+
+
+def _propietaria(vigiladas, ruta_norm, defecto):
+    return next((wf_id for dir_norm, wf_id in vigiladas if _bajo(ruta_norm, [dir_norm])), defecto)
+
+
+# ── ESCRITURA ─────────────────────────────────────────────────────────────────
+
+def guardar(conn, wf_id, filas):
+    """Altas y cambios (filas de escanear). Escribe dentro de la transacción del llamador."""
+    conn.executemany(_UPSERT, [(wf_id, norm, ruta, nombre, nombre.lower(), ext, tamano, mtime, norm)
+                               for norm, ruta, nombre, ext, tamano, mtime in filas])
+
+
+def borrar(conn, rutas_norm):
+    conn.executemany("DELETE FROM plm_archivos WHERE ruta_norm=?", [(n,) for n in rutas_norm])
+
+
+def aplicar_cambios(conn, altas, bajas, carpetas):
+    """Lote de ColaIndice: altas [(wf_id, fila)], bajas [ruta_norm] y carpetas
+    re-escaneadas [(wf_id, dir_norm, filas, errores)], cuyo contenido sustituye a
+    lo indexado bajo ellas. Cada fila se asigna a su watch folder más profunda:
+    con carpetas anidadas el evento llega por las dos. Escribe dentro de la
+    transacción del llamador."""
+    vigiladas = _vigiladas(conn)
+    grupos = {}
+    for wf_id, dir_norm, filas, errores in carpetas:
+        nuevas = {f[0] for f in filas}
+        borrar(conn, [r[0] for r in conn.execute(
+            "SELECT ruta_norm FROM plm_archivos WHERE ruta_norm >= ? AND ruta_norm < ?",
+            _rango_carpeta(dir_norm)) if r[0] not in nuevas and not _bajo(r[0], errores)])
+        for fila in filas:
+            grupos.setdefault(_propietaria(vigiladas, fila[0], wf_id), []).append(fila)
+    for wf_id, fila in altas:
+        grupos.setdefault(_propietaria(vigiladas, fila[0], wf_id), []).append(fila)
+    for wf_id, filas in grupos.items():
+        guardar(conn, wf_id, filas)
+    borrar(conn, bajas)
+
+
+# ── RASTREO ───────────────────────────────────────────────────────────────────
+
+def rastrear_carpeta(conn, wf, observador=None, avance=None):
+    """Compara una watch folder con lo indexado y escribe solo las diferencias, en
+    lotes de LOTE_BD. Lo que cuelga de carpetas ilegibles no se da por borrado,
+    y las watch folders anidadas dentro de esta se saltan (sus archivos son suyos).
+    None si la carpeta no está accesible (no se toca su índice)."""
+    if not os.path.isdir(wf['ruta']):
+        return None
+    t0 = time.monotonic()
+    propia = normalizar_ruta(wf['ruta'])
+    anidadas = {d for d, wf_id in _vigiladas(conn) if wf_id != wf['id'] and _bajo(d, [propia])}
+    avance = avance if avance is not None else {}
+    indexados = {r[0]: (r[1], r[2]) for r in conn.execute(
+        "SELECT ruta_norm, tamano, mtime_ns FROM plm_archivos WHERE wf_id=?", (wf['id'],))}
+    res = {'archivos': 0, 'cambios': 0, 'borrados': 0, 'errores': 0}
+    errores, lote = [], []
+    for fila in escanear(wf['ruta'], errores, anidadas):
+        res['archivos'] += 1
+        if indexados.pop(fila[0], None) != fila[4:]:
+            lote.append(fila)
+        if len(lote) >= LOTE_BD:
+            with conn:
+                guardar(conn, wf['id'], lote)
+            res['cambios'] += len(lote)
+            lote = []
+        if observador is not None and res['archivos'] % LOTE_BD == 0:
+            observador(dict(avance, archivos=avance.get('archivos', 0) + res['archivos']))
+    with conn:
+        guardar(conn, wf['id'], lote)
+    res['cambios'] += len(lote)
+
+    # Lo que quedó en indexados ya no está (salvo bajo una carpeta que falló o bajo
+    # una anidada, que se lo quedará en su rastreo)
+    bajas = [n for n in indexados if not _bajo(n, errores) and not _bajo(n, anidadas)]
+    for i in range(0, len(bajas), LOTE_BD):
+        with conn:
+            borrar(conn, bajas[i:i + LOTE_BD])
+    res['borrados'], res['errores'] = len(bajas), len(errores)
+    with conn:
+        conn.execute('''INSERT OR REPLACE INTO plm_indice_carpetas
+            (wf_id, ruta, rastreado, archivos, segundos, errores) VALUES (?,?,?,?,?,?)''',
+            (wf['id'], wf['ruta'], datetime.now().isoformat(timespec='seconds'), res['archivos'],
+             round(time.monotonic() - t0, 2), len(errores)))
+    return res
+
+
+def rastrear(conn, observador=None):
+    """Rastrea todas las watch folders (activas o no) y quita del índice las que
+    ya no existen. Devuelve los totales."""
+    with conn:
+        conn.execute("DELETE FROM plm_archivos WHERE wf_id NOT IN (SELECT id FROM plm_watchfolders)")
+        conn.execute("DELETE FROM plm_indice_carpetas WHERE wf_id NOT IN (SELECT id FROM plm_watchfolders)")
+    wfs = conn.execute("SELECT id, ruta FROM plm_watchfolders ORDER BY id").fetchall()
+    totales = {'carpetas': 0, 'archivos': 0, 'cambios': 0, 'borrados': 0, 'errores': 0, 'inaccesibles': 0}
+    for wf in wfs:
+        avance = dict(totales, estado='rastreando', carpeta=wf['ruta'])
+        if observador is not None:
+            observador(avance)
+        res = rastrear_carpeta(conn, wf, observador, avance)
+        if res is None:
+            totales['inaccesibles'] += 1
+            continue
+        totales['carpetas'] += 1
+        for k, v in res.items():
+            totales[k] += v
+    return totales
+
+
+def pendientes(conn):
+    """Watch folders nunca rastreadas (o cuya ruta cambió desde el último rastreo)."""
+    return conn.execute('''SELECT COUNT(*) FROM plm_watchfolders w
+        LEFT JOIN plm_indice_carpetas c ON c.wf_id = w.id
+        WHERE c.wf_id IS NULL OR c.ruta IS NOT w.ruta''').fetchone()[0]
+
+
+# ── EVENTOS DEL WATCHER ───────────────────────────────────────────────────────
+
+class ColaIndice:
+    """Eventos del sistema de archivos → plm_archivos. El handler del watcher solo
+    anota rutas; cada INTERVALO_EVENTOS segundos un hilo las resuelve fuera de la
+    BD (stat de los archivos, escaneo de las carpetas creadas, movidas o borradas)
+    y entrega un único lote con enviar(aplicar_cambios, altas, bajas, carpetas),
+    p. ej. al escritor por lotes del watcher."""
+
+    def __init__(self, enviar):
+        self._enviar = enviar
+        self._pendientes = {}  # ruta -> (wf_id, es carpeta)
+        self._lock = threading.Lock()
+        self._fin = threading.Event()
+        self._hilo = threading.Thread(target=self._bucle, name='plm-indice', daemon=True)
+        self._hilo.start()
+
+    def notificar(self, ruta, wf_id, carpeta=False):
+        if not carpeta and os.path.splitext(ruta)[1].lower() not in EXT_INDICE:
+            return
+        with self._lock:
+            previo = self._pendientes.get(ruta)
+            self._pendientes[ruta] = (wf_id, carpeta or bool(previo and previo[1]))
+
+    def cerrar(self):
+        self._fin.set()
+        self._hilo.join()
+        self._vaciar()
+
+    def _bucle(self):
+        while not self._fin.wait(INTERVALO_EVENTOS):
+            try:
+                self._vaciar()
+            except Exception as e:  # el siguiente rastreo corrige lo que se pierda aquí
+                log.warning(f"Eventos del índice descartados: {e}")
+
+    def _vaciar(self):
+        with self._lock:
+            lote, self._pendientes = self._pendientes, {}
+        if not lote:
+            return
+        altas, bajas, carpetas = [], [], []
+        for ruta, (wf_id, carpeta) in lote.items():
+            if carpeta:
+                errores = []
+                filas = list(escanear(ruta, errores)) if os.path.isdir(ruta) else []
+                carpetas.append((wf_id, normalizar_ruta(ruta), filas, errores))
+                continue
+            fila = fila_archivo(ruta)
+            if fila:
+                altas.append((wf_id, fila))
+            else:
+                bajas.append(normalizar_ruta(ruta))
+        self._enviar(aplicar_cambios, altas, bajas, carpetas)
+
+
+# ── CONSULTA ──────────────────────────────────────────────────────────────────
+
+def _patron_like(q):
+    return '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def buscar_archivos(conn, q='', modo='contiene', registro=None, exts=None, wf_id=None,
+                    cursor=None, limite=POR_PAGINA):
+    """Una página del índice. modo 'prefijo' (el nombre empieza por q) o 'contiene';
+    registro 'si' / 'no' filtra por documento PLM. cursor es el 'siguiente' de la
+    página anterior."""
+    q = (q or '').strip().lower()
+    limite = max(1, min(int(limite or POR_PAGINA), MAX_POR_PAGINA))
+    where, params = [], []
+    if registro == 'si':
+        where.append("a.documento_id IS NOT NULL")
+    elif registro == 'no':
+        where.append("a.documento_id IS NULL")
+    if exts:
+        where.append("a.ext IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(sorted(exts)))
+    if wf_id:
+        where.append("a.wf_id = ?")
+        params.append(int(wf_id))
+
+    por_fts = bool(q) and modo != 'prefijo' and len(q) >= MIN_TRIGRAMA and hay_fts(conn)
+    if por_fts:
+        desde = "plm_archivos_fts f JOIN plm_archivos a ON a.id = f.rowid"
+        where.insert(0, "plm_archivos_fts MATCH ?")
+        params.insert(0, '"' + q.replace('"', '""') + '"')
+        if cursor:
+            where.append("f.rowid > ?")
+            params.append(int(json.loads(cursor)[-1]))
+        orden = "f.rowid"
+    else:
+        desde = "plm_archivos a"
+        if q and modo == 'prefijo':
+            where.append("a.nombre_min >= ? AND a.nombre_min < ?")
+            params += [q, q + '\U0010ffff']
+        elif q:
+            where.append("a.nombre_min LIKE ? ESCAPE '\\'")
+            params.append(_patron_like(q))
+        if cursor:
+            valor, ultimo = json.loads(cursor)
+            where.append("(a.nombre_min, a.id) > (?, ?)")
+            params += [valor, int(ultimo)]
+        orden = "a.nombre_min, a.id"
+
+    filas = [dict(r) for r in conn.execute(f'''SELECT a.id, a.wf_id, a.ruta, a.nombre, a.nombre_min,
+               a.ext, a.tamano, a.mtime_ns, a.documento_id, w.ruta AS wf_ruta,
+               d.codigo AS doc_codigo, d.estado AS doc_estado
+        FROM {desde}
+        JOIN plm_watchfolders w ON w.id = a.wf_id
+        LEFT JOIN plm_documentos d ON d.id = a.documento_id
+        WHERE {' AND '.join(where) or '1=1'}
+        ORDER BY {orden} LIMIT ?''', params + [limite + 1])]
+    siguiente = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente = json.dumps([filas[-1]['id']] if por_fts else [filas[-1]['nombre_min'], filas[-1]['id']])
+    for f in filas:
+        del f['nombre_min']
+    return {'archivos': filas, 'siguiente': siguiente, 'modo': 'contiene' if por_fts else modo}
+
+
+def resumen(conn):
+    """Archivos indexados, registrados y sin registrar: en total, por watch folder
+    y por extensión, con la fecha del último rastreo de cada carpeta."""
+    carpetas = {r['id']: dict(r, total=0, registrados=0) for r in conn.execute('''
+        SELECT w.id, w.ruta, w.activa, c.rastreado, c.segundos, c.errores
+        FROM plm_watchfolders w LEFT JOIN plm_indice_carpetas c ON c.wf_id = w.id ORDER BY w.id''')}
+    extensiones = {}
+    for wf_id, ext, n, registrados in conn.execute(
+            "SELECT wf_id, ext, COUNT(*), COUNT(documento_id) FROM plm_archivos GROUP BY wf_id, ext"):
+        c = carpetas.get(wf_id)
+        if c is None:
+            continue  # watch folder borrada, pendiente del siguiente rastreo
+        e = extensiones.setdefault(ext, {'ext': ext, 'total': 0, 'registrados': 0})
+        for d in (c, e):
+            d['total'] += n
+            d['registrados'] += registrados
+    for d in list(carpetas.values()) + list(extensiones.values()):
+        d['sin_registrar'] = d['total'] - d['registrados']
+    total = sum(c['total'] for c in carpetas.values())
+    registrados = sum(c['registrados'] for c in carpetas.values())
+    return {'total': total, 'registrados': registrados, 'sin_registrar': total - registrados,
+            'carpetas': list(carpetas.values()),
+            'extensiones': sorted(extensiones.values(), key=lambda e: -e['total'])}
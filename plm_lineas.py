@@ -0,0 +1,239 @@
+"""
+PLM Líneas — JA · ERP
+Operaciones en bloque sobre las líneas de una BOM: importación desde Excel/CSV y
+reordenación.
+
+La hoja se lee fila a fila sin cargarla entera: CSV con el módulo csv (codificación
+y separador detectados en el primer bloque) y XLSX con openpyxl en modo read_only.
+La fila de cabecera es la primera que tiene al menos dos columnas reconocibles
+(SINONIMOS); el mapeo detectado se puede corregir a mano. Cada fila se valida y
+todas las válidas se insertan con un único executemany, con las posiciones ya
+calculadas, en una sola transacción.
+"""
+
+import csv
+import io
+import os
+import re
+import unicodedata
+
+from plm_ensamblajes import indice_documentos
+
+try:
+    import openpyxl
+except ImportError:  # sin openpyxl solo se importan CSV
+    openpyxl = None
+
+CAMPOS = ('pos', 'codigo', 'descripcion', 'cantidad', 'unidad', 'material', 'proveedor',
+          'notas', 'documento')
+SINONIMOS = {
+    'pos': ('pos', 'posicion', 'item', 'n', 'no', 'num', 'numero', 'marca'),
+    'codigo': ('codigo', 'referencia', 'ref', 'part number', 'pn', 'p n', 'numero de pieza',
+               'articulo', 'cod'),
+    'descripcion': ('descripcion', 'denominacion', 'designacion', 'nombre', 'description', 'desc'),
+    'cantidad': ('cantidad', 'cant', 'uds', 'unidades', 'qty', 'quantity', 'ctd'),
+    'unidad': ('unidad', 'ud', 'um', 'u m', 'unit', 'uom'),
+    'material': ('material', 'mat'),
+    'proveedor': ('proveedor', 'fabricante', 'supplier', 'vendor'),
+    'notas': ('notas', 'observaciones', 'obs', 'comentarios', 'notes'),
+    'documento': ('documento', 'doc', 'doc cad', 'plano', 'archivo', 'fichero'),
+}
+EXT_HOJA = ('.csv', '.xlsx', '.xlsm')
+PASO_POS = 10
+MAX_FILAS_CABECERA = 20   # filas en las que se busca la cabecera
+MAX_ERRORES = 100         # errores que se devuelven (se cuentan todos)
+FILAS_PREVIA = 20
+BLOQUE_DETECCION = 64 * 1024
+
+_RE_NO_ALNUM = re.compile(r'[^a-z0-9]+')
+
+
+# ── LECTURA ───────────────────────────────────────────────────────────────────
+
+def _normalizar(texto):
+    t = unicodedata.normalize('NFKD', str(texto or '')).encode('ascii', 'ignore').decode()
+    return _RE_NO_ALNUM.sub(' ', t.lower()).strip()
+
+
+_SINONIMO_CAMPO = {s: campo for campo, lista in SINONIMOS.items() for s in lista}
+
+
+def _filas_csv(f):
+    """Filas de un CSV (archivo binario con seek). Codificación y separador se
+    deducen del primer bloque."""
+    muestra = f.read(BLOQUE_DETECCION)
+    f.seek(0)
+    try:
+        muestra.decode('utf-8')
+        codificacion = 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        # un bloque cortado a media secuencia sigue siendo UTF-8
+        codificacion = 'utf-8-sig' if e.start >= len(muestra) - 3 else 'cp1252'
+    texto = muestra.decode(codificacion, errors='replace')
+    try:
+        dialecto = csv.Sniffer().sniff(texto[:8192], delimiters=';,\t|')
+    except csv.Error:  # una sola columna o muestra ambigua: el separador más frecuente
+        separador = max(';,\t|', key=texto.count)
+        dialecto = type('Dialecto', (csv.excel,), {'delimiter': separador})
+    yield from csv.reader(io.TextIOWrapper(f, encoding=codificacion, errors='replace', newline=''),
+                          dialecto)
+
+
+def _filas_xlsx(f):
+    if openpyxl is None:
+        raise RuntimeError("Para importar Excel hace falta openpyxl: pip install openpyxl")
+    libro = openpyxl.load_workbook(f, read_only=True, data_only=True)
+    try:
+        for fila in libro.worksheets[0].iter_rows(values_only=True):
+            yield fila
+    finally:
+        libro.close()
+
+
+def filas_hoja(f, nombre):
+    """Filas (tuplas de celdas) de una hoja CSV o XLSX, en streaming."""
+    ext = '.' + (nombre or '').rsplit('.', 1)[-1].lower()
+    if ext == '.csv':
+        return _filas_csv(f)
+    if ext in ('.xlsx', '.xlsm'):
+        return _filas_xlsx(f)
+    if ext == '.xls':
+        raise ValueError("Formato .xls antiguo: guárdalo como .xlsx o .csv")
+    raise ValueError(f"Formato no soportado ({ext}); usa {', '.join(EXT_HOJA)}")
+
+
+def detectar_mapeo(cabecera):
+    """{campo: índice de columna} a partir de los títulos de la cabecera."""
+    mapeo = {}
+    for i, titulo in enumerate(cabecera):
+        campo = _SINONIMO_CAMPO.get(_normalizar(titulo))
+        if campo and campo not in mapeo:
+            mapeo[campo] = i
+    return mapeo
+
+
+# ── VALIDACIÓN ────────────────────────────────────────────────────────────────
+
+def _texto(v):
+    if v is None:
+        return ''
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)
+    return str(v).strip()
+
+
+def _numero(v):
+    if isinstance(v, (int, float)):
+        return float(v)
+    t = _texto(v).replace(' ', '')
+    if ',' in t and '.' in t:   # 1.234,5 → 1234.5
+        t = t.replace('.', '').replace(',', '.')
+    return float(t.replace(',', '.'))
+
+
+def validar(filas, mapeo, indice):
+    """Recorre las filas de datos y devuelve (líneas válidas, errores, nº de filas).
+    Cada línea es un dict con los campos de plm_bom_lineas (pos puede ser None)."""
+    lineas, errores, n = [], [], 0
+    for num, fila in filas:
+        valores = {c: _texto(fila[i]) if i < len(fila) else '' for c, i in mapeo.items()}
+        if not any(valores.values()):
+            continue
+        n += 1
+        descripcion = valores.get('descripcion') or valores.get('codigo')
+        if not descripcion:
+            errores.append({'fila': num, 'error': 'Sin descripción ni código'})
+            continue
+        try:
+            cantidad = _numero(valores['cantidad']) if valores.get('cantidad') else 1.0
+        except ValueError:
+            errores.append({'fila': num, 'error': f"Cantidad no válida: {valores['cantidad']}"})
+            continue
+        if cantidad <= 0:
+            errores.append({'fila': num, 'error': f"Cantidad no positiva: {valores['cantidad']}"})
+            continue
+        try:
+            pos = int(_numero(valores['pos'])) if valores.get('pos') else None
+        except ValueError:
+            pos = None
+        doc = None
+        for clave in (valores.get('documento'), valores.get('codigo')):
+            if clave and doc is None:
+                clave = clave.lower()
+                doc = indice.get(clave) or indice.get(os.path.splitext(clave)[0])
+        lineas.append({
+            'fila': num, 'pos': pos, 'codigo': valores.get('codigo') or None,
+            'descripcion': descripcion, 'cantidad': cantidad,
+            'unidad': (valores.get('unidad') or 'ud').lower(),
+            'material': valores.get('material') or None,
+            'proveedor': valores.get('proveedor') or None,
+            'notas': valores.get('notas') or None,
+            'documento_id': doc['id'] if doc else None,
+            'doc_codigo': doc['codigo'] if doc else None,
+        })
+    return lineas, errores, n
+
+
+def leer_lineas(conn, f, nombre, mapeo=None):
+    """Cabecera, mapeo y líneas validadas de una hoja. mapeo = {campo: índice} para
+    corregir el detectado."""
+    filas = enumerate(filas_hoja(f, nombre), 1)
+    cabecera, detectado, num_cabecera = None, {}, 0
+    for num, fila in filas:
+        m = detectar_mapeo(fila)
+        if len(m) >= 2 and ('descripcion' in m or 'codigo' in m):
+            cabecera, detectado, num_cabecera = [_texto(c) for c in fila], m, num
+            break
+        if num >= MAX_FILAS_CABECERA:
+            break
+    if cabecera is None:
+        raise ValueError("No se encuentra la fila de cabecera (Código, Descripción, Cantidad...)")
+    if mapeo:
+        detectado = {c: int(i) for c, i in mapeo.items()
+                     if c in CAMPOS and i not in (None, '') and 0 <= int(i) < len(cabecera)}
+    if 'descripcion' not in detectado and 'codigo' not in detectado:
+        raise ValueError("Hay que asignar al menos la columna de descripción o de código")
+    lineas, errores, n = validar(filas, detectado, indice_documentos(conn))
+    return {'cabecera': cabecera, 'fila_cabecera': num_cabecera, 'mapeo': detectado,
+            'lineas': lineas, 'errores': errores, 'filas': n}
+
+
+# ── ESCRITURA ─────────────────────────────────────────────────────────────────
+
+def insertar_lineas(conn, bom_id, lineas, reemplazar=False):
+    """Inserta las líneas con un executemany. Las que no traen posición van detrás de
+    la última (o desde PASO_POS si se reemplaza). Escribe dentro de la transacción
+    del llamador."""
+    if reemplazar:
+        conn.execute("DELETE FROM plm_bom_lineas WHERE bom_id=?", (bom_id,))
+        ultima = 0
+    else:
+        ultima = conn.execute("SELECT COALESCE(MAX(pos), 0) FROM plm_bom_lineas WHERE bom_id=?",
+                              (bom_id,)).fetchone()[0]
+    ultima = max([ultima] + [l['pos'] for l in lineas if l['pos'] is not None])
+    filas = []
+    for l in lineas:
+        pos = l['pos']
+        if pos is None:
+            ultima = pos = ultima - ultima % PASO_POS + PASO_POS
+        filas.append((bom_id, l['documento_id'], pos, l['codigo'], l['descripcion'], l['cantidad'],
+                      l['unidad'], l['material'], l['proveedor'], l['notas']))
+    conn.executemany('''INSERT INTO plm_bom_lineas
+        (bom_id, documento_id, pos, codigo, descripcion, cantidad, unidad, material, proveedor, notas)
+        VALUES (?,?,?,?,?,?,?,?,?,?)''', filas)
+    return len(filas)
+
+
+def reordenar(conn, bom_id, orden=None, paso=PASO_POS):
+    """Renumera las líneas de la BOM (paso, 2·paso, ...). orden = ids de línea en el
+    orden nuevo; las que no aparezcan van detrás en su orden actual. Escribe dentro
+    de la transacción del llamador."""
+    actuales = [r[0] for r in conn.execute(
+        "SELECT id FROM plm_bom_lineas WHERE bom_id=? ORDER BY pos, id", (bom_id,))]
+    existentes = set(actuales)
+    nuevo = list(dict.fromkeys(i for i in (orden or ()) if i in existentes))
+    vistos = set(nuevo)
+    nuevo += [i for i in actuales if i not in vistos]
+    conn.executemany("UPDATE plm_bom_lineas SET pos=? WHERE id=?",
+                     [((k + 1) * paso, i) for k, i in enumerate(nuevo)])
+    return len(nuevo)
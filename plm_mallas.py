@@ -0,0 +1,152 @@
+"""
+PLM Mallas — JA · ERP
+Lectura de mallas STL (binario y ASCII) y OBJ como arrays de triángulos NumPy.
+
+Un STL binario se mapea en memoria sin copiarlo: los triángulos son una vista
+(n, 3, 3) float32 sobre el archivo. Todo lo que trabaja con mallas (metadatos,
+propiedades de masa, miniaturas, similitud) parte de cargar_malla().
+"""
+
+import os
+import re
+
+try:
+    import numpy as np
+    NUMPY_OK = True
+except ImportError:
+    np = None
+    NUMPY_OK = False
+
+EXT_MALLA = ('.stl', '.obj')
+BLOQUE_TRIANGULOS = 1 << 16  # ~4.5 MB en float64: el bloque de trabajo cabe en caché
+
+if NUMPY_OK:
+    # Registro de un triángulo en STL binario: normal, 3 vértices, atributo (50 bytes)
+    STL_DTYPE = np.dtype([('normal', '<f4', (3,)), ('v', '<f4', (3, 3)), ('attr', '<u2')])
+
+_RE_VERTEX = re.compile(rb'vertex\s+(\S+)\s+(\S+)\s+(\S+)')
+_RE_OBJ_V = re.compile(rb'^v\s+(\S+)\s+(\S+)\s+(\S+)', re.M)
+_RE_OBJ_F = re.compile(rb'^f\s+(.+?)\s*$', re.M)
+
+
+def es_stl_binario(ruta):
+    """(binario, n_triangulos). Un STL binario mide exactamente 84 + 50·n bytes
+    (aunque su cabecera empiece por 'solid', como los de SolidWorks)."""
+    tamano = os.path.getsize(ruta)
+    if tamano < 84:
+        return False, 0
+    with open(ruta, 'rb') as f:
+        f.seek(80)
+        n = int.from_bytes(f.read(4), 'little')
+    return tamano == 84 + 50 * n, n
+
+
+def cabecera_stl(ruta):
+    """Texto de la cabecera (binario) o nombre del sólido (ASCII)."""
+    with open(ruta, 'rb') as f:
+        inicio = f.read(256)
+    binario, _ = es_stl_binario(ruta)
+    if binario:
+        texto = inicio[:80]
+    else:
+        texto = inicio.split(b'\n', 1)[0]
+        texto = texto[5:] if texto.lower().startswith(b'solid') else b''
+    return texto.split(b'\0', 1)[0].decode('latin-1').strip()
+
+
+def cargar_stl(ruta):
+    """Triángulos (n, 3, 3). Mapeado en memoria si es binario."""
+    binario, n = es_stl_binario(ruta)
+    if binario:
+        if n == 0:
+            return np.zeros((0, 3, 3), dtype=np.float32)
+        return np.memmap(ruta, dtype=STL_DTYPE, mode='r', offset=84, shape=(n,))['v']
+    with open(ruta, 'rb') as f:
+        datos = f.read()
+    v = np.array(_RE_VERTEX.findall(datos), dtype=np.float64)
+    return v[: len(v) // 3 * 3].reshape(-1, 3, 3)
+
+
+def cargar_obj(ruta):
+    """Triángulos (n, 3, 3) de un OBJ; los polígonos se triangulan en abanico."""
+    with open(ruta, 'rb') as f:
+        datos = f.read()
+    vertices = np.array(_RE_OBJ_V.findall(datos), dtype=np.float64).reshape(-1, 3)
+    nv = len(vertices)
+    caras = []
+    for linea in _RE_OBJ_F.findall(datos):
+        idx = []
+        for token in linea.split():
+            i = int(token.split(b'/', 1)[0])
+            idx.append(i - 1 if i > 0 else nv + i)  # índices negativos: relativos al final
+        for k in range(1, len(idx) - 1):
+            caras.append((idx[0], idx[k], idx[k + 1]))
+    if not caras:
+        return np.zeros((0, 3, 3), dtype=np.float64)
+    return vertices[np.array(caras, dtype=np.int64)]
+
+
+def cargar_malla(ruta, ext=None):
+    """Triángulos (n, 3, 3) de un STL u OBJ. Requiere NumPy."""
+    if not NUMPY_OK:
+        raise RuntimeError("NumPy no está instalado: pip install numpy")
+    ext = (ext or os.path.splitext(ruta)[1]).lower()
+    if ext == '.stl':
+        return cargar_stl(ruta)
+    if ext == '.obj':
+        return cargar_obj(ruta)
+    raise ValueError(f"Formato de malla no soportado: {ext}")
+
+
+def caja_envolvente(tris):
+    """(mínimo, máximo) de los vértices, sin copiar la malla."""
+    if len(tris) == 0:
+        return None, None
+    return tris.min(axis=(0, 1)).astype(float), tris.max(axis=(0, 1)).astype(float)
+
+
+def propiedades_masa(tris):
+    """Volumen, área, caja envolvente y centro de masas de una malla cerrada, en
+    las unidades del archivo.
+
+    El volumen es la suma de los tetraedros (origen, a, b, c) con signo, tomando
+    el primer vértice como origen para no perder precisión lejos del cero (con
+    normales hacia dentro sale negativo: se devuelve en valor absoluto). Se
+    recorre por bloques que caben en caché, copiados a float64 y en columnas
+    (vértice, eje, triángulo) para que cada operación sea un vector contiguo."""
+    n = len(tris)
+    if n == 0:
+        return {'triangulos': 0, 'volumen': 0.0, 'area': 0.0,
+                'bbox_min': None, 'bbox_max': None, 'centro_masa': None}
+    origen = np.asarray(tris[0, 0], dtype=np.float64)
+    v6_total, area2 = 0.0, 0.0
+    momento = np.zeros(3)
+    minimo = np.full(3, np.inf)
+    maximo = np.full(3, -np.inf)
+    buf = np.empty((3, 3, min(BLOQUE_TRIANGULOS, n)))
+    for i in range(0, n, BLOQUE_TRIANGULOS):
+        bloque = tris[i:i + BLOQUE_TRIANGULOS]
+        t = buf[:, :, :len(bloque)]
+        t[...] = bloque.transpose(1, 2, 0)
+        minimo = np.minimum(minimo, t.min(axis=(0, 2)))
+        maximo = np.maximum(maximo, t.max(axis=(0, 2)))
+        t -= origen[None, :, None]
+        (ax, ay, az), (bx, by, bz), (cx, cy, cz) = t
+        # 6 · volumen con signo: a · (b × c); su centroide es (a + b + c) / 4
+        v6 = ax * (by * cz - bz * cy) + ay * (bz * cx - bx * cz) + az * (bx * cy - by * cx)
+        v6_total += v6.sum()
+        momento += (v6 @ (ax + bx + cx), v6 @ (ay + by + cy), v6 @ (az + bz + cz))
+        # 2 · área: |(b - a) × (c - a)|
+        ux, uy, uz = bx - ax, by - ay, bz - az
+        wx, wy, wz = cx - ax, cy - ay, cz - az
+        nx, ny, nz = uy * wz - uz * wy, uz * wx - ux * wz, ux * wy - uy * wx
+        area2 += np.sqrt(nx * nx + ny * ny + nz * nz).sum()
+    centro = origen + momento / (4.0 * v6_total) if v6_total else None
+    return {
+        'triangulos': n,
+        'volumen': float(abs(v6_total) / 6.0),
+        'area': float(area2 / 2.0),
+        'bbox_min': minimo.tolist(),
+        'bbox_max': maximo.tolist(),
+        'centro_masa': centro.tolist() if centro is not None else None,
+    }
@@ -0,0 +1,348 @@
+"""
+PLM Metadatos — JA · ERP
+Extracción de metadatos de archivos CAD en la ingesta (watcher, sync, registro).
+
+- STEP: sección HEADER (FILE_NAME, FILE_DESCRIPTION, FILE_SCHEMA). Solo se leen
+  los primeros bloques del archivo, hasta el ENDSEC de la cabecera.
+- DXF: variables de la sección HEADER ($ACADVER, $INSUNITS, $EXTMIN...). Se lee
+  línea a línea y se para al acabar la cabecera.
+- STL/OBJ: triángulos, caja envolvente, volumen, área y centro de masas (STL
+  binario mapeado en memoria, ver plm_mallas.propiedades_masa).
+
+Los resultados se guardan en plm_metadatos por hash_b2: un mismo contenido no se
+vuelve a analizar nunca, esté en el documento que esté.
+"""
+
+import os
+import json
+from datetime import datetime, timezone
+
+from plm_core import ruta_vault
+from plm_mallas import NUMPY_OK, es_stl_binario, cabecera_stl, cargar_malla, propiedades_masa
+
+STEP_BLOQUE = 64 * 1024
+STEP_MAX_CABECERA = 4 * 1024 * 1024  # una cabecera más larga se da por corrupta
+LOTE_BD = 200
+
+
+# ── STEP ──────────────────────────────────────────────────────────────────────
+
+def _decodificar_step(s):
+    """Cadenas STEP (ISO 10303-21): \\X2\\hhhh\\X0\\ (UTF-16), \\X\\hh y \\S\\c."""
+    out, i = [], 0
+    while i < len(s):
+        if s.startswith('\\X2\\', i):
+            fin = s.find('\\X0\\', i + 4)
+            if fin < 0:
+                break
+            hexa = s[i + 4:fin]
+            out.append(''.join(chr(int(hexa[k:k + 4], 16)) for k in range(0, len(hexa) - 3, 4)))
+            i = fin + 4
+        elif s.startswith('\\X\\', i) and i + 5 <= len(s):
+            out.append(chr(int(s[i + 3:i + 5], 16)))
+            i += 5
+        elif s.startswith('\\S\\', i) and i + 4 <= len(s):
+            out.append(chr(ord(s[i + 3]) + 128))
+            i += 4
+        else:
+            out.append(s[i])
+            i += 1
+    return ''.join(out)
+
+
+def parametros_step(texto, i=0):
+    """Parsea una lista de parámetros STEP que empieza en texto[i] == '('.
+    Devuelve (lista, posición tras el ')')."""
+    assert texto[i] == '('
+    i += 1
+    valores, actual = [], None
+    while i < len(texto):
+        c = texto[i]
+        if c == "'":
+            j, partes = i + 1, []
+            while j < len(texto):
+                if texto[j] == "'":
+                    if texto[j + 1:j + 2] == "'":
+                        partes.append("'")
+                        j += 2
+                        continue
+                    break
+                partes.append(texto[j])
+                j += 1
+            actual = _decodificar_step(''.join(partes))
+            i = j + 1
+        elif c == '(':
+            actual, i = parametros_step(texto, i)
+        elif c in ',)':
+            valores.append(actual)
+            actual = None
+            i += 1
+            if c == ')':
+                return valores, i
+        elif c in ' \r\n\t':
+            i += 1
+        else:
+            j = i
+            while j < len(texto) and texto[j] not in ',()':
+                j += 1
+            token = texto[i:j].strip()
+            actual = None if token in ('$', '*') else token
+            i = j
+    return valores, i
+
+
+def _cabecera_step(ruta):
+    """Texto entre HEADER; y ENDSEC; leyendo solo lo necesario."""
+    datos = b''
+    with open(ruta, 'rb') as f:
+        while len(datos) < STEP_MAX_CABECERA:
+            bloque = f.read(STEP_BLOQUE)
+            if not bloque:
+                break
+            datos += bloque
+            ini = datos.find(b'HEADER;')
+            if ini >= 0 and datos.find(b'ENDSEC;', ini) >= 0:
+                break
+    ini = datos.find(b'HEADER;')
+    fin = datos.find(b'ENDSEC;', ini)
+    if ini < 0 or fin < 0:
+        raise ValueError("Sin sección HEADER")
+    return datos[ini + 7:fin].decode('latin-1')
+
+
+def leer_step(ruta):
+    cabecera = _cabecera_step(ruta)
+    entidades = {}
+    i = 0
+    while i < len(cabecera):
+        par = cabecera.find('(', i)
+        if par < 0:
+            break
+        nombre = cabecera[i:par].strip().upper()
+        params, i = parametros_step(cabecera, par)
+        entidades[nombre] = params
+        fin = cabecera.find(';', i)
+        i = len(cabecera) if fin < 0 else fin + 1
+
+    def primero(v):
+        if isinstance(v, list):
+            v = next((x for x in v if x), None)
+        return v or None
+
+    fn = entidades.get('FILE_NAME', []) + [None] * 7
+    desc = entidades.get('FILE_DESCRIPTION', []) + [None] * 2
+    esquema = entidades.get('FILE_SCHEMA', [None])
+    return {
+        'formato': 'step',
+        'nombre_archivo': fn[0],
+        'fecha': fn[1],
+        'autor': primero(fn[2]),
+        'organizacion': primero(fn[3]),
+        'preprocesador': fn[4],
+        'sistema': fn[5],
+        'autorizacion': fn[6],
+        'descripcion': primero(desc[0]),
+        'nivel_implementacion': desc[1],
+        'esquema': primero(esquema[0]),
+    }
+
+
+# ── DXF ───────────────────────────────────────────────────────────────────────
+
+VERSIONES_DXF = {
+    'AC1009': 'R12', 'AC1012': 'R13', 'AC1014': 'R14', 'AC1015': '2000',
+    'AC1018': '2004', 'AC1021': '2007', 'AC1024': '2010', 'AC1027': '2013',
+    'AC1032': '2018',
+}
+UNIDADES_DXF = {0: None, 1: 'in', 2: 'ft', 4: 'mm', 5: 'cm', 6: 'm'}
+VARIABLES_DXF = {'$ACADVER', '$INSUNITS', '$MEASUREMENT', '$EXTMIN', '$EXTMAX',
+                 '$LASTSAVEDBY', '$TDCREATE', '$TDUPDATE', '$DWGCODEPAGE', '$PROJECTNAME'}
+
+
+def _fecha_juliana(valor):
+    try:
+        segundos = (float(valor) - 2440587.5) * 86400
+        return datetime.fromtimestamp(segundos, timezone.utc).strftime('%Y-%m-%d %H:%M')
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+
+
+def variables_dxf(ruta):
+    """{variable: valor | [valores]} de la sección HEADER, sin leer el resto."""
+    with open(ruta, 'rb') as f:
+        if f.read(18) == b'AutoCAD Binary DXF':
+            raise ValueError("DXF binario no soportado")
+    variables, actual, en_cabecera = {}, None, False
+    with open(ruta, 'r', encoding='latin-1', errors='replace') as f:
+        while True:
+            codigo, valor = f.readline(), f.readline()
+            if not valor:
+                break
+            codigo, valor = codigo.strip(), valor.strip()
+            if codigo == '0':
+                if valor == 'ENDSEC' and en_cabecera:
+                    break
+                continue
+            if codigo == '2' and valor == 'HEADER':
+                en_cabecera = True
+                continue
+            if not en_cabecera:
+                continue
+            if codigo == '9':
+                actual = valor if valor in VARIABLES_DXF else None
+            elif actual:
+                if actual in variables:
+                    if not isinstance(variables[actual], list):
+                        variables[actual] = [variables[actual]]
+                    variables[actual].append(valor)
+                else:
+                    variables[actual] = valor
+    return variables
+
+
+def leer_dxf(ruta):
+    v = variables_dxf(ruta)
+
+    def punto(nombre):
+        p = v.get(nombre)
+        try:
+            return [float(x) for x in p] if isinstance(p, list) else None
+        except ValueError:
+            return None
+
+    try:
+        unidades = UNIDADES_DXF.get(int(v.get('$INSUNITS', 0)))
+    except ValueError:
+        unidades = None
+    version = v.get('$ACADVER')
+    datos = {
+        'formato': 'dxf',
+        'version': version,
+        'sistema': f"AutoCAD {VERSIONES_DXF.get(version, version)}" if version else None,
+        'autor': v.get('$LASTSAVEDBY'),
+        'unidades': unidades,
+        'creado': _fecha_juliana(v.get('$TDCREATE')),
+        'actualizado': _fecha_juliana(v.get('$TDUPDATE')),
+        'codepage': v.get('$DWGCODEPAGE'),
+        'proyecto': v.get('$PROJECTNAME'),
+    }
+    extmin, extmax = punto('$EXTMIN'), punto('$EXTMAX')
+    if extmin and extmax and len(extmin) == len(extmax):
+        datos['bbox_min'], datos['bbox_max'] = extmin, extmax
+    return datos
+
+
+# ── MALLAS ────────────────────────────────────────────────────────────────────
+
+def leer_malla(ruta, ext):
+    datos = {'formato': ext.lstrip('.')}
+    if ext == '.stl':
+        binario, n = es_stl_binario(ruta)
+        datos['codificacion'] = 'binario' if binario else 'ascii'
+        datos['nombre_archivo'] = cabecera_stl(ruta) or None
+        if binario:
+            datos['triangulos'] = n
+    if not NUMPY_OK:
+        return datos
+    tris = cargar_malla(ruta, ext)
+    datos.update((k, v) for k, v in propiedades_masa(tris).items() if v is not None)
+    del tris  # libera el mapeo del archivo cuanto antes
+    return datos
+
+
+# ── API ───────────────────────────────────────────────────────────────────────
+
+EXTRACTORES = {
+    '.step': lambda ruta, ext: leer_step(ruta),
+    '.stp': lambda ruta, ext: leer_step(ruta),
+    '.dxf': lambda ruta, ext: leer_dxf(ruta),
+    '.stl': leer_malla,
+    '.obj': leer_malla,
+}
+
+
+def extraer(ruta, ext):
+    """Metadatos de un archivo, o None si su formato no tiene extractor.
+    Un archivo ilegible devuelve {'formato', 'error'} (también se guarda, para
+    no reintentarlo con el mismo contenido)."""
+    ext = ext.lower()
+    fn = EXTRACTORES.get(ext)
+    if fn is None:
+        return None
+    try:
+        return fn(ruta, ext)
+    except Exception as e:
+        return {'formato': ext.lstrip('.'), 'error': str(e)[:300]}
+
+
+def hashes_sin_metadatos(conn, hashes):
+    """Los hashes (de la lista) que aún no tienen fila en plm_metadatos."""
+    hashes = list(set(h for h in hashes if h))
+    if not hashes:
+        return set()
+    hechos = {r[0] for r in conn.execute(
+        "SELECT hash_b2 FROM plm_metadatos WHERE hash_b2 IN (SELECT value FROM json_each(?))",
+        (json.dumps(hashes),))}
+    return set(hashes) - hechos
+
+
+def guardar_metadatos(conn, filas):
+    """Guarda [(hash_b2, datos)] en plm_metadatos (los campos habituales en
+    columnas para buscar; todo en datos como JSON)."""
+    registros = []
+    for h, d in filas:
+        if not d:
+            continue
+        minimo, maximo = d.get('bbox_min'), d.get('bbox_max')
+        dims = [b - a for a, b in zip(minimo, maximo)] + [None] * 3 if minimo and maximo else [None] * 3
+        registros.append((h, d.get('formato'), d.get('autor'), d.get('organizacion'),
+                          d.get('sistema'), d.get('esquema'), d.get('nombre_archivo'),
+                          d.get('triangulos'), dims[0], dims[1], dims[2],
+                          d.get('volumen'), d.get('area'),
+                          json.dumps(d, ensure_ascii=False), d.get('error')))
+    conn.executemany(
+        '''INSERT OR IGNORE INTO plm_metadatos
+           (hash_b2, formato, autor, organizacion, sistema, esquema, nombre_archivo,
+            triangulos, dim_x, dim_y, dim_z, volumen, area, datos, error)
+           VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', registros)
+
+
+def metadatos_documento(conn, doc):
+    """Diccionario de metadatos del contenido actual de un documento (o None)."""
+    if not doc or not doc['hash_b2']:
+        return None
+    row = conn.execute("SELECT datos FROM plm_metadatos WHERE hash_b2=?",
+                       (doc['hash_b2'],)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def rellenar(conn, observador=None):
+    """Analiza los documentos cuyo contenido actual aún no tiene metadatos (p. ej.
+    los que entraron antes de existir esta tabla). Devuelve {'analizados', 'errores'}."""
+    docs = conn.execute('''SELECT d.hash_b2, d.archivo_vault, d.ruta_origen FROM plm_documentos d
+        WHERE d.hash_b2 IS NOT NULL AND d.archivo_vault IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM plm_metadatos m WHERE m.hash_b2 = d.hash_b2)
+        GROUP BY d.hash_b2''').fetchall()
+    pendientes = []
+    for d in docs:
+        ext = os.path.splitext(d['ruta_origen'] or d['archivo_vault'])[1].lower()
+        if ext in EXTRACTORES:
+            pendientes.append((d['hash_b2'], ruta_vault(d['archivo_vault']), ext))
+    avance = {'estado': 'extrayendo', 'total': len(pendientes), 'analizados': 0, 'errores': 0}
+    filas = []
+    for h, ruta, ext in pendientes:
+        if not os.path.isfile(ruta):
+            avance['errores'] += 1
+            continue
+        datos = extraer(ruta, ext)
+        filas.append((h, datos))
+        avance['analizados'] += 1
+        if len(filas) >= LOTE_BD:
+            with conn:
+                guardar_metadatos(conn, filas)
+            filas = []
+        if observador is not None:
+            observador(dict(avance))
+    with conn:
+        guardar_metadatos(conn, filas)
+    return {'analizados': avance['analizados'], 'errores': avance['errores']}
@@ -0,0 +1,297 @@
+"""
+PLM Miniaturas — JA · ERP
+Vistas previas sombreadas de mallas STL/OBJ, rasterizadas en NumPy (sin GPU).
+
+    malla ─► vista isométrica ─► diezmado por rejilla ─► rasterizado con z-buffer ─► PNG
+
+La malla se proyecta en ortográfica desde la esquina (+X, −Y, +Z) con Z arriba,
+como la vista isométrica de los programas CAD. Antes de rasterizar se diezma
+agrupando vértices en celdas de CELDA_DIEZMADO píxeles de render (vertex
+clustering): los triángulos que quedan dentro de una celda no se verían y una
+malla de millones de triángulos se queda en unas decenas de miles.
+
+El rasterizado es por lotes: los triángulos se agrupan por tamaño de su caja en
+píxeles (potencias de 2) y cada lote evalúa sus funciones de borde sobre una
+rejilla k×k común. Se renderiza a SUPERMUESTREO× y se promedia (antialiasing y
+canal alfa). Las miniaturas se guardan en plm_vault/miniaturas por hash de
+contenido y se generan en un pool en segundo plano.
+"""
+
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from plm_core import VAULT_DIR, ruta_vault, blob_relativo, calc_hash
+from plm_mallas import NUMPY_OK, np, cargar_malla, BLOQUE_TRIANGULOS
+
+MINIATURAS_DIR = os.path.join(VAULT_DIR, 'miniaturas')
+TAM_MINIATURA = 160          # píxeles de lado del PNG
+SUPERMUESTREO = 2            # se renderiza a TAM·SUPERMUESTREO y se promedia
+MARGEN = 0.06                # fracción libre en cada borde
+MAX_TRIANGULOS = 60_000      # por encima se diezma
+CELDA_DIEZMADO = 2           # lado de la celda de diezmado, en píxeles de render
+MAX_FRAGMENTOS = 1 << 21     # píxeles candidatos por lote del rasterizador
+PRESUPUESTO_FRAGMENTOS = 1 << 24  # por render; agotado, se omiten los triángulos más pequeños
+COLOR_BASE = (176, 190, 205)
+LUZ_AMBIENTE = 0.22
+MINIATURA_WORKERS = 2
+
+_pool = ThreadPoolExecutor(max_workers=MINIATURA_WORKERS, thread_name_prefix='plm-thumb')
+_en_curso = {}  # hash_b2 -> Future
+_lock = threading.RLock()  # add_done_callback puede ejecutarse dentro del lock
+
+
+# ── VISTA ─────────────────────────────────────────────────────────────────────
+
+def _ejes_vista():
+    """Matriz 3×3 mundo → vista (x derecha, y arriba, z hacia la cámara)."""
+    camara = np.array([1.0, -1.0, 1.0]) / np.sqrt(3.0)
+    derecha = np.cross(-camara, [0.0, 0.0, 1.0])
+    derecha /= np.linalg.norm(derecha)
+    arriba = np.cross(derecha, -camara)
+    return np.stack([derecha, arriba, camara])
+
+
+def _bloques_vista(tris, ejes):
+    """Bloques de vértices (3·n, 3) en coordenadas de vista float64 (un solo
+    producto de matrices por bloque, no n productos de 3×3)."""
+    for i in range(0, len(tris), BLOQUE_TRIANGULOS):
+        bloque = np.asarray(tris[i:i + BLOQUE_TRIANGULOS], dtype=np.float64)
+        yield bloque.reshape(-1, 3) @ ejes.T
+
+
+# ── DIEZMADO ──────────────────────────────────────────────────────────────────
+
+def diezmar(tris, ejes, minimo, maximo, celda):
+    """Vertex clustering (Rossignac-Borrel): los vértices de cada celda cúbica de
+    lado `celda` se sustituyen por su media y se descartan los triángulos
+    degenerados y los repetidos. Por bloques: solo se acumulan las celdas
+    ocupadas y los triángulos que sobreviven."""
+    dim = np.floor((maximo - minimo) / celda).astype(np.int64) + 1
+    celdas, sumas, cuentas, caras = [], [], [], []
+    for v in _bloques_vista(tris, ejes):
+        q = np.minimum(np.floor((v - minimo) / celda).astype(np.int64), dim - 1)
+        ids = (q[:, 0] * dim[1] + q[:, 1]) * dim[2] + q[:, 2]
+        u, inv = np.unique(ids, return_inverse=True)
+        celdas.append(u)
+        sumas.append(np.stack([np.bincount(inv, v[:, j], len(u)) for j in range(3)], axis=1))
+        cuentas.append(np.bincount(inv, minlength=len(u)))
+        ids = ids.reshape(-1, 3)  # (n, 3): celda de cada vértice del triángulo
+        validos = (ids[:, 0] != ids[:, 1]) & (ids[:, 1] != ids[:, 2]) & (ids[:, 0] != ids[:, 2])
+        # El orden de los vértices no importa para el sombreado (se usa |normal|)
+        caras.append(np.unique(np.sort(ids[validos], axis=1), axis=0))
+    u, inv = np.unique(np.concatenate(celdas), return_inverse=True)
+    suma = np.stack([np.bincount(inv, c, len(u)) for c in np.concatenate(sumas).T], axis=1)
+    media = suma / np.bincount(inv, np.concatenate(cuentas), len(u))[:, None]
+    caras = np.unique(np.concatenate(caras), axis=0)
+    return media[np.searchsorted(u, caras)]
+
+
+# ── RASTERIZADO ───────────────────────────────────────────────────────────────
+
+def _luces(v):
+    """Intensidad por triángulo (Lambert a dos caras con luz desde arriba-izquierda)."""
+    n = np.cross(v[:, 1] - v[:, 0], v[:, 2] - v[:, 0])
+    norma = np.linalg.norm(n, axis=1)
+    norma[norma == 0] = 1.0
+    luz = np.array([-0.5, 0.8, 0.5])
+    luz /= np.linalg.norm(luz)
+    return LUZ_AMBIENTE + (1 - LUZ_AMBIENTE) * np.abs(n @ luz) / norma
+
+
+def rasterizar(v, intensidad, lado):
+    """(intensidad, cubierto) de lado×lado para triángulos ya en píxeles:
+    v[..., 0:2] columna/fila, v[..., 2] profundidad (mayor = más cerca) y una
+    intensidad por triángulo."""
+    zbuf = np.full(lado * lado, -np.inf)
+    color = np.zeros(lado * lado)
+    x, y, z = v[..., 0], v[..., 1], v[..., 2]
+    x0 = np.floor(x.min(axis=1)).astype(np.int64)
+    y0 = np.floor(y.min(axis=1)).astype(np.int64)
+    # Lado de la rejilla de cada triángulo, redondeado a potencia de 2 por eje
+    kx = 1 << np.ceil(np.log2(np.ceil(x.max(axis=1)).astype(np.int64) - x0 + 1)).astype(np.int64)
+    ky = 1 << np.ceil(np.log2(np.ceil(y.max(axis=1)).astype(np.int64) - y0 + 1)).astype(np.int64)
+    lote = kx * (lado * 4) + ky
+    area = ((x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0])
+            - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0]))
+    visibles = np.abs(area) > 1e-12
+    # El trabajo de cada triángulo es su rejilla (kx·ky), no su área: con muchos
+    # triángulos grandes solapados se acota, dando prioridad a los que más tapan.
+    coste = np.where(visibles, kx * ky, 0)
+    if coste.sum() > PRESUPUESTO_FRAGMENTOS:
+        orden = np.argsort(-np.abs(area))
+        visibles[orden[np.cumsum(coste[orden]) > PRESUPUESTO_FRAGMENTOS]] = False
+
+    for clave in np.unique(lote[visibles]):
+        sel = np.nonzero(visibles & (lote == clave))[0]
+        ancho, alto = divmod(int(clave), lado * 4)
+        oy, ox = np.divmod(np.arange(ancho * alto), ancho)
+        paso = max(1, MAX_FRAGMENTOS // (ancho * alto))
+        for i in range(0, len(sel), paso):
+            t = sel[i:i + paso]
+            px = x0[t, None] + ox + 0.5
+            py = y0[t, None] + oy + 0.5
+            tx, ty, a = x[t], y[t], area[t, None]
+            # Coordenadas baricéntricas por funciones de borde (normalizadas por el área)
+            w0 = ((tx[:, 1, None] - px) * (ty[:, 2, None] - py)
+                  - (tx[:, 2, None] - px) * (ty[:, 1, None] - py)) / a
+            w1 = ((tx[:, 2, None] - px) * (ty[:, 0, None] - py)
+                  - (tx[:, 0, None] - px) * (ty[:, 2, None] - py)) / a
+            w2 = 1.0 - w0 - w1
+            dentro = ((w0 >= 0) & (w1 >= 0) & (w2 >= 0)
+                      & (px >= 0) & (px < lado) & (py >= 0) & (py < lado))
+            fila, col = np.nonzero(dentro)
+            if not len(fila):
+                continue
+            pix = (py[fila, col].astype(np.int64) * lado + px[fila, col].astype(np.int64))
+            prof = (w0[fila, col] * z[t[fila], 0] + w1[fila, col] * z[t[fila], 1]
+                    + w2[fila, col] * z[t[fila], 2])
+            # z-buffer del lote: el fragmento más cercano de cada píxel
+            orden = np.lexsort((-prof, pix))
+            pix, prof, fila = pix[orden], prof[orden], fila[orden]
+            primero = np.ones(len(pix), dtype=bool)
+            primero[1:] = pix[1:] != pix[:-1]
+            pix, prof, fila = pix[primero], prof[primero], fila[primero]
+            gana = prof > zbuf[pix]
+            pix = pix[gana]
+            zbuf[pix] = prof[gana]
+            color[pix] = intensidad[t[fila[gana]]]
+    return color.reshape(lado, lado), np.isfinite(zbuf).reshape(lado, lado)
+
+
+def renderizar(tris, tam=TAM_MINIATURA):
+    """Imagen RGBA (tam, tam, 4) uint8 de una malla (n, 3, 3)."""
+    if not NUMPY_OK:
+        raise RuntimeError("NumPy no está instalado: pip install numpy")
+    if len(tris) == 0:
+        raise ValueError("La malla no tiene triángulos")
+    lado = tam * SUPERMUESTREO
+    ejes = _ejes_vista()
+    minimo, maximo = np.full(3, np.inf), np.full(3, -np.inf)
+    for v in _bloques_vista(tris, ejes):
+        minimo = np.minimum(minimo, v.min(axis=0))
+        maximo = np.maximum(maximo, v.max(axis=0))
+    extension = float(max(maximo[0] - minimo[0], maximo[1] - minimo[1])) or 1.0
+    escala = lado * (1 - 2 * MARGEN) / extension
+    if len(tris) > MAX_TRIANGULOS:
+        v = diezmar(tris, ejes, minimo, maximo, CELDA_DIEZMADO / escala)
+    else:
+        v = np.concatenate(list(_bloques_vista(tris, ejes))).reshape(-1, 3, 3)
+
+    centro = (minimo + maximo) / 2
+    p = np.empty_like(v)
+    p[..., 0] = (v[..., 0] - centro[0]) * escala + lado / 2
+    p[..., 1] = lado / 2 - (v[..., 1] - centro[1]) * escala
+    p[..., 2] = v[..., 2]
+    color, cubierto = rasterizar(p, _luces(v), lado)
+
+    s = SUPERMUESTREO
+    cobertura = cubierto.reshape(tam, s, tam, s).sum(axis=(1, 3))
+    suma = (color * cubierto).reshape(tam, s, tam, s).sum(axis=(1, 3))
+    media = suma / np.maximum(cobertura, 1)
+    img = np.empty((tam, tam, 4), dtype=np.uint8)
+    img[..., :3] = np.clip(media[..., None] * np.array(COLOR_BASE), 0, 255)
+    img[..., 3] = cobertura * 255 // (s * s)
+    return img
+
+
+def png(img):
+    """Codifica una imagen RGBA uint8 como PNG (sin dependencias)."""
+    alto, ancho = img.shape[:2]
+    filas = np.zeros((alto, ancho * 4 + 1), dtype=np.uint8)  # byte de filtro 0 por fila
+    filas[:, 1:] = img.reshape(alto, -1)
+
+    def bloque(tipo, datos):
+        return (struct.pack('>I', len(datos)) + tipo + datos
+                + struct.pack('>I', zlib.crc32(tipo + datos) & 0xffffffff))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + bloque(b'IHDR', struct.pack('>IIBBBBB', ancho, alto, 8, 6, 0, 0, 0))
+            + bloque(b'IDAT', zlib.compress(filas.tobytes(), 6))
+            + bloque(b'IEND', b''))
+
+
+# ── CACHÉ Y POOL ──────────────────────────────────────────────────────────────
+
+def ruta_miniatura(hash_b2):
+    return os.path.join(MINIATURAS_DIR, hash_b2[:2], hash_b2 + '.png')
+
+
+def ruta_fallo(hash_b2):
+    """Marca de un contenido que no se pudo renderizar: depende solo del
+    contenido, así que no se vuelve a intentar."""
+    return os.path.join(MINIATURAS_DIR, hash_b2[:2], hash_b2 + '.error')
+
+
+def fallo_miniatura(hash_b2):
+    """Mensaje del fallo guardado para hash_b2, o None."""
+    try:
+        with open(ruta_fallo(hash_b2), encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _guardar(destino, datos):
+    carpeta = os.path.dirname(destino)
+    os.makedirs(carpeta, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=carpeta, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(datos)
+        os.replace(tmp, destino)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def generar(hash_b2, ruta, ext=None):
+    """Renderiza la malla de `ruta` y guarda el PNG de su hash. Devuelve la ruta.
+
+    Si `ruta` es un archivo de trabajo (no el blob del vault) se vuelve a hashear
+    al terminar: si cambió entretanto, la imagen no es la de hash_b2 y se
+    descarta. Los errores de E/S se reintentan en la próxima petición; los del
+    contenido (malla ilegible) quedan en ruta_fallo."""
+    destino = ruta_miniatura(hash_b2)
+    if os.path.exists(destino):
+        return destino
+    fallo = fallo_miniatura(hash_b2)
+    if fallo is not None:
+        raise ValueError(fallo)
+    try:
+        img, error = renderizar(cargar_malla(ruta, ext)), None
+    except (OSError, RuntimeError, MemoryError):
+        raise
+    except Exception as e:
+        img, error = None, e
+    en_vault = os.path.abspath(ruta) == ruta_vault(blob_relativo(hash_b2))
+    if not en_vault and calc_hash(ruta) != hash_b2:
+        raise OSError(f"El archivo cambió mientras se renderizaba: {ruta}")
+    if error is not None:
+        _guardar(ruta_fallo(hash_b2), (str(error) or type(error).__name__).encode('utf-8'))
+        raise error
+    _guardar(destino, png(img))
+    return destino
+
+
+def solicitar(hash_b2, ruta, ext=None):
+    """Future con la ruta del PNG. Si ya está en caché sale resuelto; si ya se
+    está generando se devuelve el mismo future (una sola generación por hash)."""
+    with _lock:
+        fut = _en_curso.get(hash_b2)
+        if fut is None:
+            fut = _pool.submit(generar, hash_b2, ruta, ext)
+            _en_curso[hash_b2] = fut
+            fut.add_done_callback(lambda _: _olvidar(hash_b2))
+    return fut
+
+
+def _olvidar(hash_b2):
+    with _lock:
+        _en_curso.pop(hash_b2, None)
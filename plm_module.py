@@ -3,9 +3,29 @@ PLM Module — JA · ERP
 Gestión de: Documentos CAD, BOM, Revisiones/Estados
 """
 
-import sqlite3, os, json, hashlib, shutil
+import sqlite3, os, json, math
 from datetime import datetime, date
 from flask import Blueprint, render_template, request, jsonify, redirect, url_for, send_file
+from plm_core import (normalizar_ruta, asegurar_esquema, buscar_doc_por_ruta,
+                      referenciar_blob, blob_relativo, abrir_vault)
+from plm_sync import sincronizar
+from plm_compactar import compactar
+from plm_metadatos import metadatos_documento, rellenar as rellenar_metadatos
+from plm_costes import (asegurar_costes, propiedades_documento, estimaciones,
+                        adjuntar_a_presupuesto, PROCESOS, UNIDADES_MM, PRESUPUESTO_EDITABLE)
+from plm_corte import asegurar_corte, corte_documento, es_dxf
+from plm_similitud import (asegurar_similitud, similares, pendientes as similitud_pendientes,
+                           indexar as indexar_similitud)
+from plm_ensamblajes import asegurar_ensamblajes, es_step, importar_bom
+from plm_explosion import asegurar_explosion, explosion, donde_se_usa
+from plm_diferencias import asegurar_diferencias, guardar_foto, diferencias, ESTADOS_FOTO
+from plm_escandallo import asegurar_escandallo, escandallo, guardar_precio, clave_componente
+from plm_auditoria import asegurar_auditoria, registrar_db, Registro, consultar, historial
+from plm_busqueda import asegurar_busqueda, buscar, FACETAS
+from plm_indice import asegurar_indice, rastrear as rastrear_indice
+from plm_lineas import (leer_lineas, insertar_lineas, reordenar, CAMPOS as CAMPOS_LINEA,
+                        MAX_ERRORES, FILAS_PREVIA)
+from trabajos import encolar, tarea
 
 plm = Blueprint('plm', __name__)
 
@@ -35,8 +55,10 @@ def init_plm_db():
         descripcion TEXT,
         estado TEXT DEFAULT 'en_diseno',  -- en_diseno | revision | aprobado | liberado | obsoleto
         ruta_origen TEXT,            -- ruta original en el PC del usuario
+        ruta_norm TEXT,              -- ruta_origen normalizada (índice único, ver plm_core)
         archivo_vault TEXT,          -- nombre del archivo en plm_vault
-        hash_md5 TEXT,               -- para detectar cambios
+        hash_md5 TEXT,               -- heredado: documentos anteriores a hash_b2
+        hash_b2 TEXT,                -- BLAKE2b del contenido, para detectar cambios
         creado TEXT DEFAULT CURRENT_TIMESTAMP,
         modificado TEXT DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY (proyecto_id) REFERENCES proyectos(id))''')
@@ -50,6 +72,7 @@ def init_plm_db():
         estado TEXT DEFAULT 'en_diseno',
         archivo_vault TEXT,
         hash_md5 TEXT,
+        hash_b2 TEXT,
         creado_por TEXT DEFAULT 'JA',
         fecha TEXT DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY (documento_id) REFERENCES plm_documentos(id))''')
@@ -80,14 +103,6 @@ def init_plm_db():
         FOREIGN KEY (bom_id) REFERENCES plm_bom(id),
         FOREIGN KEY (documento_id) REFERENCES plm_documentos(id))''')
 
-    # Log de cambios (audit trail)
-    c.execute('''CREATE TABLE IF NOT EXISTS plm_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        documento_id INTEGER,
-        accion TEXT,
-        detalle TEXT,
-        fecha TEXT DEFAULT CURRENT_TIMESTAMP)''')
-
     # Watch folder config
     c.execute('''CREATE TABLE IF NOT EXISTS plm_watchfolders (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -97,26 +112,33 @@ def init_plm_db():
         ultima_sync TEXT)''')
 
     conn.commit()
+    asegurar_esquema(conn)
+    asegurar_costes(conn)
+    asegurar_corte(conn)
+    asegurar_similitud(conn)
+    asegurar_ensamblajes(conn)
+    asegurar_explosion(conn)
+    asegurar_escandallo(conn)
+    asegurar_diferencias(conn)
+    asegurar_busqueda(conn)
+    asegurar_auditoria(conn)  # registro de actividad (migra el plm_log antiguo)
+    asegurar_indice(conn)
     conn.close()
 
 
+registro = Registro(DB)
+
+
 def log_accion(documento_id, accion, detalle=''):
-    conn = get_db()
-    conn.execute('INSERT INTO plm_log (documento_id, accion, detalle) VALUES (?,?,?)',
-                 (documento_id, accion, detalle))
-    conn.commit()
-    conn.close()
+    """Al registro de auditoría, que escribe por lotes con su propia conexión
+    (ver plm_auditoria)."""
+    registro.registrar(documento_id, accion, detalle)
 
 
-def calc_hash(filepath):
-    try:
-        h = hashlib.md5()
-        with open(filepath, 'rb') as f:
-            for chunk in iter(lambda: f.read(8192), b''):
-                h.update(chunk)
-        return h.hexdigest()
-    except:
-        return None
+def log_accion_db(conn, documento_id, accion, detalle=''):
+    """Igual que log_accion pero dentro de la transacción abierta en conn
+    (otra conexión se bloquearía esperando a que esta haga commit)."""
+    registrar_db(conn, documento_id, accion, detalle)
 
 
 def next_codigo(tipo):
@@ -141,32 +163,29 @@ def next_codigo(tipo):
 
 @plm.route('/plm')
 def plm_index():
+    """Los documentos no se cargan aquí: la tabla los pide a /plm/api/documentos por páginas."""
     conn = get_db()
-    docs = conn.execute('''
-        SELECT d.*, p.nombre as proyecto_nombre
-        FROM plm_documentos d
-        LEFT JOIN proyectos p ON d.proyecto_id = p.id
-        ORDER BY d.modificado DESC
-    ''').fetchall()
     boms = conn.execute('''
-        SELECT b.*, p.nombre as proyecto_nombre,
-               (SELECT COUNT(*) FROM plm_bom_lineas WHERE bom_id=b.id) as num_lineas
+        SELECT b.*, p.nombre as proyecto_nombre, COALESCE(n.num_lineas, 0) as num_lineas
         FROM plm_bom b
         LEFT JOIN proyectos p ON b.proyecto_id = p.id
+        LEFT JOIN (SELECT bom_id, COUNT(*) AS num_lineas FROM plm_bom_lineas GROUP BY bom_id) n
+               ON n.bom_id = b.id
         ORDER BY b.creado DESC
     ''').fetchall()
     proyectos = conn.execute("SELECT id, nombre FROM proyectos WHERE estado NOT IN ('entregado','cancelado') ORDER BY nombre").fetchall()
     watchfolders = conn.execute("SELECT * FROM plm_watchfolders ORDER BY id").fetchall()
+    por_estado = dict(conn.execute("SELECT estado, COUNT(*) FROM plm_documentos GROUP BY estado").fetchall())
     stats = {
-        'total_docs': conn.execute("SELECT COUNT(*) FROM plm_documentos").fetchone()[0],
-        'en_diseno': conn.execute("SELECT COUNT(*) FROM plm_documentos WHERE estado='en_diseno'").fetchone()[0],
-        'revision': conn.execute("SELECT COUNT(*) FROM plm_documentos WHERE estado='revision'").fetchone()[0],
-        'aprobados': conn.execute("SELECT COUNT(*) FROM plm_documentos WHERE estado='aprobado'").fetchone()[0],
-        'liberados': conn.execute("SELECT COUNT(*) FROM plm_documentos WHERE estado='liberado'").fetchone()[0],
-        'total_boms': conn.execute("SELECT COUNT(*) FROM plm_bom").fetchone()[0],
+        'total_docs': sum(por_estado.values()),
+        'en_diseno': por_estado.get('en_diseno', 0),
+        'revision': por_estado.get('revision', 0),
+        'aprobados': por_estado.get('aprobado', 0),
+        'liberados': por_estado.get('liberado', 0),
+        'total_boms': len(boms),
     }
     conn.close()
-    return render_template('plm.html', docs=docs, boms=boms, proyectos=proyectos,
+    return render_template('plm.html', boms=boms, proyectos=proyectos,
                            watchfolders=watchfolders, stats=stats)
 
 
@@ -174,10 +193,16 @@ def plm_index():
 def plm_nuevo_documento():
     data = request.form
     conn = get_db()
+    ruta_origen = data.get('ruta_origen', '')
+    existing = buscar_doc_por_ruta(conn, ruta_origen)
+    if existing:
+        # La ruta ya pertenece a otro documento (ruta_norm es única)
+        conn.close()
+        return redirect(url_for('plm.plm_documento_detalle', doc_id=existing['id']))
     codigo = next_codigo(data.get('tipo', 'pieza'))
     conn.execute('''INSERT INTO plm_documentos
-        (proyecto_id, codigo, nombre, tipo, software, descripcion, estado, ruta_origen)
-        VALUES (?,?,?,?,?,?,?,?)''', (
+        (proyecto_id, codigo, nombre, tipo, software, descripcion, estado, ruta_origen, ruta_norm)
+        VALUES (?,?,?,?,?,?,?,?,?)''', (
         data.get('proyecto_id') or None,
         codigo,
         data['nombre'],
@@ -185,7 +210,8 @@ def plm_nuevo_documento():
         data.get('software', ''),
         data.get('descripcion', ''),
         data.get('estado', 'en_diseno'),
-        data.get('ruta_origen', '')
+        ruta_origen,
+        normalizar_ruta(ruta_origen)
     ))
     doc_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
     # Crear revisión inicial A
@@ -208,13 +234,26 @@ def plm_documento_detalle(doc_id):
     revisiones = conn.execute(
         "SELECT * FROM plm_revisiones WHERE documento_id=? ORDER BY id DESC", (doc_id,)
     ).fetchall()
-    log = conn.execute(
-        "SELECT * FROM plm_log WHERE documento_id=? ORDER BY id DESC LIMIT 20", (doc_id,)
-    ).fetchall()
+    registro.vaciar()  # lo que acaba de registrarse tiene que salir ya
+    log = historial(conn, doc_id)
     proyectos = conn.execute("SELECT id, nombre FROM proyectos ORDER BY nombre").fetchall()
+    meta = metadatos_documento(conn, doc)
+    materiales, presupuestos = [], []
+    if meta and meta.get('formato') in ('stl', 'obj') and not meta.get('error'):
+        materiales = conn.execute(
+            "SELECT id, nombre FROM plm_materiales WHERE activo=1 ORDER BY nombre").fetchall()
+        presupuestos = conn.execute('''SELECT p.id, p.numero, p.descripcion, c.nombre AS cliente
+            FROM presupuestos p LEFT JOIN clientes c ON c.id = p.cliente_id
+            WHERE p.estado IN (?, ?) ORDER BY p.id DESC''', PRESUPUESTO_EDITABLE).fetchall()
+    corte = corte_documento(conn, doc) if doc and es_dxf(doc) else None
+    boms = conn.execute('''SELECT b.id, b.nombre, b.estado, b.creado,
+               (SELECT COUNT(*) FROM plm_bom_lineas WHERE bom_id=b.id) AS num_lineas
+        FROM plm_bom b WHERE b.documento_id=? ORDER BY b.id DESC''', (doc_id,)).fetchall()
     conn.close()
     return render_template('plm_detalle.html', doc=doc, revisiones=revisiones,
-                           log=log, proyectos=proyectos)
+                           log=log, proyectos=proyectos, meta=meta, corte=corte,
+                           materiales=materiales, presupuestos=presupuestos, unidades=UNIDADES_MM,
+                           boms=boms, es_step=bool(doc and es_step(doc)))
 
 
 @plm.route('/plm/documento/<int:doc_id>/estado', methods=['POST'])
@@ -244,9 +283,17 @@ def plm_nueva_revision(doc_id):
         nueva_rev = letras[idx + 1] if idx + 1 < len(letras) else 'A1'
     else:
         nueva_rev = 'A'
-    conn.execute('''INSERT INTO plm_revisiones (documento_id, revision, descripcion_cambio, estado)
-        VALUES (?,?,?,?)''', (doc_id, nueva_rev, request.form.get('descripcion', ''),
-                               request.form.get('estado', 'en_diseno')))
+    # La revisión congela el contenido actual del documento (su blob en el vault)
+    doc = conn.execute("SELECT archivo_vault, hash_b2 FROM plm_documentos WHERE id=?",
+                       (doc_id,)).fetchone()
+    cur = conn.execute('''INSERT INTO plm_revisiones
+        (documento_id, revision, descripcion_cambio, estado, archivo_vault, hash_b2)
+        VALUES (?,?,?,?,?,?)''', (doc_id, nueva_rev, request.form.get('descripcion', ''),
+                                 request.form.get('estado', 'en_diseno'),
+                                 doc['archivo_vault'] if doc else None,
+                                 doc['hash_b2'] if doc else None))
+    if doc and doc['hash_b2'] and doc['archivo_vault'] == blob_relativo(doc['hash_b2']):
+        referenciar_blob(conn, doc['hash_b2'], doc_id, cur.lastrowid)
     conn.execute("UPDATE plm_documentos SET modificado=? WHERE id=?",
                  (datetime.now().isoformat(), doc_id))
     conn.commit()
@@ -272,8 +319,9 @@ def plm_nueva_bom():
 def plm_bom_detalle(bom_id):
     conn = get_db()
     bom = conn.execute('''
-        SELECT b.*, p.nombre as proyecto_nombre
+        SELECT b.*, p.nombre as proyecto_nombre, p.cliente_id, d.codigo as doc_codigo
         FROM plm_bom b LEFT JOIN proyectos p ON b.proyecto_id=p.id
+        LEFT JOIN plm_documentos d ON b.documento_id=d.id
         WHERE b.id=?''', (bom_id,)).fetchone()
     lineas = conn.execute('''
         SELECT l.*, d.codigo as doc_codigo
@@ -282,8 +330,15 @@ def plm_bom_detalle(bom_id):
         WHERE l.bom_id=? ORDER BY l.pos''', (bom_id,)).fetchall()
     docs = conn.execute("SELECT id, codigo, nombre, tipo FROM plm_documentos ORDER BY codigo").fetchall()
     proyectos = conn.execute("SELECT id, nombre FROM proyectos ORDER BY nombre").fetchall()
+    fotos = conn.execute('''SELECT id, estado, num_lineas, creado FROM plm_bom_fotos
+        WHERE bom_id=? ORDER BY id DESC''', (bom_id,)).fetchall()
+    otras = conn.execute('''SELECT id, nombre, estado FROM plm_bom WHERE id != ?
+        ORDER BY (documento_id IS ? AND documento_id IS NOT NULL) DESC,
+                 (proyecto_id IS ? AND proyecto_id IS NOT NULL) DESC, id DESC LIMIT 200''',
+        (bom_id, bom['documento_id'] if bom else None, bom['proyecto_id'] if bom else None)).fetchall()
     conn.close()
-    return render_template('plm_bom.html', bom=bom, lineas=lineas, docs=docs, proyectos=proyectos)
+    return render_template('plm_bom.html', bom=bom, lineas=lineas, docs=docs, proyectos=proyectos,
+                           fotos=fotos, otras_boms=otras)
 
 
 @plm.route('/plm/bom/<int:bom_id>/linea', methods=['POST'])
@@ -321,14 +376,87 @@ def plm_delete_linea_bom(bom_id, linea_id):
 
 @plm.route('/plm/bom/<int:bom_id>/estado', methods=['POST'])
 def plm_bom_estado(bom_id):
+    """Cambia el estado; al pasar a aprobado o liberado se guarda una foto de las
+    líneas para poder compararlas después (ver plm_diferencias)."""
+    estado = request.form['estado']
     conn = get_db()
-    conn.execute("UPDATE plm_bom SET estado=? WHERE id=?",
-                 (request.form['estado'], bom_id))
-    conn.commit()
+    with conn:
+        anterior = conn.execute("SELECT estado FROM plm_bom WHERE id=?", (bom_id,)).fetchone()
+        conn.execute("UPDATE plm_bom SET estado=? WHERE id=?", (estado, bom_id))
+        if anterior and anterior['estado'] != estado and estado in ESTADOS_FOTO:
+            guardar_foto(conn, bom_id, estado)
     conn.close()
     return redirect(url_for('plm.plm_bom_detalle', bom_id=bom_id))
 
 
+@plm.route('/plm/bom/<int:bom_id>/importar', methods=['POST'])
+def plm_bom_importar(bom_id):
+    """Líneas desde una hoja Excel/CSV: subida (archivo) o del vault (documento_id).
+    Con previa=1 solo devuelve la cabecera, el mapeo y las filas validadas; si no,
+    inserta todas las válidas en una transacción (ver plm_lineas). Con errores no se
+    importa nada salvo omitir_errores=1."""
+    data = request.form
+    conn = get_db()
+    try:
+        bom = conn.execute("SELECT id, documento_id FROM plm_bom WHERE id=?", (bom_id,)).fetchone()
+        if bom is None:
+            return jsonify({'ok': False, 'error': 'BOM no encontrada'}), 404
+        archivo, doc = request.files.get('archivo'), None
+        if archivo and archivo.filename:
+            f, nombre = archivo.stream, archivo.filename
+        elif data.get('documento_id'):
+            doc = conn.execute("SELECT * FROM plm_documentos WHERE id=?",
+                               (data['documento_id'],)).fetchone()
+            if doc is None or not doc['archivo_vault']:
+                return jsonify({'ok': False, 'error': 'Documento no encontrado en el vault'}), 404
+            f, nombre = abrir_vault(conn, doc['archivo_vault']), doc['ruta_origen'] or doc['archivo_vault']
+        else:
+            return jsonify({'ok': False, 'error': 'Falta el archivo'}), 400
+        try:
+            with f:
+                hoja = leer_lineas(conn, f, nombre, json.loads(data.get('mapeo') or 'null'))
+        except (ValueError, RuntimeError) as e:
+            return jsonify({'ok': False, 'error': str(e)}), 400
+        lineas, errores = hoja['lineas'], hoja['errores']
+        res = {'cabecera': hoja['cabecera'], 'fila_cabecera': hoja['fila_cabecera'],
+               'mapeo': hoja['mapeo'], 'campos': CAMPOS_LINEA, 'filas': hoja['filas'],
+               'validas': len(lineas), 'vinculadas': sum(1 for l in lineas if l['documento_id']),
+               'errores': errores[:MAX_ERRORES], 'total_errores': len(errores)}
+        if data.get('previa'):
+            return jsonify({'ok': True, 'muestra': lineas[:FILAS_PREVIA], **res})
+        if errores and not data.get('omitir_errores'):
+            return jsonify({'ok': False, 'error': f'{len(errores)} filas con errores', **res}), 400
+        if not lineas:
+            return jsonify({'ok': False, 'error': 'La hoja no tiene líneas', **res}), 400
+        with conn:
+            insertadas = insertar_lineas(conn, bom_id, lineas, data.get('modo') == 'reemplazar')
+            if bom['documento_id']:
+                log_accion_db(conn, bom['documento_id'], 'BOM',
+                              f"{insertadas} líneas importadas de {os.path.basename(nombre)}")
+        return jsonify({'ok': True, 'insertadas': insertadas, **res})
+    finally:
+        conn.close()
+
+
+@plm.route('/plm/bom/<int:bom_id>/reordenar', methods=['POST'])
+def plm_bom_reordenar(bom_id):
+    """Renumera las posiciones: {orden: [linea_id, ...], paso: 10}. Sin orden, solo
+    cierra los huecos manteniendo el orden actual."""
+    data = request.get_json() or {}
+    try:
+        orden = [int(i) for i in data.get('orden') or ()]
+        paso = int(data.get('paso') or 10)
+    except (TypeError, ValueError):
+        return jsonify({'ok': False, 'error': 'Orden no válido'}), 400
+    if paso <= 0:
+        return jsonify({'ok': False, 'error': 'El paso debe ser positivo'}), 400
+    conn = get_db()
+    with conn:
+        n = reordenar(conn, bom_id, orden, paso)
+    conn.close()
+    return jsonify({'ok': True, 'lineas': n})
+
+
 # ── WATCH FOLDER ──────────────────────────────────────────────────────────────
 
 @plm.route('/plm/watchfolder/add', methods=['POST'])
@@ -338,6 +466,7 @@ def plm_add_watchfolder():
         conn.execute("INSERT INTO plm_watchfolders (ruta, software) VALUES (?,?)",
                      (request.form['ruta'], request.form.get('software', '')))
         conn.commit()
+        encolar('plm_indice', unico=True)
     except:
         pass
     conn.close()
@@ -359,93 +488,411 @@ def plm_toggle_watchfolder(wf_id):
 def plm_delete_watchfolder(wf_id):
     conn = get_db()
     conn.execute("DELETE FROM plm_watchfolders WHERE id=?", (wf_id,))
+    conn.execute("DELETE FROM plm_wf_snapshot WHERE wf_id=?", (wf_id,))
     conn.commit()
     conn.close()
+    encolar('plm_indice', unico=True)  # sus archivos salen del índice al rastrear
     return redirect(url_for('plm.plm_index'))
 
 
 @plm.route('/plm/sync', methods=['POST'])
 def plm_sync_manual():
-    """Sincronización manual de watch folders"""
-    conn = get_db()
-    wfs = conn.execute("SELECT * FROM plm_watchfolders WHERE activa=1").fetchall()
-    nuevos = 0
-    actualizados = 0
-
-    EXT_MAP = {
-        '.sldprt': ('pieza', 'solidworks'),
-        '.sldasm': ('ensamblaje', 'solidworks'),
-        '.slddrw': ('plano', 'solidworks'),
-        '.prt':    ('pieza', 'solidworks'),
-        '.asm':    ('ensamblaje', 'solidworks'),
-        '.drw':    ('plano', 'solidworks'),
-        '.dwg':    ('plano', 'autocad'),
-        '.dxf':    ('plano', 'autocad'),
-        '.ipt':    ('pieza', 'autocad'),
-        '.iam':    ('ensamblaje', 'autocad'),
-        '.idw':    ('plano', 'autocad'),
-        '.step':   ('pieza', 'otro'),
-        '.stp':    ('pieza', 'otro'),
-        '.iges':   ('pieza', 'otro'),
-        '.stl':    ('pieza', 'otro'),
-    }
+    """Sincronización manual de watch folders.
+
+    Se encola como trabajo (ver trabajos.py); el progreso se consulta en /api/jobs/<id>.
+    """
+    job_id = encolar('plm_sync', unico=True)
+    return jsonify({'ok': True, 'job_id': job_id})
+
+
+@plm.route('/plm/vault/compactar', methods=['POST'])
+def plm_vault_compactar():
+    """Compacta versiones antiguas del vault en segundo plano (ver plm_compactar)."""
+    job_id = encolar('plm_compactar', unico=True)
+    return jsonify({'ok': True, 'job_id': job_id})
+
+
+@plm.route('/plm/metadatos/rellenar', methods=['POST'])
+def plm_metadatos_rellenar():
+    """Extrae los metadatos CAD de los documentos que aún no los tienen."""
+    job_id = encolar('plm_metadatos', unico=True)
+    return jsonify({'ok': True, 'job_id': job_id})
+
+
+@plm.route('/plm/api/metadatos')
+def plm_api_metadatos():
+    """Búsqueda por metadatos CAD (autor, organización, sistema, esquema, nombre)."""
+    q = request.args.get('q', '').strip()
+    formato = request.args.get('formato', '').strip()
+    sql = '''SELECT d.id, d.codigo, d.nombre, d.tipo, d.estado, m.formato, m.autor,
+                    m.organizacion, m.sistema, m.esquema, m.nombre_archivo, m.triangulos,
+                    m.dim_x, m.dim_y, m.dim_z
+             FROM plm_metadatos m JOIN plm_documentos d ON d.hash_b2 = m.hash_b2
+             WHERE m.error IS NULL'''
+    params = []
+    if q:
+        sql += ''' AND (m.autor LIKE ? OR m.organizacion LIKE ? OR m.sistema LIKE ?
+                   OR m.esquema LIKE ? OR m.nombre_archivo LIKE ?)'''
+        params += [f'%{q}%'] * 5
+    if formato:
+        sql += " AND m.formato = ?"
+        params.append(formato)
+    sql += " ORDER BY d.modificado DESC LIMIT 200"
+    conn = get_db()
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+    return jsonify([dict(r) for r in rows])
 
-    for wf in wfs:
-        ruta = wf['ruta']
-        if not os.path.exists(ruta):
-            continue
-        for fname in os.listdir(ruta):
-            fpath = os.path.join(ruta, fname)
-            if not os.path.isfile(fpath):
-                continue
-            ext = os.path.splitext(fname)[1].lower()
-            if ext not in EXT_MAP:
-                continue
-
-            tipo, software = EXT_MAP[ext]
-            nuevo_hash = calc_hash(fpath)
-            nombre_sin_ext = os.path.splitext(fname)[0]
-
-            # ¿Existe ya este documento por ruta origen?
-            existing = conn.execute(
-                "SELECT * FROM plm_documentos WHERE ruta_origen=?", (fpath,)
-            ).fetchone()
-
-            if existing:
-                # Comprobar si cambió
-                if existing['hash_md5'] != nuevo_hash:
-                    # Copiar al vault como nueva versión
-                    ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-                    vault_name = f"{existing['codigo']}_rev_{ts}{ext}"
-                    shutil.copy2(fpath, os.path.join(VAULT_DIR, vault_name))
-                    conn.execute('''UPDATE plm_documentos
-                        SET hash_md5=?, archivo_vault=?, modificado=?, estado='en_diseno'
-                        WHERE id=?''',
-                        (nuevo_hash, vault_name, datetime.now().isoformat(), existing['id']))
-                    log_accion(existing['id'], 'SYNC_CAMBIO', f"Hash actualizado: {vault_name}")
-                    actualizados += 1
-            else:
-                # Nuevo documento
-                codigo = next_codigo(tipo)
-                ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-                vault_name = f"{codigo}_{ts}{ext}"
-                shutil.copy2(fpath, os.path.join(VAULT_DIR, vault_name))
-                conn.execute('''INSERT INTO plm_documentos
-                    (codigo, nombre, tipo, software, ruta_origen, archivo_vault, hash_md5, estado)
-                    VALUES (?,?,?,?,?,?,?,?)''',
-                    (codigo, nombre_sin_ext, tipo, software, fpath, vault_name, nuevo_hash, 'en_diseno'))
-                doc_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-                conn.execute('''INSERT INTO plm_revisiones (documento_id, revision, descripcion_cambio)
-                    VALUES (?,?,?)''', (doc_id, 'A', 'Importado automáticamente'))
-                log_accion(doc_id, 'SYNC_NUEVO', f"Detectado: {fpath}")
-                nuevos += 1
-
-        conn.execute("UPDATE plm_watchfolders SET ultima_sync=? WHERE id=?",
-                     (datetime.now().isoformat(), wf['id']))
 
-    conn.commit()
+# ── ESTIMACIÓN DE COSTE ───────────────────────────────────────────────────────
+
+def _parametros_estimacion(args):
+    """(material_id, cantidad, unidades, margen) de la petición; ValueError si no valen."""
+    try:
+        material_id = int(args.get('material_id') or 0)
+        cantidad = max(1, int(args.get('cantidad') or 1))
+        margen = float(args.get('margen') or 0)
+    except (TypeError, ValueError):
+        raise ValueError("Material, cantidad o margen no válidos")
+    unidades = args.get('unidades') or 'mm'
+    if unidades not in UNIDADES_MM or not math.isfinite(margen):
+        raise ValueError("Unidades o margen no válidos")
+    return material_id, cantidad, unidades, margen
+
+
+@plm.route('/plm/api/documento/<int:doc_id>/estimacion')
+def plm_api_estimacion(doc_id):
+    """Propiedades de masa y coste estimado con cada tarifa (piezas STL/OBJ)."""
+    conn = get_db()
+    try:
+        material_id, cantidad, unidades, margen = _parametros_estimacion(request.args)
+        doc = conn.execute("SELECT * FROM plm_documentos WHERE id=?", (doc_id,)).fetchone()
+        props = propiedades_documento(conn, doc) if doc else None
+        if props is None:
+            return jsonify({'ok': False, 'error': 'El documento no es una malla STL/OBJ legible'}), 400
+        lista = estimaciones(conn, props, material_id, cantidad, unidades) if material_id else []
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    finally:
+        conn.close()
+    for e in lista:
+        e['precio'] = round(e['coste'] * (1 + margen / 100.0), 2)
+        e['proceso_nombre'] = PROCESOS.get(e['proceso'], e['proceso'])
+    return jsonify({'ok': True, 'propiedades': props, 'estimaciones': lista})
+
+
+@plm.route('/plm/documento/<int:doc_id>/presupuesto', methods=['POST'])
+def plm_adjuntar_presupuesto(doc_id):
+    """Adjunta a un presupuesto la estimación de una tarifa (se recalcula aquí)."""
+    data = request.get_json(silent=True) or {}
+    conn = get_db()
+    try:
+        material_id, cantidad, unidades, margen = _parametros_estimacion(data)
+        try:
+            tarifa_id = int(data.get('tarifa_id') or 0)
+        except (TypeError, ValueError):
+            raise ValueError("Tarifa no válida")
+        doc = conn.execute("SELECT * FROM plm_documentos WHERE id=?", (doc_id,)).fetchone()
+        pres = conn.execute("SELECT id, numero, estado FROM presupuestos WHERE id=?",
+                            (data.get('presupuesto_id'),)).fetchone()
+        props = propiedades_documento(conn, doc) if doc else None
+        if props is None or pres is None:
+            return jsonify({'ok': False, 'error': 'Documento o presupuesto no válido'}), 400
+        if pres['estado'] not in PRESUPUESTO_EDITABLE:
+            return jsonify({'ok': False, 'error': f"El presupuesto {pres['numero']} ya no admite cambios"}), 400
+        estimacion = next((e for e in estimaciones(conn, props, material_id, cantidad, unidades)
+                           if e['tarifa_id'] == tarifa_id), None)
+        if estimacion is None:
+            return jsonify({'ok': False, 'error': 'Tarifa no aplicable'}), 400
+        with conn:
+            precio = adjuntar_a_presupuesto(conn, pres['id'], doc, estimacion, margen)
+            log_accion_db(conn, doc_id, 'PRESUPUESTO',
+                          f"{pres['numero']}: {cantidad} × {estimacion['material']} "
+                          f"({estimacion['proveedor']}) = {precio:.2f}€")
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    finally:
+        conn.close()
+    return jsonify({'ok': True, 'precio': precio, 'presupuesto_id': pres['id']})
+
+
+# ── CORTE DXF ─────────────────────────────────────────────────────────────────
+
+@plm.route('/plm/api/documento/<int:doc_id>/corte')
+def plm_api_corte(doc_id):
+    """Longitud de corte, contornos, perforaciones y aprovechamiento de un DXF."""
+    conn = get_db()
+    doc = conn.execute("SELECT * FROM plm_documentos WHERE id=?", (doc_id,)).fetchone()
+    corte = corte_documento(conn, doc)
+    conn.close()
+    if corte is None:
+        return jsonify({'ok': False, 'error': 'El documento no es un DXF'}), 400
+    return jsonify({'ok': not corte.get('error'), **corte})
+
+
+@plm.route('/pedido/<int:pedido_id>/plm', methods=['POST'])
+def plm_pedido_vincular(pedido_id):
+    """Vincula un DXF a un pedido de proveedor (o actualiza su cantidad)."""
+    documento_id = int(request.form.get('documento_id') or 0)
+    cantidad = max(1, int(request.form.get('cantidad') or 1))
+    conn = get_db()
+    doc = conn.execute("SELECT * FROM plm_documentos WHERE id=?", (documento_id,)).fetchone()
+    if doc is not None and es_dxf(doc):
+        with conn:
+            conn.execute('''INSERT INTO plm_pedido_documentos (pedido_id, documento_id, cantidad)
+                VALUES (?,?,?) ON CONFLICT (pedido_id, documento_id) DO UPDATE SET cantidad=excluded.cantidad''',
+                (pedido_id, documento_id, cantidad))
+            log_accion_db(conn, documento_id, 'PEDIDO', f"Pedido #{pedido_id}: {cantidad} ud.")
+    conn.close()
+    return redirect(url_for('pedido_detalle_view', id=pedido_id))
+
+
+@plm.route('/pedido/<int:pedido_id>/plm/<int:enlace_id>/quitar', methods=['POST'])
+def plm_pedido_quitar(pedido_id, enlace_id):
+    conn = get_db()
+    with conn:
+        conn.execute("DELETE FROM plm_pedido_documentos WHERE id=? AND pedido_id=?", (enlace_id, pedido_id))
+    conn.close()
+    return redirect(url_for('pedido_detalle_view', id=pedido_id))
+
+
+# ── PIEZAS SIMILARES ──────────────────────────────────────────────────────────
+
+@plm.route('/plm/api/similares/<int:doc_id>')
+def plm_api_similares(doc_id):
+    """Los k documentos de malla con geometría más parecida (ver plm_similitud).
+    Si quedan mallas sin indexar se encola su indexado y se avisa en la respuesta."""
+    k = min(max(request.args.get('k', 10, type=int), 1), 100)
+    conn = get_db()
+    try:
+        doc = conn.execute("SELECT * FROM plm_documentos WHERE id=?", (doc_id,)).fetchone()
+        if doc is None:
+            return jsonify({'ok': False, 'error': 'Documento no encontrado'}), 404
+        lista = similares(conn, doc, k)
+        if lista is None:
+            return jsonify({'ok': False, 'error': 'El documento no es una malla STL/OBJ legible'}), 400
+        sin_indexar = similitud_pendientes(conn)
+    finally:
+        conn.close()
+    job_id = encolar('plm_similitud', unico=True) if sin_indexar else None
+    return jsonify({'ok': True, 'similares': lista, 'sin_indexar': sin_indexar, 'job_id': job_id})
+
+
+@plm.route('/plm/similitud/indexar', methods=['POST'])
+def plm_similitud_indexar():
+    """Calcula los descriptores de forma de las mallas del vault que no los tengan."""
+    job_id = encolar('plm_similitud', unico=True)
+    return jsonify({'ok': True, 'job_id': job_id})
+
+
+# ── BÚSQUEDA DE DOCUMENTOS ────────────────────────────────────────────────────
+
+@plm.route('/plm/api/documentos')
+def plm_api_documentos():
+    """Página de documentos con facetas (ver plm_busqueda). Filtros repetibles:
+    ?estado=aprobado&estado=liberado&tipo=...&software=...&proyecto=<id>|''&modificado=7d;
+    texto en q; orden, dir (asc|desc), cursor (el 'siguiente' de la página anterior)
+    y facetas=0 para no recalcularlas al pedir más páginas."""
+    a = request.args
+    filtros = {f: a.getlist(f) for f in FACETAS if a.getlist(f)}
+    direccion = a.get('dir')
+    conn = get_db()
+    try:
+        return jsonify({'ok': True, **buscar(
+            conn, a.get('q', ''), filtros, a.get('orden', 'modificado'),
+            None if direccion not in ('asc', 'desc') else direccion == 'desc',
+            a.get('cursor') or None, a.get('limite'), a.get('facetas') != '0')})
+    except (ValueError, TypeError):
+        return jsonify({'ok': False, 'error': 'Parámetros de búsqueda no válidos'}), 400
+    finally:
+        conn.close()
+
+
+# ── AUDITORÍA ─────────────────────────────────────────────────────────────────
+
+@plm.route('/plm/api/auditoria')
+def plm_api_auditoria():
+    """Registro de actividad, más reciente primero, incluidos los meses archivados:
+    ?documento_id=&desde=YYYY-MM-DD&hasta=YYYY-MM-DD&accion=ESTADO&limite=100"""
+    a = request.args
+    registro.vaciar()
+    conn = get_db()
+    try:
+        entradas = consultar(conn, a.get('documento_id', type=int), a.get('desde') or None,
+                             a.get('hasta') or None, a.get('accion') or None,
+                             a.get('limite', 100, type=int))
+    except ValueError:
+        return jsonify({'ok': False, 'error': 'Fecha no válida (YYYY-MM-DD)'}), 400
+    finally:
+        conn.close()
+    return jsonify({'ok': True, 'entradas': entradas})
+
+
+# ── EXPLOSIÓN Y CADENA DE USO ─────────────────────────────────────────────────
+
+@plm.route('/plm/api/bom/<int:bom_id>/explosion')
+def plm_api_bom_explosion(bom_id):
+    """Árbol completo de la BOM con cantidades acumuladas (ver plm_explosion)."""
+    conn = get_db()
+    try:
+        if not conn.execute("SELECT 1 FROM plm_bom WHERE id=?", (bom_id,)).fetchone():
+            return jsonify({'ok': False, 'error': 'BOM no encontrada'}), 404
+        return jsonify({'ok': True, **explosion(conn, bom_id)})
+    finally:
+        conn.close()
+
+
+@plm.route('/plm/api/bom/<int:bom_id>/usos')
+def plm_api_bom_usos(bom_id):
+    """BOMs que contienen esta BOM, hasta las de nivel superior."""
+    conn = get_db()
+    try:
+        if not conn.execute("SELECT 1 FROM plm_bom WHERE id=?", (bom_id,)).fetchone():
+            return jsonify({'ok': False, 'error': 'BOM no encontrada'}), 404
+        return jsonify({'ok': True, **donde_se_usa(conn, bom_id=bom_id)})
+    finally:
+        conn.close()
+
+
+@plm.route('/plm/api/documento/<int:doc_id>/usos')
+def plm_api_documento_usos(doc_id):
+    """Dónde se usa un documento: BOMs que lo contienen, hasta las de nivel superior."""
+    conn = get_db()
+    try:
+        if not conn.execute("SELECT 1 FROM plm_documentos WHERE id=?", (doc_id,)).fetchone():
+            return jsonify({'ok': False, 'error': 'Documento no encontrado'}), 404
+        return jsonify({'ok': True, **donde_se_usa(conn, documento_id=doc_id)})
+    finally:
+        conn.close()
+
+
+# ── DIFERENCIAS ───────────────────────────────────────────────────────────────
+
+@plm.route('/plm/api/bom/<int:bom_id>/diferencias')
+def plm_api_bom_diferencias(bom_id):
+    """Cambios de la BOM respecto a ?contra= ('foto:<id>' o 'bom:<id>'); por defecto,
+    la última foto de aprobación/liberación de la propia BOM."""
+    contra = request.args.get('contra', '')
+    conn = get_db()
+    try:
+        if not contra:
+            foto = conn.execute("SELECT id FROM plm_bom_fotos WHERE bom_id=? ORDER BY id DESC LIMIT 1",
+                                (bom_id,)).fetchone()
+            if foto is None:
+                return jsonify({'ok': False, 'error': 'La BOM no tiene fotos con las que comparar'}), 404
+            contra = f"foto:{foto['id']}"
+        res = diferencias(conn, contra, f'bom:{bom_id}')
+    finally:
+        conn.close()
+    if res is None:
+        return jsonify({'ok': False, 'error': 'BOM o foto no encontrada'}), 404
+    return jsonify({'ok': True, **res})
+
+
+# ── ESCANDALLO ────────────────────────────────────────────────────────────────
+
+@plm.route('/plm/api/bom/<int:bom_id>/escandallo')
+def plm_api_bom_escandallo(bom_id):
+    """Coste y peso de la BOM completa, por proveedor y por componente (ver plm_escandallo)."""
+    conn = get_db()
+    try:
+        if not conn.execute("SELECT 1 FROM plm_bom WHERE id=?", (bom_id,)).fetchone():
+            return jsonify({'ok': False, 'error': 'BOM no encontrada'}), 404
+        return jsonify({'ok': True, **escandallo(conn, bom_id)})
+    except RuntimeError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 500
+    finally:
+        conn.close()
+
+
+@plm.route('/plm/api/precios', methods=['POST'])
+def plm_api_precio():
+    """Fija el precio y/o peso unitario de un componente (por documento o por código)."""
+    data = request.get_json() or {}
+    clave = clave_componente(data.get('documento_id'), data.get('codigo'))
+    if clave is None:
+        return jsonify({'ok': False, 'error': 'Falta documento o código'}), 400
+    try:
+        precio, peso = (None if data.get(k) in (None, '') else float(data[k])
+                        for k in ('precio', 'peso_kg'))
+    except (TypeError, ValueError):
+        return jsonify({'ok': False, 'error': 'Precio o peso no válido'}), 400
+    conn = get_db()
+    with conn:
+        guardar_precio(conn, clave, precio, peso)
     conn.close()
-    return jsonify({'ok': True, 'nuevos': nuevos, 'actualizados': actualizados})
+    return jsonify({'ok': True, 'clave': clave})
+
+
+# ── BOM DESDE STEP ────────────────────────────────────────────────────────────
+
+@plm.route('/plm/documento/<int:doc_id>/bom/importar', methods=['POST'])
+def plm_importar_bom_step(doc_id):
+    """Genera la BOM multinivel de un ensamblaje STEP (ver plm_ensamblajes).
+    Se encola como trabajo: un STEP grande tarda en recorrerse."""
+    conn = get_db()
+    doc = conn.execute("SELECT * FROM plm_documentos WHERE id=?", (doc_id,)).fetchone()
+    conn.close()
+    if doc is None:
+        return jsonify({'ok': False, 'error': 'Documento no encontrado'}), 404
+    if not es_step(doc) or not doc['archivo_vault']:
+        return jsonify({'ok': False, 'error': 'El documento no es un STEP del vault'}), 400
+    job_id = encolar('plm_bom_step', {'documento_id': doc_id})
+    return jsonify({'ok': True, 'job_id': job_id})
+
+
+# ── TRABAJOS ──────────────────────────────────────────────────────────────────
+
+@tarea('plm_sync')
+def trabajo_sync(ctx):
+    return sincronizar(lambda p: ctx.avanzar(p))
+
+
+@tarea('plm_compactar')
+def trabajo_compactar(ctx):
+    return compactar(lambda p: ctx.avanzar(p))
+
+
+@tarea('plm_metadatos')
+def trabajo_metadatos(ctx):
+    conn = get_db()
+    try:
+        return rellenar_metadatos(conn, lambda p: ctx.avanzar(p))
+    finally:
+        conn.close()
+
+
+@tarea('plm_similitud')
+def trabajo_similitud(ctx):
+    conn = get_db()
+    try:
+        return indexar_similitud(conn, lambda p: ctx.avanzar(p))
+    finally:
+        conn.close()
+
+
+@tarea('plm_indice')
+def trabajo_indice(ctx):
+    conn = get_db()
+    try:
+        return rastrear_indice(conn, lambda p: ctx.avanzar(p))
+    finally:
+        conn.close()
+
+
+@tarea('plm_bom_step')
+def trabajo_bom_step(ctx, documento_id):
+    conn = get_db()
+    try:
+        doc = conn.execute("SELECT * FROM plm_documentos WHERE id=?", (documento_id,)).fetchone()
+        res = importar_bom(conn, doc, lambda p: ctx.avanzar(p))
+        log_accion_db(conn, documento_id, 'BOM',
+                      f"BOM importada del STEP: {res['boms']} BOM, {res['lineas']} líneas "
+                      f"({res['vinculadas']} vinculadas)")
+        conn.commit()
+        return res
+    finally:
+        conn.close()
 
 
 @plm.route('/plm/api/stats')
@@ -0,0 +1,288 @@
+"""
+PLM Similitud — JA · ERP
+Búsqueda de piezas parecidas por forma entre todas las mallas STL/OBJ del vault.
+
+Cada contenido (hash_b2) se resume en un vector de forma invariante a posición,
+rotación y escala:
+
+    D2          histograma de distancias entre pares de puntos al azar de la
+                superficie (Osada et al.), normalizado por la distancia media
+    momentos    raíces de los cocientes de autovalores de la covarianza de la
+                superficie (invariantes de segundo orden)
+    caja        cocientes de la caja envolvente en los ejes principales, más
+                esfericidad y llenado (volumen / caja)
+    tamaño      log10 de la mayor dimensión, con poco peso: una pieza igual a
+                escala 10× no es la misma pieza
+
+Los vectores se guardan como float32 en plm_descriptores y se cargan en una
+única matriz NumPy: buscar los k más cercanos es un producto matriz-vector y un
+argpartition, milisegundos aunque haya decenas de miles de piezas.
+"""
+
+import json
+import math
+import threading
+
+from plm_core import ruta_vault, blob_relativo
+from plm_mallas import NUMPY_OK, np, cargar_malla, propiedades_masa, BLOQUE_TRIANGULOS
+
+VERSION_DESCRIPTOR = 1
+MUESTRAS_D2 = 8192
+BINS_D2 = 32
+MAX_D2 = 3.0                 # en múltiplos de la distancia media
+SEMILLA = 20240611           # muestreo determinista: mismo contenido, mismo vector
+DIM = BINS_D2 + 7
+PESO_D2 = 4.0
+PESO_TAMANO = 0.1
+LOTE_BD = 200
+
+if NUMPY_OK:
+    PESOS = np.concatenate([np.full(BINS_D2, PESO_D2), np.ones(6), [PESO_TAMANO]]).astype(np.float32)
+
+
+# ── DESCRIPTOR ────────────────────────────────────────────────────────────────
+
+def _areas(tris):
+    """Área de cada triángulo, por bloques."""
+    out = np.empty(len(tris))
+    for i in range(0, len(tris), BLOQUE_TRIANGULOS):
+        t = np.asarray(tris[i:i + BLOQUE_TRIANGULOS], dtype=np.float64)
+        out[i:i + len(t)] = np.linalg.norm(np.cross(t[:, 1] - t[:, 0], t[:, 2] - t[:, 0]), axis=1) / 2
+    return out
+
+
+def muestrear_superficie(tris, n, rng):
+    """n puntos uniformes sobre la superficie (triángulo según su área y
+    coordenadas baricéntricas uniformes)."""
+    acumulado = np.cumsum(_areas(tris))
+    if acumulado[-1] <= 0:
+        raise ValueError("La malla no tiene superficie")
+    idx = np.searchsorted(acumulado, rng.random(n) * acumulado[-1], side='right')
+    idx = np.minimum(idx, len(tris) - 1)
+    orden = np.argsort(idx)  # lectura secuencial del memmap
+    t = np.empty((n, 3, 3))
+    t[orden] = np.asarray(tris[idx[orden]], dtype=np.float64)
+    s = np.sqrt(rng.random(n))[:, None]
+    r = rng.random(n)[:, None]
+    return (1 - s) * t[:, 0] + s * (1 - r) * t[:, 1] + s * r * t[:, 2]
+
+
+def descriptor(tris):
+    """Vector de forma (DIM,) float32 de una malla (n, 3, 3)."""
+    if len(tris) == 0:
+        raise ValueError("La malla no tiene triángulos")
+    rng = np.random.default_rng(SEMILLA)
+    puntos = muestrear_superficie(tris, 2 * MUESTRAS_D2, rng)
+
+    d = np.linalg.norm(puntos[:MUESTRAS_D2] - puntos[MUESTRAS_D2:], axis=1)
+    media = d.mean()
+    if media <= 0:
+        raise ValueError("La malla es degenerada")
+    d2 = np.histogram(d / media, bins=BINS_D2, range=(0, MAX_D2))[0] / MUESTRAS_D2
+
+    # Ejes principales de la superficie (autovalores de mayor a menor)
+    centro = puntos.mean(axis=0)
+    valores, ejes = np.linalg.eigh(np.cov((puntos - centro).T))
+    valores, ejes = np.maximum(valores[::-1], 0), ejes[:, ::-1]
+    momentos = np.sqrt(valores[1:] / valores[0]) if valores[0] > 0 else np.zeros(2)
+
+    # Caja envolvente en los ejes principales, con todos los vértices
+    minimo, maximo = np.full(3, np.inf), np.full(3, -np.inf)
+    for i in range(0, len(tris), BLOQUE_TRIANGULOS):
+        v = np.asarray(tris[i:i + BLOQUE_TRIANGULOS], dtype=np.float64).reshape(-1, 3)
+        p = (v - centro) @ ejes
+        minimo, maximo = np.minimum(minimo, p.min(axis=0)), np.maximum(maximo, p.max(axis=0))
+    caja = np.sort(maximo - minimo)[::-1]
+    masa = propiedades_masa(tris)
+    volumen, area = masa['volumen'], masa['area']
+    esfericidad = math.pi ** (1 / 3) * (6 * volumen) ** (2 / 3) / area if area > 0 else 0.0
+    llenado = volumen / float(np.prod(caja)) if np.prod(caja) > 0 else 0.0
+
+    forma = [momentos[0], momentos[1],
+             caja[1] / caja[0] if caja[0] > 0 else 0.0,
+             caja[2] / caja[0] if caja[0] > 0 else 0.0,
+             min(esfericidad, 1.0), min(llenado, 1.0),
+             math.log10(caja[0]) if caja[0] > 0 else 0.0]
+    return np.concatenate([d2, forma]).astype(np.float32)
+
+
+# ── ESQUEMA Y ALMACÉN ─────────────────────────────────────────────────────────
+
+def asegurar_similitud(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS plm_descriptores (
+        hash_b2 TEXT PRIMARY KEY,
+        version INTEGER NOT NULL,
+        vector BLOB,                 -- DIM float32; NULL si no se pudo calcular
+        error TEXT,
+        creado TEXT DEFAULT CURRENT_TIMESTAMP)''')
+    # Antes también se guardaban los fallos de lectura, que son pasajeros
+    conn.execute("""DELETE FROM plm_descriptores WHERE vector IS NULL
+        AND (error = 'Blob compactado' OR error LIKE '[Errno %')""")
+    conn.commit()
+
+
+def guardar_descriptores(conn, filas):
+    """Guarda [(hash_b2, vector | None, error | None)]."""
+    conn.executemany(
+        "INSERT OR REPLACE INTO plm_descriptores (hash_b2, version, vector, error) VALUES (?,?,?,?)",
+        [(h, VERSION_DESCRIPTOR, v.tobytes() if v is not None else None, e) for h, v, e in filas])
+
+
+def calcular(ruta, ext):
+    """(vector, error) de un archivo de malla. error es del contenido y se guarda;
+    los fallos de lectura (OSError) y de entorno (RuntimeError, sin NumPy) se
+    propagan: son pasajeros (p. ej. un blob compactado que referenciar_blob
+    restaura) y no deben quedar anotados."""
+    try:
+        return descriptor(cargar_malla(ruta, ext)), None
+    except ValueError as e:
+        return None, str(e)[:300]
+
+
+def descriptor_hash(conn, hash_b2):
+    """Vector de un contenido: guardado, o calculado ahora sobre el blob y
+    guardado. None si no es una malla legible."""
+    row = conn.execute("SELECT vector, version FROM plm_descriptores WHERE hash_b2=?",
+                       (hash_b2,)).fetchone()
+    if row is not None and row['version'] == VERSION_DESCRIPTOR:
+        return np.frombuffer(row['vector'], dtype=np.float32) if row['vector'] else None
+    meta = conn.execute("SELECT formato FROM plm_metadatos WHERE hash_b2=?", (hash_b2,)).fetchone()
+    if meta is None or meta['formato'] not in ('stl', 'obj'):
+        return None
+    try:
+        vector, error = calcular(ruta_vault(blob_relativo(hash_b2)), '.' + meta['formato'])
+    except (OSError, RuntimeError):  # ilegible ahora o sin NumPy: nada que guardar
+        return None
+    with conn:
+        guardar_descriptores(conn, [(hash_b2, vector, error)])
+    return vector
+
+
+_SIN_DESCRIPTOR = '''FROM plm_metadatos m
+    WHERE m.formato IN ('stl', 'obj') AND m.error IS NULL
+      AND NOT EXISTS (SELECT 1 FROM plm_descriptores d
+                      WHERE d.hash_b2 = m.hash_b2 AND d.version = ?)'''
+
+
+def pendientes(conn):
+    """Nº de mallas del vault aún sin descriptor."""
+    return conn.execute("SELECT COUNT(*) " + _SIN_DESCRIPTOR, (VERSION_DESCRIPTOR,)).fetchone()[0]
+
+
+def indexar(conn, observador=None):
+    """Calcula el descriptor de cada malla del vault que no lo tenga. Los blobs
+    que no se pueden leer (p. ej. revisiones antiguas compactadas) se omiten sin
+    anotar nada: siguen pendientes para el próximo indexado."""
+    filas_pend = conn.execute("SELECT m.hash_b2, m.formato " + _SIN_DESCRIPTOR,
+                              (VERSION_DESCRIPTOR,)).fetchall()
+    avance = {'estado': 'indexando', 'total': len(filas_pend), 'indexados': 0,
+              'errores': 0, 'omitidos': 0}
+    filas = []
+    for row in filas_pend:
+        try:
+            vector, error = calcular(ruta_vault(blob_relativo(row['hash_b2'])), '.' + row['formato'])
+        except OSError:
+            avance['omitidos'] += 1
+        else:
+            avance['indexados' if vector is not None else 'errores'] += 1
+            filas.append((row['hash_b2'], vector, error))
+            if len(filas) >= LOTE_BD:
+                with conn:
+                    guardar_descriptores(conn, filas)
+                filas = []
+        if observador is not None:
+            observador(dict(avance))
+    with conn:
+        guardar_descriptores(conn, filas)
+    return {k: avance[k] for k in ('indexados', 'errores', 'omitidos')}
+
+
+# ── ÍNDICE EN MEMORIA ─────────────────────────────────────────────────────────
+
+class IndiceFormas:
+    """Matriz (n, DIM) float32 con los descriptores ya ponderados, recargada
+    cuando cambia plm_descriptores (nº de filas o último rowid)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._firma = None
+        self.hashes = []
+        self.matriz = None
+        self.normas = None
+
+    def actualizar(self, conn):
+        firma = tuple(conn.execute(
+            "SELECT COUNT(*), MAX(rowid) FROM plm_descriptores WHERE version=? AND vector IS NOT NULL",
+            (VERSION_DESCRIPTOR,)).fetchone())
+        with self._lock:
+            if firma == self._firma:
+                return
+            rows = conn.execute(
+                "SELECT hash_b2, vector FROM plm_descriptores WHERE version=? AND vector IS NOT NULL",
+                (VERSION_DESCRIPTOR,)).fetchall()
+            matriz = np.frombuffer(b''.join(r[1] for r in rows), dtype=np.float32).reshape(-1, DIM)
+            self.matriz = matriz * PESOS
+            self.normas = np.einsum('ij,ij->i', self.matriz, self.matriz)
+            self.hashes = [r[0] for r in rows]
+            self._firma = firma
+
+    def vecinos(self, vector, k):
+        """[(hash_b2, distancia)] de los k descriptores más cercanos."""
+        with self._lock:
+            matriz, normas, hashes = self.matriz, self.normas, self.hashes
+        if matriz is None or not len(hashes):
+            return []
+        q = vector * PESOS
+        d2 = normas - 2 * (matriz @ q) + q @ q
+        k = min(k, len(hashes))
+        idx = np.argpartition(d2, k - 1)[:k]
+        idx = idx[np.argsort(d2[idx])]
+        return [(hashes[i], float(np.sqrt(max(d2[i], 0.0)))) for i in idx]
+
+
+indice = IndiceFormas()
+
+
+def similares(conn, doc, k=10):
+    """Documentos cuya geometría (actual o de una revisión) más se parece a la de
+    `doc`, el mejor resultado por documento. None si doc no es una malla."""
+    vector = descriptor_hash(conn, doc['hash_b2']) if doc['hash_b2'] else None
+    if vector is None:
+        return None
+    indice.actualizar(conn)
+    candidatos = indice.vecinos(vector, 4 * k + 8)
+    distancias = dict(candidatos)
+    lista = json.dumps(list(distancias))
+    # Un contenido puede ser la versión actual de varios documentos o de revisiones antiguas
+    filas = conn.execute('''
+        SELECT d.id AS documento_id, NULL AS revision, d.hash_b2 FROM plm_documentos d
+        WHERE d.hash_b2 IN (SELECT value FROM json_each(?))
+        UNION ALL
+        SELECT r.documento_id, r.revision, r.hash_b2 FROM plm_revisiones r
+        JOIN plm_documentos d ON d.id = r.documento_id
+        WHERE r.hash_b2 IN (SELECT value FROM json_each(?)) AND r.hash_b2 != d.hash_b2''',
+        (lista, lista)).fetchall()
+    mejores = {}
+    for f in filas:
+        if f['documento_id'] == doc['id']:
+            continue
+        d = distancias[f['hash_b2']]
+        if f['documento_id'] not in mejores or d < mejores[f['documento_id']][0]:
+            mejores[f['documento_id']] = (d, f['revision'], f['hash_b2'])
+    elegidos = sorted(mejores.items(), key=lambda x: x[1][0])[:k]
+    if not elegidos:
+        return []
+    docs = {r['id']: r for r in conn.execute('''
+        SELECT d.id, d.codigo, d.nombre, d.estado, p.nombre AS proyecto,
+               COALESCE(c.empresa, c.nombre) AS cliente
+        FROM plm_documentos d
+        LEFT JOIN proyectos p ON p.id = d.proyecto_id
+        LEFT JOIN clientes c ON c.id = p.cliente_id
+        WHERE d.id IN (SELECT value FROM json_each(?))''',
+        (json.dumps([doc_id for doc_id, _ in elegidos]),)).fetchall()}
+    return [{
+        'documento_id': doc_id, 'codigo': docs[doc_id]['codigo'], 'nombre': docs[doc_id]['nombre'],
+        'estado': docs[doc_id]['estado'], 'proyecto': docs[doc_id]['proyecto'],
+        'cliente': docs[doc_id]['cliente'], 'revision': revision, 'hash_b2': h,
+        'distancia': round(d, 4), 'similitud': round(100.0 / (1.0 + 4.0 * d), 1),
+    } for doc_id, (d, revision, h) in elegidos if doc_id in docs]
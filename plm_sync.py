@@ -0,0 +1,399 @@
+"""
+PLM Sync — JA · ERP
+Sincronización de watch folders por etapas: escaneo → hash → copia al vault →
+metadatos → BD.
+
+El escaneo es recursivo (como plm_watcher) y se compara con el snapshot de cada
+watch folder: solo se leen los archivos nuevos o con stat distinto. El hash y la
+ingesta en el vault por contenido corren en pools de hilos (hashlib y las
+copias del sistema liberan el GIL); las copias se hacen fuera de cualquier transacción y la BD se escribe
+en lotes cortos para no bloquear al resto de escritores.
+"""
+
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date
+
+from plm_core import (buscar_docs_por_rutas, normalizar_ruta, normalizar_en_directorio,
+                      calc_hash, calc_hash_md5, hashes_en_cache, guardar_hashes,
+                      cargar_snapshot, guardar_snapshot, firma_archivo, guardar_blob, referenciar_blob,
+                      ruta_vault)
+from plm_metadatos import EXTRACTORES, extraer, hashes_sin_metadatos, guardar_metadatos
+from plm_auditoria import registrar_lote
+
+DB = os.path.join(os.path.dirname(__file__), 'crm.db')
+
+HASH_WORKERS = min(8, os.cpu_count() or 2)
+COPY_WORKERS = 4  # copias simultáneas: más solo satura el disco
+
+EXT_MAP = {
+    '.sldprt': ('pieza', 'solidworks'),
+    '.sldasm': ('ensamblaje', 'solidworks'),
+    '.slddrw': ('plano', 'solidworks'),
+    '.prt':    ('pieza', 'solidworks'),
+    '.asm':    ('ensamblaje', 'solidworks'),
+    '.drw':    ('plano', 'solidworks'),
+    '.dwg':    ('plano', 'autocad'),
+    '.dxf':    ('plano', 'autocad'),
+    '.ipt':    ('pieza', 'autocad'),
+    '.iam':    ('ensamblaje', 'autocad'),
+    '.idw':    ('plano', 'autocad'),
+    '.step':   ('pieza', 'otro'),
+    '.stp':    ('pieza', 'otro'),
+    '.iges':   ('pieza', 'otro'),
+    '.stl':    ('pieza', 'otro'),
+    '.obj':    ('pieza', 'otro'),
+}
+
+PREFIJOS = {'pieza': 'PZA', 'ensamblaje': 'ENS', 'plano': 'PLN', 'otro': 'DOC'}
+
+
+def get_db():
+    conn = sqlite3.connect(DB)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+# ── PROGRESO ──────────────────────────────────────────────────────────────────
+# Estado de la sincronización en curso (una a la vez, ver trabajos.py). Si se pasa
+# un observador a sincronizar(), recibe una copia en cada avance; puede lanzar
+# una excepción para cancelar.
+
+_lock = threading.Lock()
+_progreso = {'estado': 'inactivo'}
+_observador = None
+
+
+def _avanzar(**cambios):
+    with _lock:
+        for k, v in cambios.items():
+            if k.startswith('+'):
+                _progreso[k[1:]] = _progreso.get(k[1:], 0) + v
+            else:
+                _progreso[k] = v
+        copia = dict(_progreso)
+    if _observador is not None:
+        _observador(copia)
+
+
+def estado_sync():
+    with _lock:
+        return dict(_progreso)
+
+
+# ── ETAPAS ────────────────────────────────────────────────────────────────────
+
+LOTE_BD = 200  # filas por transacción de escritura
+
+
+def escanear_arbol(ruta, errores=None):
+    """Etapa 1: {ruta_norm: archivo} de todos los CAD bajo la carpeta (recursivo).
+    Las carpetas que no se pueden leer (o dejan de responder a medias) se añaden
+    a errores: lo que cuelga de ellas no se puede dar por borrado."""
+    archivos = {}
+    pendientes = [(ruta, normalizar_ruta(ruta))]
+    while pendientes:
+        carpeta, dir_norm = pendientes.pop()
+        try:
+            with os.scandir(carpeta) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pendientes.append((entry.path, os.path.join(dir_norm, os.path.normcase(entry.name))))
+                            continue
+                        ext = os.path.splitext(entry.name)[1].lower()
+                        if ext not in EXT_MAP or not entry.is_file():
+                            continue
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    tipo, software = EXT_MAP[ext]
+                    norm = normalizar_en_directorio(dir_norm, entry)
+                    archivos[norm] = {
+                        'ruta': entry.path, 'norm': norm, 'st': st, 'ext': ext,
+                        'tipo': tipo, 'software': software,
+                        'nombre': os.path.splitext(entry.name)[0],
+                    }
+        except OSError:
+            if errores is not None:
+                errores.append(dir_norm)
+    return archivos
+
+
+def calcular_hashes(conn, archivos):
+    """Etapa 2: hash_b2 de cada archivo. Los que no cambiaron de stat salen de
+    plm_hash_cache; el resto se lee en paralelo."""
+    cache = hashes_en_cache(conn, [(a['norm'], a['st']) for a in archivos])
+    pendientes = []
+    for a in archivos:
+        a['hash'] = cache.get(a['norm'])
+        if a['hash'] is None:
+            pendientes.append(a)
+    _avanzar(**{'+hasheados': len(archivos) - len(pendientes)})
+
+    with ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix='plm-hash') as pool:
+        for a, h in zip(pendientes, pool.map(lambda a: calc_hash(a['ruta']), pendientes)):
+            a['hash'] = h
+            _avanzar(**{'+hasheados': 1, '+bytes_leidos': a['st'].st_size})
+
+    for i in range(0, len(pendientes), LOTE_BD):
+        with conn:
+            guardar_hashes(conn, [(a['norm'], a['st'], a['hash']) for a in pendientes[i:i + LOTE_BD]])
+
+
+def _contador_codigos(conn):
+    """Códigos consecutivos por tipo sin consultar la BD en cada archivo. Se crea
+    dentro de la transacción de escritura que los va a usar (ver _por_lotes): el
+    último código se lee con el bloqueo ya tomado y nadie más puede asignar el
+    mismo entretanto (watcher, registro desde el explorador)."""
+    ultimos = {}
+
+    def siguiente(tipo):
+        if tipo not in ultimos:
+            row = conn.execute(
+                "SELECT codigo FROM plm_documentos WHERE tipo=? ORDER BY id DESC LIMIT 1", (tipo,)
+            ).fetchone()
+            try:
+                ultimos[tipo] = int(row['codigo'].split('-')[-1]) if row else 0
+            except Exception:
+                ultimos[tipo] = 0
+        ultimos[tipo] += 1
+        return f"{PREFIJOS.get(tipo, 'DOC')}-{date.today().year}-{ultimos[tipo]:04d}"
+    return siguiente
+
+
+def clasificar(conn, archivos):
+    """Etapa 3: separa archivos sin documento y documentos cuyo contenido cambió
+    (una consulta para todos). Devuelve (nuevos, modificados, rellenar_b2)."""
+    docs = buscar_docs_por_rutas(conn, (a['norm'] for a in archivos))
+    nuevos, modificados, legado = [], [], []
+
+    for a in archivos:
+        if not a['hash']:
+            continue
+        doc = docs.get(a['norm'])
+        a['doc'] = doc
+        if doc is None:
+            nuevos.append(a)
+        elif doc['hash_b2']:
+            if doc['hash_b2'] != a['hash']:
+                modificados.append(a)
+        elif doc['hash_md5']:
+            legado.append(a)
+        else:
+            modificados.append(a)
+
+    # Documentos anteriores a BLAKE2: se comparan por MD5 una única vez
+    rellenar_b2 = []
+    if legado:
+        with ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix='plm-hash') as pool:
+            for a, md5 in zip(legado, pool.map(lambda a: calc_hash_md5(a['ruta']), legado)):
+                if md5 == a['doc']['hash_md5']:
+                    rellenar_b2.append((a['hash'], a['doc']['id']))
+                else:
+                    modificados.append(a)
+    return nuevos, modificados, rellenar_b2
+
+
+def detectar_movidos(conn, nuevos, desaparecidos):
+    """Archivos sin documento cuyo contenido coincide con uno que desapareció del
+    snapshot: es el mismo documento movido o renombrado.
+    Devuelve (movidos, nuevos_restantes)."""
+    if not desaparecidos or not nuevos:
+        return [], nuevos
+    docs_viejos = buscar_docs_por_rutas(conn, (r['ruta_norm'] for r in desaparecidos))
+    por_hash = {}
+    for r in desaparecidos:
+        doc = docs_viejos.get(r['ruta_norm'])
+        if doc and r['hash_b2']:
+            por_hash.setdefault(r['hash_b2'], []).append(doc)
+
+    movidos, restantes = [], []
+    for a in nuevos:
+        candidatos = por_hash.get(a['hash'])
+        if candidatos:
+            a['doc'] = candidatos.pop()
+            movidos.append(a)
+        else:
+            restantes.append(a)
+    return movidos, restantes
+
+
+def copiar_al_vault(cambios):
+    """Etapa 4: ingesta en el vault con concurrencia acotada, fuera de
+    transacción. Devuelve (copiados, fallidos)."""
+    _avanzar(**{'estado': 'copiando', '+por_copiar': len(cambios)})
+
+    def copiar(a):
+        try:
+            a['archivo_vault'] = guardar_blob(a['ruta'], a['hash'])
+            return True
+        except OSError:
+            return False
+
+    copiados, fallidos = [], []
+    with ThreadPoolExecutor(COPY_WORKERS, thread_name_prefix='plm-copy') as pool:
+        for a, ok in zip(cambios, pool.map(copiar, cambios)):
+            if ok:
+                copiados.append(a)
+                _avanzar(**{'+copiados': 1, '+bytes_copiados': a['st'].st_size})
+            else:
+                fallidos.append(a)
+                _avanzar(**{'+errores': 1})
+    return copiados, fallidos
+
+
+def extraer_metadatos(conn, copiados):
+    """Etapa 5: metadatos CAD de los contenidos que aún no se han analizado
+    (uno por hash, leyendo el blob del vault). Devuelve [(hash_b2, datos)]."""
+    por_hash = {a['hash']: a for a in copiados if a['ext'] in EXTRACTORES}
+    pendientes = [por_hash[h] for h in hashes_sin_metadatos(conn, por_hash)]
+    _avanzar(**{'estado': 'extrayendo', '+por_extraer': len(pendientes)})
+
+    def analizar(a):
+        return extraer(ruta_vault(a['archivo_vault']), a['ext'])
+
+    filas = []
+    with ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix='plm-meta') as pool:
+        for a, datos in zip(pendientes, pool.map(analizar, pendientes)):
+            filas.append((a['hash'], datos))
+            _avanzar(**{'+extraidos': 1})
+    return filas
+
+
+def _guardar_copiados(conn, lote, ahora):
+    logs = []
+    siguiente_codigo = _contador_codigos(conn)
+    # clasificar() es de antes de copiar: con el bloqueo ya tomado se vuelven a
+    # resolver los nuevos, por si el watcher o el explorador registraron la ruta
+    registrados = buscar_docs_por_rutas(conn, (a['norm'] for a in lote if not a['doc']))
+    for a in lote:
+        doc = a['doc'] or registrados.get(a['norm'])
+        if doc and doc['hash_b2'] == a['hash']:
+            continue
+        if doc:
+            conn.execute('''UPDATE plm_documentos
+                SET hash_b2=?, archivo_vault=?, modificado=?, estado='en_diseno'
+                WHERE id=?''', (a['hash'], a['archivo_vault'], ahora, doc['id']))
+            referenciar_blob(conn, a['hash'], doc['id'], ruta=a['ruta'])
+            logs.append((doc['id'], 'SYNC_CAMBIO', f"Hash actualizado: {a['hash'][:16]}"))
+        else:
+            a['codigo'] = siguiente_codigo(a['tipo'])
+            cur = conn.execute('''INSERT INTO plm_documentos
+                (codigo, nombre, tipo, software, ruta_origen, ruta_norm, archivo_vault, hash_b2, estado)
+                VALUES (?,?,?,?,?,?,?,?,?)''',
+                (a['codigo'], a['nombre'], a['tipo'], a['software'], a['ruta'], a['norm'],
+                 a['archivo_vault'], a['hash'], 'en_diseno'))
+            doc_id = cur.lastrowid
+            cur = conn.execute('''INSERT INTO plm_revisiones
+                (documento_id, revision, descripcion_cambio, archivo_vault, hash_b2)
+                VALUES (?,?,?,?,?)''', (doc_id, 'A', 'Importado automáticamente',
+                                     a['archivo_vault'], a['hash']))
+            referenciar_blob(conn, a['hash'], doc_id, cur.lastrowid, a['ruta'])
+            logs.append((doc_id, 'SYNC_NUEVO', f"Detectado: {a['ruta']}"))
+    registrar_lote(conn, logs)
+
+
+def _guardar_movidos(conn, lote, ahora):
+    for a in lote:
+        conn.execute("UPDATE plm_documentos SET ruta_origen=?, ruta_norm=?, modificado=? WHERE id=?",
+                     (a['ruta'], a['norm'], ahora, a['doc']['id']))
+    registrar_lote(conn, [(a['doc']['id'], 'SYNC_MOVIDO', f"{a['doc']['ruta_origen']} → {a['ruta']}")
+                          for a in lote])
+
+
+def _por_lotes(conn, filas, fn, *args):
+    """Aplica fn a bloques de LOTE_BD filas, cada bloque en su propia transacción.
+    La transacción es IMMEDIATE: lo que fn lea (p. ej. el último código) ya está
+    bajo el bloqueo de escritura."""
+    for i in range(0, len(filas), LOTE_BD):
+        with conn:
+            if not conn.in_transaction:
+                conn.execute('BEGIN IMMEDIATE')
+            fn(conn, filas[i:i + LOTE_BD], *args)
+
+
+def reconciliar(conn, wf):
+    """Compara una watch folder con su snapshot y aplica solo las diferencias."""
+    errores = []
+    actuales = escanear_arbol(wf['ruta'], errores)
+    snapshot = cargar_snapshot(conn, wf['id'])
+    ilegibles = tuple(e.rstrip(os.sep) + os.sep for e in errores)
+
+    examinar = []
+    for norm, a in actuales.items():
+        s = snapshot.get(norm)
+        if s is None or (s['tamano'], s['mtime_ns'], s['inode']) != firma_archivo(a['st']):
+            examinar.append(a)
+    # Lo que cuelga de una carpeta ilegible no se da por desaparecido
+    desaparecidos = [r for norm, r in snapshot.items()
+                     if norm not in actuales and not norm.startswith(ilegibles)]
+    _avanzar(**{'estado': 'hasheando', '+total': len(actuales),
+                '+sin_cambios': len(actuales) - len(examinar)})
+
+    calcular_hashes(conn, examinar)
+    nuevos, modificados, rellenar_b2 = clasificar(conn, examinar)
+    movidos, nuevos = detectar_movidos(conn, nuevos, desaparecidos)
+
+    copiados, fallidos = copiar_al_vault(nuevos + modificados)
+    metadatos = extraer_metadatos(conn, copiados)
+
+    _avanzar(estado='guardando')
+    ahora = datetime.now().isoformat()
+    _por_lotes(conn, copiados, _guardar_copiados, ahora)
+    _por_lotes(conn, metadatos, guardar_metadatos)
+    _por_lotes(conn, movidos, _guardar_movidos, ahora)
+    _por_lotes(conn, rellenar_b2, lambda c, lote: c.executemany(
+        "UPDATE plm_documentos SET hash_b2=? WHERE id=?", lote))
+
+    # Snapshot: lo examinado con éxito entra; lo fallido se reintentará la próxima vez
+    fallidas = {a['norm'] for a in fallidos}
+    vistos = [(a['norm'], a['ruta'], a['st'], a['hash'])
+              for a in examinar if a['hash'] and a['norm'] not in fallidas]
+    _por_lotes(conn, vistos, lambda c, lote: guardar_snapshot(c, wf['id'], lote))
+
+    # Desaparecidos: fuera del snapshot y registro en el log (el documento se conserva)
+    movidas = {a['doc']['ruta_norm'] for a in movidos}
+    borrados = [r for r in desaparecidos if r['ruta_norm'] not in movidas]
+    docs_borrados = buscar_docs_por_rutas(conn, (r['ruta_norm'] for r in borrados))
+    _por_lotes(conn, [r['ruta_norm'] for r in desaparecidos], lambda c, lote: c.executemany(
+        "DELETE FROM plm_wf_snapshot WHERE wf_id=? AND ruta_norm=?", [(wf['id'], n) for n in lote]))
+    _por_lotes(conn, list(docs_borrados.values()), lambda c, lote: registrar_lote(
+        c, [(d['id'], 'SYNC_BORRADO', f"Ya no existe: {d['ruta_origen']}") for d in lote]))
+
+    with conn:
+        conn.execute("UPDATE plm_watchfolders SET ultima_sync=? WHERE id=?", (ahora, wf['id']))
+
+    resultado = {
+        'nuevos': sum(1 for a in copiados if a['doc'] is None),
+        'actualizados': sum(1 for a in copiados if a['doc'] is not None),
+        'movidos': len(movidos),
+        'borrados': len(borrados),
+    }
+    _avanzar(**{'+' + k: v for k, v in resultado.items()})
+    return resultado
+
+
+def sincronizar(observador=None):
+    """Sincroniza todas las watch folders activas. Devuelve los totales."""
+    global _observador
+    with _lock:
+        _progreso.clear()
+        _progreso.update({'estado': 'escaneando', 'total': 0, 'sin_cambios': 0, 'hasheados': 0})
+    _observador = observador
+    conn = get_db()
+    try:
+        wfs = conn.execute("SELECT * FROM plm_watchfolders WHERE activa=1").fetchall()
+        totales = {'nuevos': 0, 'actualizados': 0, 'movidos': 0, 'borrados': 0}
+        for wf in wfs:
+            if not os.path.isdir(wf['ruta']):
+                continue
+            for k, v in reconciliar(conn, wf).items():
+                totales[k] += v
+        _avanzar(estado='terminado')
+        return totales
+    finally:
+        _observador = None
+        conn.close()
@@ -9,16 +9,28 @@ Requisitos:
     pip install watchdog requests
 
 Este script se ejecuta en paralelo a app.py y envía cambios automáticamente.
+Al arrancar (y al activar una carpeta) se pone al día con lo que cambió mientras
+estaba parado, comparando con el snapshot de cada watch folder. También mantiene
+el índice global de archivos del explorador (plm_indice): lo rastrea al activar
+cada carpeta y cada RASTREO_PERIODICO, y entre medias le pasa los eventos.
 """
 
 import time
 import os
 import sys
-import hashlib
+import queue
 import logging
 import sqlite3
-import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from plm_core import (normalizar_ruta, asegurar_esquema, buscar_doc_por_ruta, calc_hash,
+                      hashes_en_cache, guardar_hashes, contenido_cambiado, guardar_blob,
+                      referenciar_blob, guardar_snapshot, version_aviso, ruta_vault)
+from plm_sync import reconciliar
+from plm_metadatos import EXTRACTORES, extraer, hashes_sin_metadatos, guardar_metadatos
+from plm_auditoria import asegurar_auditoria, registrar_db
+from plm_indice import asegurar_indice, rastrear_carpeta, ColaIndice, RASTREO_PERIODICO
 
 try:
     from watchdog.observers import Observer
@@ -26,6 +38,7 @@ try:
     WATCHDOG_OK = True
 except ImportError:
     WATCHDOG_OK = False
+    FileSystemEventHandler = object
 
 logging.basicConfig(
     level=logging.INFO,
@@ -37,8 +50,13 @@ log = logging.getLogger('plm_watcher')
 # Ajusta esta ruta al directorio donde está tu ERP
 ERP_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(ERP_DIR, 'crm.db')
-VAULT_DIR = os.path.join(ERP_DIR, 'plm_vault')
-os.makedirs(VAULT_DIR, exist_ok=True)
+
+DEBOUNCE = 1.0          # segundos sin eventos (y con tamaño/mtime estables) antes de procesar
+WORKERS = 4             # hashes e ingestas simultáneas
+LOTE_COMMIT = 100       # trabajos por transacción
+INTERVALO_COMMIT = 2.0  # segundos máximos antes de confirmar un lote
+COMPROBAR_CONFIG = 2    # segundos entre comprobaciones de cambios en watch folders
+REINTENTO_CARPETAS = 30  # segundos entre reintentos de carpetas activas no accesibles
 
 # Extensiones CAD soportadas
 EXT_MAP = {
@@ -57,6 +75,7 @@ EXT_MAP = {
     '.stp':    ('pieza',       'otro'),
     '.iges':   ('pieza',       'otro'),
     '.stl':    ('pieza',       'otro'),
+    '.obj':    ('pieza',       'otro'),
 }
 
 
@@ -66,17 +85,6 @@ def get_db():
     return conn
 
 
-def calc_hash(filepath):
-    try:
-        h = hashlib.md5()
-        with open(filepath, 'rb') as f:
-            for chunk in iter(lambda: f.read(8192), b''):
-                h.update(chunk)
-        return h.hexdigest()
-    except Exception:
-        return None
-
-
 def next_codigo(conn, tipo):
     prefijos = {'pieza': 'PZA', 'ensamblaje': 'ENS', 'plano': 'PLN', 'otro': 'DOC'}
     pref = prefijos.get(tipo, 'DOC')
@@ -94,68 +102,101 @@ def next_codigo(conn, tipo):
 
 
 def log_accion_db(conn, documento_id, accion, detalle=''):
-    conn.execute(
-        'INSERT INTO plm_log (documento_id, accion, detalle) VALUES (?,?,?)',
-        (documento_id, accion, detalle)
-    )
+    registrar_db(conn, documento_id, accion, detalle)
 
 
-def process_file(filepath):
-    """Procesa un archivo CAD detectado: crea o actualiza en BD."""
+# ── PROCESADO ─────────────────────────────────────────────────────────────────
+# Dos fases: la E/S (hash, ingesta en el vault, metadatos) corre en el pool de trabajo;
+# la escritura en BD la hace un único hilo escritor que confirma por lotes.
+
+def preparar_archivo(filepath):
+    """Fase de E/S: hash, ingesta en el vault y metadatos (si el contenido no se
+    había analizado ya), sin escribir en la BD. None si no aplica."""
     ext = os.path.splitext(filepath)[1].lower()
     if ext not in EXT_MAP:
-        return
+        return None
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    # La caché se consulta aquí y se actualiza en registrar_archivo (el escritor)
+    norm = normalizar_ruta(filepath)
+    conn = get_db()
+    try:
+        nuevo_hash = hashes_en_cache(conn, [(norm, st)]).get(norm) or calc_hash(filepath)
+        if not nuevo_hash:
+            return None
+        archivo_vault = guardar_blob(filepath, nuevo_hash)
+        pendiente = ext in EXTRACTORES and bool(hashes_sin_metadatos(conn, [nuevo_hash]))
+    finally:
+        conn.close()
+    metadatos = extraer(ruta_vault(archivo_vault), ext) if pendiente else None
+    return {'ruta': filepath, 'ext': ext, 'st': st, 'hash': nuevo_hash,
+            'archivo_vault': archivo_vault, 'metadatos': metadatos}
 
-    tipo, software = EXT_MAP[ext]
-    nuevo_hash = calc_hash(filepath)
-    if not nuevo_hash:
-        return
 
+def registrar_archivo(conn, trabajo):
+    """Fase de BD: crea o actualiza el documento de un archivo ya preparado."""
+    filepath, nuevo_hash = trabajo['ruta'], trabajo['hash']
+    archivo_vault = trabajo['archivo_vault']
+    tipo, software = EXT_MAP[trabajo['ext']]
     nombre_sin_ext = os.path.splitext(os.path.basename(filepath))[0]
-    conn = get_db()
+    norm = normalizar_ruta(filepath)
+    guardar_hashes(conn, [(norm, trabajo['st'], nuevo_hash)])
+    if trabajo.get('wf_id') is not None:
+        guardar_snapshot(conn, trabajo['wf_id'], [(norm, filepath, trabajo['st'], nuevo_hash)])
+    if trabajo.get('metadatos'):
+        guardar_metadatos(conn, [(nuevo_hash, trabajo['metadatos'])])
 
-    try:
-        existing = conn.execute(
-            "SELECT * FROM plm_documentos WHERE ruta_origen=?", (filepath,)
-        ).fetchone()
-
-        if existing:
-            if existing['hash_md5'] != nuevo_hash:
-                ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-                vault_name = f"{existing['codigo']}_rev_{ts}{ext}"
-                shutil.copy2(filepath, os.path.join(VAULT_DIR, vault_name))
-                conn.execute(
-                    '''UPDATE plm_documentos
-                       SET hash_md5=?, archivo_vault=?, modificado=?, estado='en_diseno'
-                       WHERE id=?''',
-                    (nuevo_hash, vault_name, datetime.now().isoformat(), existing['id'])
-                )
-                log_accion_db(conn, existing['id'], 'WATCHER_CAMBIO',
-                              f"Cambio detectado → {vault_name}")
-                log.info(f"ACTUALIZADO: {nombre_sin_ext} [{existing['codigo']}]")
-            else:
-                log.debug(f"Sin cambios: {nombre_sin_ext}")
-        else:
-            codigo = next_codigo(conn, tipo)
-            ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-            vault_name = f"{codigo}_{ts}{ext}"
-            shutil.copy2(filepath, os.path.join(VAULT_DIR, vault_name))
-            conn.execute(
-                '''INSERT INTO plm_documentos
-                   (codigo, nombre, tipo, software, ruta_origen, archivo_vault, hash_md5, estado)
-                   VALUES (?,?,?,?,?,?,?,?)''',
-                (codigo, nombre_sin_ext, tipo, software,
-                 filepath, vault_name, nuevo_hash, 'en_diseno')
-            )
-            doc_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    existing = buscar_doc_por_ruta(conn, filepath)
+
+    if existing:
+        if contenido_cambiado(conn, existing, filepath, nuevo_hash):
             conn.execute(
-                '''INSERT INTO plm_revisiones (documento_id, revision, descripcion_cambio)
-                   VALUES (?,?,?)''',
-                (doc_id, 'A', 'Importado automáticamente por Watch Folder')
+                '''UPDATE plm_documentos
+                   SET hash_b2=?, archivo_vault=?, modificado=?, estado='en_diseno'
+                   WHERE id=?''',
+                (nuevo_hash, archivo_vault, datetime.now().isoformat(), existing['id'])
             )
-            log_accion_db(conn, doc_id, 'WATCHER_NUEVO', f"Detectado: {filepath}")
-            log.info(f"NUEVO: {nombre_sin_ext} → {codigo} [{software}]")
+            referenciar_blob(conn, nuevo_hash, existing['id'], ruta=filepath)
+            log_accion_db(conn, existing['id'], 'WATCHER_CAMBIO',
+                          f"Cambio detectado → {nuevo_hash[:16]}")
+            log.info(f"ACTUALIZADO: {nombre_sin_ext} [{existing['codigo']}]")
+        else:
+            log.debug(f"Sin cambios: {nombre_sin_ext}")
+    else:
+        codigo = next_codigo(conn, tipo)
+        conn.execute(
+            '''INSERT INTO plm_documentos
+               (codigo, nombre, tipo, software, ruta_origen, ruta_norm, archivo_vault, hash_b2, estado)
+               VALUES (?,?,?,?,?,?,?,?,?)''',
+            (codigo, nombre_sin_ext, tipo, software,
+             filepath, norm, archivo_vault, nuevo_hash, 'en_diseno')
+        )
+        doc_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        cur = conn.execute(
+            '''INSERT INTO plm_revisiones
+               (documento_id, revision, descripcion_cambio, archivo_vault, hash_b2)
+               VALUES (?,?,?,?,?)''',
+            (doc_id, 'A', 'Importado automáticamente por Watch Folder', archivo_vault, nuevo_hash)
+        )
+        referenciar_blob(conn, nuevo_hash, doc_id, cur.lastrowid, filepath)
+        log_accion_db(conn, doc_id, 'WATCHER_NUEVO', f"Detectado: {filepath}")
+        log.info(f"NUEVO: {nombre_sin_ext} → {codigo} [{software}]")
+
 
+def process_file(filepath):
+    """Procesa un archivo CAD de inmediato, fuera de la cola: crea o actualiza en BD."""
+    try:
+        trabajo = preparar_archivo(filepath)
+    except Exception as e:
+        log.error(f"Error procesando {filepath}: {e}")
+        return
+    if trabajo is None:
+        return
+    conn = get_db()
+    try:
+        registrar_archivo(conn, trabajo)
         conn.commit()
     except Exception as e:
         log.error(f"Error procesando {filepath}: {e}")
@@ -163,40 +204,279 @@ def process_file(filepath):
         conn.close()
 
 
+class EscritorLotes:
+    """Único escritor de la BD del watcher. Acumula trabajos y los aplica juntos
+    cada LOTE_COMMIT trabajos o INTERVALO_COMMIT segundos, con una sola conexión.
+    La transacción se abre solo al aplicar el lote, así que el bloqueo de
+    escritura dura lo que tarda la escritura y no la espera entre eventos; cada
+    trabajo va en su SAVEPOINT (un error no arrastra al resto)."""
+
+    def __init__(self):
+        self._cola = queue.Queue()
+        self._hilo = threading.Thread(target=self._bucle, name='plm-escritor', daemon=True)
+        self._hilo.start()
+
+    def enviar(self, fn, *args):
+        self._cola.put((fn, args))
+
+    def cerrar(self):
+        self._cola.put(None)
+        self._hilo.join()
+
+    def _bucle(self):
+        conn = get_db()
+        conn.isolation_level = None  # transacciones explícitas
+        lote, desde, fin = [], None, False
+        while not fin:
+            try:
+                espera = max(0, desde + INTERVALO_COMMIT - time.monotonic()) if lote else None
+                item = self._cola.get(timeout=espera)
+            except queue.Empty:
+                item = False
+            if item is None:
+                fin = True
+            elif item:
+                if not lote:
+                    desde = time.monotonic()
+                lote.append(item)
+            if lote and (fin or len(lote) >= LOTE_COMMIT
+                         or time.monotonic() - desde >= INTERVALO_COMMIT):
+                if self._aplicar(conn, lote):
+                    lote = []
+        conn.close()
+
+    def _aplicar(self, conn, lote):
+        """Aplica un lote en una transacción. False si la BD estaba ocupada:
+        el lote se conserva y se reintenta en la siguiente vuelta."""
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as e:
+            log.warning(f"Lote aplazado: {e}")
+            return False
+        for fn, args in lote:
+            conn.execute('SAVEPOINT trabajo')
+            try:
+                fn(conn, *args)
+            except Exception as e:
+                conn.execute('ROLLBACK TO trabajo')
+                log.error(f"Error guardando en BD: {e}")
+            conn.execute('RELEASE trabajo')
+        try:
+            conn.execute('COMMIT')
+        except sqlite3.OperationalError as e:
+            conn.execute('ROLLBACK')
+            log.warning(f"Lote aplazado: {e}")
+            return False
+        return True
+
+
+class ColaDebounce:
+    """Agrupa ráfagas de eventos por ruta. Un archivo se procesa cuando lleva
+    DEBOUNCE segundos sin eventos y su (tamaño, mtime) no ha cambiado entre dos
+    comprobaciones; el trabajo corre en un pool, nunca en el hilo del observer."""
+
+    def __init__(self, procesar):
+        self._procesar = procesar
+        self._pendientes = {}  # ruta -> [vence, firma, datos]
+        self._en_curso = set()
+        self._pausas = 0
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(WORKERS, thread_name_prefix='plm-watch')
+        threading.Thread(target=self._bucle, name='plm-debounce', daemon=True).start()
+
+    def notificar(self, ruta, *datos):
+        """Encola una ruta; datos se pasan tal cual a procesar(ruta, *datos)."""
+        with self._cond:
+            vence = time.monotonic() + DEBOUNCE
+            if ruta in self._pendientes:
+                self._pendientes[ruta][0] = vence
+            else:
+                self._pendientes[ruta] = [vence, None, datos]
+            self._cond.notify()
+
+    def pausar(self):
+        """Retiene los trabajos (los eventos se siguen acumulando)."""
+        with self._cond:
+            self._pausas += 1
+
+    def reanudar(self):
+        with self._cond:
+            self._pausas -= 1
+            self._cond.notify()
+
+    def _bucle(self):
+        while True:
+            with self._cond:
+                ahora = time.monotonic()
+                vencidas = [] if self._pausas else [
+                    r for r, (vence, _, _) in self._pendientes.items() if vence <= ahora]
+                if not vencidas:
+                    proximo = None if self._pausas else min(
+                        (p[0] for p in self._pendientes.values()), default=None)
+                    self._cond.wait(None if proximo is None else proximo - ahora)
+                    continue
+            for ruta in vencidas:
+                self._revisar(ruta)
+
+    def _revisar(self, ruta):
+        try:
+            st = os.stat(ruta)
+            firma = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            firma = None
+        with self._cond:
+            p = self._pendientes.get(ruta)
+            if p is None or p[0] > time.monotonic():
+                return  # llegó otro evento entretanto
+            if firma is None:
+                del self._pendientes[ruta]  # temporal del CAD que ya no existe
+                return
+            if p[1] != firma or ruta in self._en_curso:
+                # Aún se está escribiendo (o hay un trabajo en marcha): otra vuelta
+                p[0], p[1] = time.monotonic() + DEBOUNCE, firma
+                return
+            del self._pendientes[ruta]
+            self._en_curso.add(ruta)
+        self._pool.submit(self._trabajo, ruta, p[2])
+
+    def _trabajo(self, ruta, datos):
+        try:
+            self._procesar(ruta, *datos)
+        except Exception as e:
+            log.error(f"Error procesando {ruta}: {e}")
+        finally:
+            with self._cond:
+                self._en_curso.discard(ruta)
+
+    def cerrar(self):
+        self._pool.shutdown(wait=True)
+
+
 class CADFileHandler(FileSystemEventHandler):
-    """Handler de eventos del sistema de archivos."""
+    """Handler de eventos del sistema de archivos: solo encola, no procesa.
+    Los CAD van a la cola de procesado; todo (también borrados y carpetas
+    creadas, movidas o borradas) a la del índice global si la hay."""
+
+    def __init__(self, cola, wf_id=None, indice=None):
+        super().__init__()
+        self.cola = cola
+        self.wf_id = wf_id
+        self.indice = indice
 
     def _should_process(self, path):
-        ext = os.path.splitext(path)[1].lower()
-        return ext in EXT_MAP and os.path.isfile(path)
+        return os.path.splitext(path)[1].lower() in EXT_MAP
+
+    def _indexar(self, path, carpeta):
+        if self.indice is not None:
+            self.indice.notificar(path, self.wf_id, carpeta)
 
     def on_created(self, event):
+        self._indexar(event.src_path, event.is_directory)
         if not event.is_directory and self._should_process(event.src_path):
-            # Pequeña espera para que el programa CAD termine de escribir
-            time.sleep(1.5)
-            process_file(event.src_path)
+            self.cola.notificar(event.src_path, self.wf_id)
 
     def on_modified(self, event):
-        if not event.is_directory and self._should_process(event.src_path):
-            time.sleep(1.5)
-            process_file(event.src_path)
+        if event.is_directory:
+            return  # el mtime de la carpeta cambia con cada archivo de dentro
+        self._indexar(event.src_path, False)
+        if self._should_process(event.src_path):
+            self.cola.notificar(event.src_path, self.wf_id)
 
     def on_moved(self, event):
+        self._indexar(event.src_path, event.is_directory)
+        self._indexar(event.dest_path, event.is_directory)
         if not event.is_directory and self._should_process(event.dest_path):
-            process_file(event.dest_path)
+            self.cola.notificar(event.dest_path, self.wf_id)
+
+    def on_deleted(self, event):
+        self._indexar(event.src_path, event.is_directory)
 
 
-def get_watchfolders():
-    """Obtiene carpetas activas de la BD."""
+def get_watchfolders(conn):
+    """Carpetas activas de la BD: {id: row}."""
     try:
-        conn = get_db()
         folders = conn.execute(
             "SELECT * FROM plm_watchfolders WHERE activa=1"
         ).fetchall()
-        conn.close()
-        return [(f['ruta'], f['software']) for f in folders]
+        return {f['id']: f for f in folders}
     except Exception:
-        return []
+        return {}
+
+
+def ponerse_al_dia(cola, wfs):
+    """Reconcilia las carpetas con su snapshot (lo que cambió con el watcher
+    parado). La cola se pausa mientras tanto: los eventos se acumulan y se
+    procesan después, sin competir por los mismos archivos."""
+    cola.pausar()
+    conn = get_db()
+    try:
+        for wf in wfs:
+            r = reconciliar(conn, wf)
+            log.info(f"Puesta al día {wf['ruta']}: {r['nuevos']} nuevos, "
+                     f"{r['actualizados']} actualizados, {r['movidos']} movidos, "
+                     f"{r['borrados']} desaparecidos")
+    except Exception as e:
+        log.error(f"Error en la puesta al día: {e}")
+    finally:
+        conn.close()
+        cola.reanudar()
+
+
+_rastreo_lock = threading.Lock()
+
+
+def rastrear_indice(wfs):
+    """Rastreo del índice global de estas carpetas, con su propia conexión. Si ya
+    hay uno en marcha no se lanza otro (el siguiente periódico las cubre)."""
+    if not _rastreo_lock.acquire(blocking=False):
+        return
+    conn = get_db()
+    try:
+        for wf in wfs:
+            r = rastrear_carpeta(conn, wf)
+            if r:
+                log.info(f"Índice {wf['ruta']}: {r['archivos']} archivos, {r['cambios']} cambios, "
+                         f"{r['borrados']} borrados")
+    except Exception as e:
+        log.error(f"Error rastreando el índice: {e}")
+    finally:
+        conn.close()
+        _rastreo_lock.release()
+
+
+def actualizar_carpetas(conn, observer, cola, vigiladas, indice=None, ausentes=()):
+    """Ajusta las carpetas observadas a plm_watchfolders: deja de observar las
+    desactivadas o borradas y programa (con su puesta al día y su rastreo del
+    índice) las nuevas. Devuelve los wf_id activos cuya carpeta no está accesible
+    (p. ej. un recurso de red aún sin montar), que main reintenta; de los que ya
+    estaban en ausentes no se vuelve a avisar."""
+    activas = get_watchfolders(conn)
+    for wf_id in list(vigiladas):
+        wf = activas.get(wf_id)
+        if wf is None or wf['ruta'] != vigiladas[wf_id][0]:
+            ruta, watch = vigiladas.pop(wf_id)
+            observer.unschedule(watch)
+            log.info(f"Carpeta retirada: {ruta}")
+
+    nuevas, faltan = [], set()
+    for wf_id, wf in activas.items():
+        if wf_id in vigiladas:
+            continue
+        if not os.path.isdir(wf['ruta']):
+            if wf_id not in ausentes:
+                log.warning(f"Carpeta no encontrada: {wf['ruta']}")
+            faltan.add(wf_id)
+            continue
+        watch = observer.schedule(CADFileHandler(cola, wf_id, indice), wf['ruta'], recursive=True)
+        vigiladas[wf_id] = (wf['ruta'], watch)
+        nuevas.append(wf)
+        log.info(f"Monitorizando: {wf['ruta']} [{wf['software'] or 'mixto'}]")
+    if nuevas:
+        threading.Thread(target=ponerse_al_dia, args=(cola, nuevas),
+                         name='plm-puesta-al-dia', daemon=True).start()
+        threading.Thread(target=rastrear_indice, args=(nuevas,),
+                         name='plm-rastreo', daemon=True).start()
+    return faltan
 
 
 def main():
@@ -211,47 +491,68 @@ def main():
     print("  JA · ERP — PLM Watch Folder Daemon")
     print("=" * 60)
 
+    # Migraciones PLM (por si el ERP aún no ha arrancado con esta versión).
+    # La conexión se queda abierta para vigilar cambios de configuración.
+    conn = get_db()
+    asegurar_esquema(conn)
+    asegurar_auditoria(conn)
+    asegurar_indice(conn)
+
+    escritor = EscritorLotes()
+    indice = ColaIndice(escritor.enviar)
+
+    def procesar(ruta, wf_id):
+        trabajo = preparar_archivo(ruta)
+        if trabajo:
+            trabajo['wf_id'] = wf_id
+            escritor.enviar(registrar_archivo, trabajo)
+
+    cola = ColaDebounce(procesar)
     observer = Observer()
-    handlers_activos = []
+    vigiladas = {}  # wf_id -> (ruta, watch)
 
-    folders = get_watchfolders()
-    if not folders:
+    ausentes = actualizar_carpetas(conn, observer, cola, vigiladas, indice)
+    ultimo_rastreo = ultimo_reintento = time.monotonic()
+    if not vigiladas:
         log.warning("No hay watch folders configuradas en la BD.")
         log.warning("Añádelas desde el ERP en PLM → Watch Folders.")
-    else:
-        for ruta, software in folders:
-            if os.path.exists(ruta):
-                handler = CADFileHandler()
-                observer.schedule(handler, ruta, recursive=True)
-                handlers_activos.append(ruta)
-                log.info(f"Monitorizando: {ruta} [{software or 'mixto'}]")
-            else:
-                log.warning(f"Carpeta no encontrada: {ruta}")
 
     observer.start()
     log.info("Watcher activo. Ctrl+C para detener.")
 
     try:
-        check_interval = 30  # segundos entre re-lecturas de config
-        elapsed = 0
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        version = version_aviso(conn, 'plm_watchfolders')
         while True:
-            time.sleep(1)
-            elapsed += 1
-            if elapsed >= check_interval:
-                elapsed = 0
-                # Recargar carpetas por si se añadieron nuevas desde el ERP
-                nuevas = get_watchfolders()
-                for ruta, software in nuevas:
-                    if ruta not in handlers_activos and os.path.exists(ruta):
-                        handler = CADFileHandler()
-                        observer.schedule(handler, ruta, recursive=True)
-                        handlers_activos.append(ruta)
-                        log.info(f"Nueva carpeta añadida: {ruta}")
+            time.sleep(COMPROBAR_CONFIG)
+            if time.monotonic() - ultimo_rastreo >= RASTREO_PERIODICO:
+                ultimo_rastreo = time.monotonic()
+                activas = get_watchfolders(conn)
+                threading.Thread(target=rastrear_indice,
+                                 args=([activas[i] for i in vigiladas if i in activas],),
+                                 name='plm-rastreo', daemon=True).start()
+            # Carpetas que no estaban accesibles: al volver se programan y se ponen al día
+            if ausentes and time.monotonic() - ultimo_reintento >= REINTENTO_CARPETAS:
+                ultimo_reintento = time.monotonic()
+                ausentes = actualizar_carpetas(conn, observer, cola, vigiladas, indice, ausentes)
+            # data_version solo cambia si otra conexión escribió en la BD
+            dv = conn.execute("PRAGMA data_version").fetchone()[0]
+            if dv == data_version:
+                continue
+            data_version = dv
+            v = version_aviso(conn, 'plm_watchfolders')
+            if v != version:
+                version = v
+                ausentes = actualizar_carpetas(conn, observer, cola, vigiladas, indice, ausentes)
     except KeyboardInterrupt:
         log.info("Deteniendo watcher...")
         observer.stop()
 
     observer.join()
+    cola.cerrar()
+    indice.cerrar()
+    escritor.cerrar()
+    conn.close()
     log.info("Watcher detenido.")
 
 
@@ -0,0 +1,346 @@
+"""
+Trabajos — JA · ERP
+Cola de trabajos en segundo plano respaldada por SQLite (tabla trabajos).
+
+Las peticiones solo encolan y devuelven el id; un pool de hilos del propio
+proceso ejecuta los trabajos y va dejando estado, progreso y resultado en la BD.
+El navegador consulta /api/jobs/<id> y puede cancelar con /api/jobs/<id>/cancel.
+
+Registrar un tipo de trabajo:
+
+    @tarea('plm_sync')
+    def trabajo_sync(ctx, **params):
+        ctx.avanzar({'estado': 'escaneando'})   # también comprueba la cancelación
+        return {'nuevos': 3}                     # resultado (JSON)
+"""
+
+import os
+import json
+import uuid
+import shutil
+import socket
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import Blueprint, jsonify, send_file
+
+trabajos = Blueprint('trabajos', __name__)
+log = logging.getLogger('trabajos')
+
+DB = os.path.join(os.path.dirname(__file__), 'crm.db')
+RESULTADOS_DIR = os.path.join(os.path.dirname(__file__), 'trabajos_resultados')
+
+WORKERS = 2
+INTERVALO_PROGRESO = 0.5  # segundos mínimos entre escrituras de progreso
+SONDEO = 2.0              # por si otro proceso encola trabajos
+LATIDO_MAX = 120          # segundos sin progreso para dar por interrumpido un trabajo de otro proceso
+RETENCION_DIAS = 7        # días que se conservan los trabajos acabados y sus archivos
+LIMPIEZA = 3600           # segundos entre limpiezas
+
+# Identifica los trabajos que este proceso tiene en curso: al arrancar, los
+# 'en_curso' de cualquier otro proceso quedaron huérfanos.
+PROCESO = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+TAREAS = {}
+
+
+def get_db():
+    conn = sqlite3.connect(DB)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_trabajos_db():
+    conn = get_db()
+    conn.execute('''CREATE TABLE IF NOT EXISTS trabajos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tipo TEXT NOT NULL,
+        params TEXT,                 -- JSON
+        estado TEXT DEFAULT 'pendiente',  -- pendiente | en_curso | terminado | error | cancelado
+        progreso REAL,               -- 0..1 si se conoce
+        detalle TEXT,                -- JSON con el avance propio de cada tarea
+        resultado TEXT,              -- JSON
+        archivo TEXT,                -- resultado descargable (p. ej. un PDF)
+        error TEXT,
+        cancelar INTEGER DEFAULT 0,
+        creado TEXT DEFAULT CURRENT_TIMESTAMP,
+        inicio TEXT,
+        fin TEXT,
+        latido TEXT,
+        proceso TEXT)''')
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(trabajos)").fetchall()]
+    if 'proceso' not in cols:
+        conn.execute("ALTER TABLE trabajos ADD COLUMN proceso TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trabajos_estado ON trabajos(estado, id)")
+    conn.commit()
+    conn.close()
+
+
+# ── API ───────────────────────────────────────────────────────────────────────
+
+class Cancelado(Exception):
+    pass
+
+
+def tarea(tipo):
+    """Decorador: registra la función que ejecuta los trabajos de un tipo."""
+    def registrar(fn):
+        TAREAS[tipo] = fn
+        return fn
+    return registrar
+
+
+def encolar(tipo, params=None, unico=False):
+    """Encola un trabajo y devuelve su id. Con unico=True, si ya hay uno del mismo
+    tipo pendiente o en curso se devuelve ese."""
+    iniciar_workers()
+    conn = get_db()
+    try:
+        with conn:
+            if unico:
+                row = conn.execute(
+                    "SELECT id FROM trabajos WHERE tipo=? AND estado IN ('pendiente','en_curso') "
+                    "ORDER BY id LIMIT 1", (tipo,)).fetchone()
+                if row:
+                    return row['id']
+            cur = conn.execute("INSERT INTO trabajos (tipo, params) VALUES (?,?)",
+                               (tipo, json.dumps(params or {})))
+            job_id = cur.lastrowid
+    finally:
+        conn.close()
+    _hay_trabajo.set()
+    return job_id
+
+
+def estado_trabajo(job_id):
+    conn = get_db()
+    row = conn.execute("SELECT * FROM trabajos WHERE id=?", (job_id,)).fetchone()
+    conn.close()
+    if row is None:
+        return None
+    return {
+        'id': row['id'], 'tipo': row['tipo'], 'estado': row['estado'],
+        'progreso': row['progreso'],
+        'detalle': json.loads(row['detalle']) if row['detalle'] else {},
+        'resultado': json.loads(row['resultado']) if row['resultado'] else None,
+        'archivo': bool(row['archivo']), 'error': row['error'],
+        'cancelar': bool(row['cancelar']),
+        'creado': row['creado'], 'inicio': row['inicio'], 'fin': row['fin'],
+    }
+
+
+def cancelar_trabajo(job_id):
+    """Un pendiente se cancela al momento; uno en curso, en su próximo avance."""
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE trabajos SET estado='cancelado', fin=? WHERE id=? AND estado='pendiente'",
+                     (datetime.now().isoformat(), job_id))
+        conn.execute("UPDATE trabajos SET cancelar=1 WHERE id=? AND estado='en_curso'", (job_id,))
+    conn.close()
+
+
+# ── EJECUCIÓN ─────────────────────────────────────────────────────────────────
+
+class Contexto:
+    """Lo que recibe cada tarea: progreso, cancelación y dónde dejar archivos."""
+
+    def __init__(self, conn, job_id):
+        self.conn = conn
+        self.id = job_id
+        self._ultimo = 0.0
+        self._lock = threading.Lock()
+
+    def avanzar(self, detalle=None, progreso=None, forzar=False):
+        """Publica el avance (como mucho cada INTERVALO_PROGRESO s). Lanza
+        Cancelado si se pidió cancelar. Se puede llamar desde varios hilos: la
+        conexión del worker admite otros hilos y el lock serializa su uso."""
+        ahora = datetime.now()
+        with self._lock:
+            if not forzar and ahora.timestamp() - self._ultimo < INTERVALO_PROGRESO:
+                return
+            self._ultimo = ahora.timestamp()
+            self.conn.execute(
+                "UPDATE trabajos SET detalle=COALESCE(?, detalle), progreso=COALESCE(?, progreso), "
+                "latido=? WHERE id=?",
+                (json.dumps(detalle) if detalle is not None else None, progreso,
+                 ahora.isoformat(), self.id))
+            cancelar = self.conn.execute("SELECT cancelar FROM trabajos WHERE id=?",
+                                         (self.id,)).fetchone()[0]
+        if cancelar:
+            raise Cancelado()
+
+    def ruta_archivo(self, nombre):
+        """Ruta donde la tarea deja su resultado descargable."""
+        carpeta = os.path.join(RESULTADOS_DIR, str(self.id))
+        os.makedirs(carpeta, exist_ok=True)
+        return os.path.join(carpeta, nombre)
+
+
+_hay_trabajo = threading.Event()
+_workers_lock = threading.Lock()
+_workers = []
+
+
+def iniciar_workers(n=WORKERS):
+    """Arranca el pool una sola vez por proceso (y marca como interrumpidos los
+    trabajos que otro proceso dejó a medias)."""
+    with _workers_lock:
+        if _workers:
+            return
+        conn = get_db()
+        with conn:
+            conn.execute("""UPDATE trabajos SET estado='error', error='Interrumpido', fin=?
+                WHERE estado='en_curso' AND proceso IS NOT ?""",
+                         (datetime.now().isoformat(), PROCESO))
+        conn.close()
+        for i in range(n):
+            t = threading.Thread(target=_worker, name=f'trabajos-{i}', daemon=True)
+            t.start()
+            _workers.append(t)
+
+
+# ── LIMPIEZA ──────────────────────────────────────────────────────────────────
+
+_ultima_limpieza = None
+
+
+def limpiar(conn):
+    """Borra los trabajos acabados hace más de RETENCION_DIAS con sus archivos,
+    las carpetas de resultados sin trabajo y da por interrumpidos los trabajos de
+    otros procesos (p. ej. uno que murió con este en marcha) sin latido reciente."""
+    ahora = datetime.now()
+    limite = (ahora - timedelta(days=RETENCION_DIAS)).isoformat()
+    latido = (ahora - timedelta(seconds=LATIDO_MAX)).isoformat()
+    with conn:
+        conn.execute("""UPDATE trabajos SET estado='error', error='Interrumpido', fin=?
+            WHERE estado='en_curso' AND proceso IS NOT ? AND COALESCE(latido, inicio) < ?""",
+                     (ahora.isoformat(), PROCESO, latido))
+        conn.execute("""DELETE FROM trabajos
+            WHERE estado IN ('terminado','error','cancelado') AND fin < ?""", (limite,))
+    if not os.path.isdir(RESULTADOS_DIR):
+        return
+    vivos = {str(r[0]) for r in conn.execute("SELECT id FROM trabajos")}
+    for nombre in os.listdir(RESULTADOS_DIR):
+        if nombre not in vivos:
+            shutil.rmtree(os.path.join(RESULTADOS_DIR, nombre), ignore_errors=True)
+
+
+def _limpiar_si_toca():
+    global _ultima_limpieza
+    with _workers_lock:
+        if _ultima_limpieza is not None and time.monotonic() - _ultima_limpieza < LIMPIEZA:
+            return
+        _ultima_limpieza = time.monotonic()
+    conn = get_db()
+    try:
+        limpiar(conn)
+    except (sqlite3.Error, OSError) as e:
+        log.warning(f"Limpieza de trabajos fallida: {e}")
+    finally:
+        conn.close()
+
+
+def _reclamar(conn):
+    """Toma el siguiente trabajo pendiente de forma atómica (BEGIN IMMEDIATE)."""
+    if not conn.execute("SELECT 1 FROM trabajos WHERE estado='pendiente' LIMIT 1").fetchone():
+        return None  # sin bloqueo de escritura mientras no haya nada que hacer
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute(
+            "SELECT * FROM trabajos WHERE estado='pendiente' ORDER BY id LIMIT 1").fetchone()
+        if row:
+            ahora = datetime.now().isoformat()
+            conn.execute("UPDATE trabajos SET estado='en_curso', inicio=?, latido=?, proceso=? "
+                         "WHERE id=?", (ahora, ahora, PROCESO, row['id']))
+        conn.execute('COMMIT')
+        return row
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def _terminar(conn, job_id, estado, **campos):
+    campos['fin'] = datetime.now().isoformat()
+    sets = ', '.join(f"{k}=?" for k in campos)
+    conn.execute(f"UPDATE trabajos SET estado=?, {sets} WHERE id=?",
+                 (estado, *campos.values(), job_id))
+
+
+def _ejecutar(conn, job):
+    ctx = Contexto(conn, job['id'])
+    fn = TAREAS.get(job['tipo'])
+    if fn is None:
+        _terminar(conn, job['id'], 'error', error=f"Tipo de trabajo desconocido: {job['tipo']}")
+        return
+    try:
+        resultado = fn(ctx, **json.loads(job['params'] or '{}'))
+    except Cancelado:
+        _terminar(conn, job['id'], 'cancelado')
+        return
+    except Exception as e:
+        _terminar(conn, job['id'], 'error', error=str(e))
+        return
+    archivo = None
+    if isinstance(resultado, dict):
+        archivo = resultado.pop('archivo', None)
+    _terminar(conn, job['id'], 'terminado', progreso=1.0, archivo=archivo,
+              resultado=json.dumps(resultado))
+
+
+def _worker():
+    # Contexto.avanzar puede llegar desde los hilos de la propia tarea
+    conn = sqlite3.connect(DB, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.isolation_level = None  # autocommit: el progreso se ve al momento
+    while True:
+        _hay_trabajo.clear()
+        try:
+            job = _reclamar(conn)
+        except sqlite3.OperationalError:
+            job = None
+        if job is None:
+            _limpiar_si_toca()
+            _hay_trabajo.wait(SONDEO)
+            continue
+        try:
+            _ejecutar(conn, job)
+        except Exception as e:
+            # p. ej. la BD bloqueada al guardar el resultado: el worker sigue vivo
+            log.exception(f"Trabajo {job['id']} ({job['tipo']})")
+            try:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                _terminar(conn, job['id'], 'error', error=str(e))
+            except sqlite3.Error:
+                pass
+
+
+# ── RUTAS ─────────────────────────────────────────────────────────────────────
+
+@trabajos.route('/api/jobs/<int:job_id>')
+def api_job(job_id):
+    iniciar_workers()  # tras un reinicio, retoma los pendientes
+    estado = estado_trabajo(job_id)
+    if estado is None:
+        return jsonify({'ok': False, 'error': 'Trabajo no encontrado'}), 404
+    return jsonify(estado)
+
+
+@trabajos.route('/api/jobs/<int:job_id>/cancel', methods=['POST'])
+def api_job_cancelar(job_id):
+    cancelar_trabajo(job_id)
+    return jsonify(estado_trabajo(job_id) or {'ok': False})
+
+
+@trabajos.route('/api/jobs/<int:job_id>/resultado')
+def api_job_resultado(job_id):
+    conn = get_db()
+    row = conn.execute("SELECT archivo FROM trabajos WHERE id=? AND estado='terminado'",
+                       (job_id,)).fetchone()
+    conn.close()
+    if not row or not row['archivo'] or not os.path.isfile(row['archivo']):
+        return jsonify({'ok': False, 'error': 'Sin resultado'}), 404
+    return send_file(row['archivo'], as_attachment=True,
+                     download_name=os.path.basename(row['archivo']))